@@ -1383,3 +1383,260 @@ processing.run('CAFS:suitableroofs', parameters, feedback=MyFeedBack())
 
 
 
+
+
+############## Wall aspect - check the batched calculation against the original loop ####################
+# Builds some synthetic DSMs with rectangular "buildings" and compares WallworkerModified.Worker.run
+# with runLegacy. The number of differing pixels should be zero for every DSM and scale.
+
+import numpy as np
+from UMEP.WallHeight import wallalgorithms
+from solarcalculator.WallworkerModified import Worker as WallWorker
+
+def syntheticDsm(seed, size=80):
+	rng = np.random.default_rng(seed)
+	dsm = np.zeros((size, size + 13))
+	for building in range(12):
+		row, col = rng.integers(0, size - 15, 2)
+		height, width = rng.integers(4, 15, 2)
+		dsm[row:row + height, col:col + width] = rng.uniform(3, 15)
+	return dsm + rng.normal(0, 0.2, dsm.shape)
+
+for seed in range(6):
+	for scale in (0.5, 1.0, 2.0):
+		dsm = syntheticDsm(seed)
+		walls = wallalgorithms.findwalls(dsm, WALL_LIMIT)
+		differences = WallWorker(walls, scale, dsm, MyFeedBack()).compareWithLegacy()
+		print(f"seed {seed}, scale {scale}: {differences} differing pixels")
+
+############## Wall tiling - check the tiled calculation against the whole DSM ####################
+# Uses the synthetic DSMs above and compares the walls and aspects of WallTiler with those of
+# WallworkerModified.Worker.run on the whole DSM, for both aspect methods and for tiles both smaller and
+# larger than the filter. The numbers of differing pixels should be zero.
+
+from solarcalculator.WallworkerModified import FILTER_METHOD, GRADIENT_METHOD
+from solarcalculator.wall_tiling import WallTiler
+
+for method in (FILTER_METHOD, GRADIENT_METHOD):
+	for scale in (0.5, 1.0, 2.0):
+		dsm = syntheticDsm(1)
+		walls = wallalgorithms.findwalls(dsm, WALL_LIMIT)
+		aspect = WallWorker(walls, scale, dsm, MyFeedBack(), method).run()
+		for tileSize in (5, 12, 30, 1000):
+			tiledWalls, tiledAspect = WallTiler(dsm, scale, WALL_LIMIT, MyFeedBack(), method, tileSize).run()
+			print(f"{method}, scale {scale}, tiles of {tileSize}: {np.count_nonzero(tiledWalls != walls)} differing wall pixels, {np.count_nonzero(tiledAspect != aspect)} differing aspect pixels")
+
+############## SEBE patch shadow cache - check a cached rerun matches the uncached calculation ####################
+# Uses the synthetic DSM above and some made up sky patch radiation. The first run fills the cache,
+# the second reads the shadows from it. Both maximum differences should be zero.
+
+import tempfile
+from solarcalculator.sebeworker_modified import Worker as SebeWorker
+from solarcalculator.patch_shadow_cache import PatchShadowCache
+
+dsm = syntheticDsm(0) + np.linspace(0, 10, 80)[:, None]
+slope, aspect = wallalgorithms.get_ders(dsm, 1.0)
+patches = np.array([(altitude, azimuth * 360. / count) for altitude, count in zip([6, 18, 30, 42, 54, 66, 78, 90], [30, 30, 24, 24, 18, 12, 6, 1]) for azimuth in range(count)])
+rng = np.random.default_rng(0)
+radmatI, radmatD, radmatR = [np.c_[patches, rng.uniform(0, 300, 145)] for radmat in range(3)]
+sebeArguments = (dsm, 1.0, slope, aspect, 1.0, dsm.shape[1], dsm.shape[0], dsm * 0, dsm * 0, 0.15, 0.03, radmatI, radmatD, radmatR, False, MyFeedBack())
+uncached = SebeWorker(*sebeArguments).run()
+cacheDirectory = tempfile.mkdtemp()
+for run in range(2):
+	shadowCache = PatchShadowCache(cacheDirectory, dsm, 1.0, radmatI[:, 0:2])
+	cached = SebeWorker(*sebeArguments, shadowCache=shadowCache).run()
+	print(f"run {run}: maximum difference {np.abs(cached - uncached).max()}")
+
+############## Solar ephemeris - check the vectorised sun positions against UMEP's ####################
+# Compares solar_ephemeris.sunPositionsAt with UMEP's sun_position through a year at the location of the Cumbria
+# TMY file, then metdataSolarGeometry with Solweig_2015a_metdata_noload on the processed TMY data.
+# The maximum differences should be a few hundredths of a degree (azimuths are only compared with the sun up,
+# as they swing round quickly near the zenith and nadir and don't matter with the sun down).
+
+import datetime
+from UMEP.Utilities.SEBESOLWEIGCommonFiles import sun_position as sp
+from UMEP.Utilities.SEBESOLWEIGCommonFiles.Solweig_v2015_metdata_noload import Solweig_2015a_metdata_noload
+from solarcalculator.metdata_processor_modified import MetdataProcessor
+from solarcalculator.solar_ephemeris import sunPositionsAt, metdataSolarGeometry
+
+def angleDifference(first, second):
+	return np.abs(np.mod(first - second + 180., 360.) - 180.)
+
+location = {'longitude': -2.963, 'latitude': 54.430, 'altitude': 100.}
+timestamps = np.arange(np.datetime64('2015-01-01T00:00'), np.datetime64('2016-01-01T00:00'), np.timedelta64(97, 'm'))
+azimuth, altitude = sunPositionsAt(timestamps, location['longitude'], location['latitude'])
+umepAzimuth = np.zeros(len(timestamps))
+umepAltitude = np.zeros(len(timestamps))
+for i, timestamp in enumerate(timestamps.astype(datetime.datetime)):
+	time = {'year': timestamp.year, 'month': timestamp.month, 'day': timestamp.day,
+		'hour': timestamp.hour, 'min': timestamp.minute, 'sec': 0, 'UTC': 0}
+	sun = sp.sun_position(time, location)
+	umepAzimuth[i] = sun['azimuth']
+	umepAltitude[i] = 90. - sun['zenith']
+sunUp = umepAltitude > 0
+print(f"sunPositionsAt: maximum azimuth difference {angleDifference(azimuth, umepAzimuth)[sunUp].max():.4f}, "
+	  f"maximum altitude difference {np.abs(altitude - umepAltitude).max():.4f} degrees")
+
+metdataProcessor = MetdataProcessor()
+metdataProcessor.importFileFromFilePath(projectPath / METEOROLOGICAL_FILE_RAW_FILE_NAME)
+processedFilePath = Path(tempfile.mkdtemp()) / METEOROLOGICAL_FILE_PROCESSED_FILE_NAME
+metdataProcessor.preprocessMetData(processedFilePath)
+metdata = np.loadtxt(processedFilePath, skiprows=1, delimiter=' ')
+fast = metdataSolarGeometry(metdata, location, 0)
+umep = Solweig_2015a_metdata_noload(metdata, location, 0)
+sunUp = umep[1] > 0
+print(f"metdataSolarGeometry: maximum azimuth difference {angleDifference(fast[2], umep[2])[sunUp].max():.4f}, "
+	  f"maximum altitude difference {np.abs(fast[1] - umep[1]).max():.4f}, "
+	  f"maximum daily maximum altitude difference {np.abs(fast[7] - umep[7]).max():.4f} degrees; "
+	  f"{np.count_nonzero(fast[4] != umep[4])} rows with a different day of year")
+
+############## Roof shadows - check them against UMEP's shadow casting ####################
+# Compares shadow_kernels.roofShadow and roofShadowMask with UMEP's shadowingfunctionglobalradiation on the synthetic
+# DSMs above and on one of buildings of whole metres, with the sun every 9 degrees of azimuth (including due north,
+# east, south and west and the diagonals) and between 1 and 85 degrees high. Expect no differing pixels.
+
+from scipy.ndimage import gaussian_filter
+from UMEP.Utilities import shadowingfunctions as shadow
+from solarcalculator.shadow_kernels import roofShadow, roofShadowMask
+
+rng = np.random.default_rng(1)
+buildings = gaussian_filter((rng.random((70, 85)) > 0.9) * np.round(rng.uniform(3, 20, (70, 85))), 1).round()
+for name, dsm in [('synthetic DSM 0', syntheticDsm(0)), ('synthetic DSM 3', syntheticDsm(3)), ('buildings', buildings)]:
+	shadowDifferences, maskDifferences = 0, 0
+	for azimuth in range(0, 360, 9):
+		for altitude in (1, 3, 10, 25, 45, 60, 85):
+			umep = shadow.shadowingfunctionglobalradiation(dsm, azimuth, altitude, 1.0, None, 1)
+			shadowDifferences += np.count_nonzero(roofShadow(dsm, azimuth, altitude, 1.0) != umep)
+			maskDifferences += np.count_nonzero(roofShadowMask(dsm, azimuth, altitude, 1.0) != (umep == 1))
+	print(f"Roof shadows on {name}: {shadowDifferences} roofShadow and {maskDifferences} roofShadowMask pixels differ from UMEP's (should be 0)")
+
+############## Line sweep shadows - check them against the shift and compare sweep ####################
+# Compares shadow_kernels.lineSweepShadowMask with roofShadowMask on a synthetic hilly DSM with scattered spikes,
+# and on one of buildings of whole metres (where the shadows can be level with the roofs), for sun positions every
+# 7 degrees of azimuth and between 2 and 70 degrees high. Expect no differences.
+
+from scipy.ndimage import gaussian_filter
+from solarcalculator.shadow_kernels import roofShadowMask, lineSweepShadowMask
+
+rng = np.random.default_rng(0)
+hills = gaussian_filter(rng.normal(0, 1, (150, 170)), 6) * 60
+hills.ravel()[rng.integers(0, hills.size, 300)] += 15
+hills -= hills.min()
+buildings = gaussian_filter((rng.random((120, 130)) > 0.9) * np.round(rng.uniform(3, 20, (120, 130))), 1).round()
+for name, dsm in [('hills', hills), ('buildings', buildings)]:
+	differences = 0
+	for azimuth in range(0, 360, 7):
+		for altitude in (2, 5, 20, 35, 45, 70):
+			differences += np.count_nonzero(roofShadowMask(dsm, azimuth, altitude, 1.0) != lineSweepShadowMask(dsm, azimuth, altitude, 1.0))
+	print(f"Line sweep on {name}: {differences} pixels differ from roofShadowMask (should be 0)")
+
+############## Wide area window - check the window indices against zooming the whole wide area ####################
+# For random wide area shapes and local areas, picks the local window out of a random low resolution raster with
+# wideAreaWindowIndices and compares it with zoomResolutionArray followed by clipping, as used before.
+# Local areas off the far edge of the wide area should all match; those reaching it either match or are refused
+# (zoom can put the last row or column of the zoomed wide area outside the low resolution raster).
+
+from types import SimpleNamespace
+from solarcalculator.dailyshading_modified import wideAreaWindowIndices, zoomResolutionArray
+from solarcalculator.shadow_kernels import compositeWideAreaWindow
+from solarcalculator.solar_exception import SolarException
+
+rng = np.random.default_rng(0)
+matched, differed, refused = 0, 0, 0
+for trial in range(1000):
+	lowResShape = tuple(rng.integers(5, 120, 2))
+	wideWidth, wideHeight = int(lowResShape[1] * rng.uniform(2, 12)), int(lowResShape[0] * rng.uniform(2, 12))
+	wideExtent = SimpleNamespace(xmin=0, ymax=wideHeight, width=wideWidth, height=wideHeight)
+	width, height = rng.integers(1, wideWidth + 1), rng.integers(1, wideHeight + 1)
+	xmin, top = rng.integers(0, wideWidth - width + 1), rng.integers(0, wideHeight - height + 1)
+	if trial % 2 == 0: # every other local area reaches the far corner
+		xmin, top = wideWidth - width, wideHeight - height
+	localExtent = SimpleNamespace(xmin=xmin, xmax=xmin + width, ymax=wideHeight - top, ymin=wideHeight - top - height)
+	lowResArray = rng.random(lowResShape)
+	clipped = zoomResolutionArray(lowResArray, wideWidth / lowResShape[1], wideHeight / lowResShape[0])[top:top + height, xmin:xmin + width]
+	try:
+		window = compositeWideAreaWindow(lowResArray, *wideAreaWindowIndices(lowResShape, wideExtent, localExtent))
+	except SolarException:
+		refused += 1
+		continue
+	if np.array_equal(window, clipped):
+		matched += 1
+	else:
+		differed += 1
+print(f"{matched} windows matched, {differed} differed (should be 0), {refused} refused at the far edge")
+
+############## Regional wide area shadows - check them against those of the merged wide area DSM ####################
+# Casts the shadows of a synthetic region with a local area of coarse buildings in it through a RegionalShadowCache,
+# and compares them over the local area with UMEP's shadows on the region with the local area flattened at its
+# highest point, as the merged wide area DSM is. Expect no differences; casting on the region as it is (the second
+# figure) lets the coarse buildings shade the local area.
+
+from types import SimpleNamespace
+from UMEP.Utilities import shadowingfunctions as shadow
+from solarcalculator.shadow_kernels import roofShadowDepth
+from solarcalculator.regional_shadow_cache import RegionalShadowCache, regionWindow
+
+rng = np.random.default_rng(0)
+rows, columns = np.mgrid[0:200, 0:200]
+dem = 300 + 250 * np.exp(-((columns - 40)**2 + (rows - 150)**2) / 800.) + 120 * np.exp(-((columns - 160)**2 + (rows - 40)**2) / 400.)
+dem[60:80, 90:115] += (rng.random((20, 25)) > 0.7) * 12
+localHeight = dem[60:80, 90:115].max() + 3 # the highest point of the local DSM is above that of the coarse DEM
+geoTransform = (0., 10., 0., 2000., 0., -10.)
+localArea = regionWindow(geoTransform, dem.shape, SimpleNamespace(xmin=900, ymin=1200, xmax=1150, ymax=1400))
+sunPositions = [(azimuth, altitude) for azimuth in range(5, 360, 37) for altitude in (3, 8, 15, 30)]
+regionalCache = RegionalShadowCache(dem, geoTransform, 0.1)
+regionalCache.addSteps('20201222', np.arange(len(sunPositions)), *zip(*sunPositions))
+merged = dem.copy()
+merged[localArea.rows, localArea.columns] = localHeight
+differences, rawDifferences = 0, 0
+for azimuth, altitude in sunPositions:
+	regional = regionalCache.shadow(azimuth, altitude, lambda azimuth, altitude: roofShadowDepth(dem, azimuth, altitude, 0.1), None, localArea, localHeight)
+	baseline = shadow.shadowingfunctionglobalradiation(merged, azimuth, altitude, 0.1, None, 1)[localArea.rows, localArea.columns]
+	raw = shadow.shadowingfunctionglobalradiation(dem, azimuth, altitude, 0.1, None, 1)[localArea.rows, localArea.columns]
+	differences += np.count_nonzero(regional[localArea.rows, localArea.columns] != baseline)
+	rawDifferences += np.count_nonzero(raw != baseline)
+print(f"Regional shadows: {differences} local area pixels differ from the merged wide area DSM's (should be 0), "
+	  f"{rawDifferences} without flattening the local area")
+
+############## Receiver shadows - check the ray march against the shift and compare sweep ####################
+# The receiver engine marches rays towards the sun from the receiver pixels with point_shadows.sunlitAtPoints.
+# Compares it at every pixel with roofShadowMask on a synthetic hilly DSM and on one of buildings of whole metres,
+# for sun positions every 7 degrees of azimuth and between 2 and 70 degrees high. Expect no differences.
+
+from scipy.ndimage import gaussian_filter
+from solarcalculator.shadow_kernels import roofShadowMask
+from solarcalculator.point_shadows import sunlitAtPoints
+
+rng = np.random.default_rng(0)
+hills = gaussian_filter(rng.normal(0, 1, (90, 100)), 6) * 60
+hills -= hills.min()
+buildings = gaussian_filter((rng.random((80, 90)) > 0.9) * np.round(rng.uniform(3, 20, (80, 90))), 1).round()
+sunPositions = np.array([(azimuth, altitude) for azimuth in range(0, 360, 7) for altitude in (2, 5, 20, 35, 45, 70)], dtype=float)
+for name, dsm in [('hills', hills), ('buildings', buildings)]:
+	rows, columns = np.indices(dsm.shape).reshape(2, -1)
+	sunlit = sunlitAtPoints(dsm, 1.0, rows, columns, sunPositions[:, 0], sunPositions[:, 1])
+	cast = np.array([roofShadowMask(dsm, azimuth, altitude, 1.0).ravel() for azimuth, altitude in sunPositions])
+	print(f"Receivers on {name}: {np.count_nonzero(sunlit != cast)} pixel shadows differ from roofShadowMask (should be 0)")
+
+############## Parallel time steps - check them against the serial calculation ####################
+# Casts the shadows of three days on the synthetic DSM above, without and then with a synthetic wide area around it,
+# both serially with shadingFromSunPositions and with the time steps shared out between worker processes by
+# parallelShadingFromSunPositions. All the maximum differences should be zero.
+
+from types import SimpleNamespace
+from solarcalculator.dailyshading_modified import shadingFromSunPositions, sunPositions, wideAreaWindowIndices
+from solarcalculator.timestep_pool import parallelShadingFromSunPositions, umepShadow
+
+dsm = syntheticDsm(2)
+rows, columns = np.mgrid[0:60, 0:70]
+wideDsm = 40 * np.exp(-((columns - 15)**2 + (rows - 45)**2) / 150.) + 25 * np.exp(-((columns - 55)**2 + (rows - 10)**2) / 60.)
+wideExtent = SimpleNamespace(xmin=0, ymax=600, width=700, height=600) # 10m pixels
+localExtent = SimpleNamespace(xmin=300, xmax=300 + dsm.shape[1], ymin=220, ymax=220 + dsm.shape[0], width=dsm.shape[1], height=dsm.shape[0])
+days = [sunPositions((-2.4, 54.8), [2020, month, 21, 0, 0, 0], 0, 30, 0, dst) for month, dst in [(3, 0), (6, 1), (12, 0)]]
+for useWideArea in (False, True):
+	windowIndices = wideAreaWindowIndices(wideDsm.shape, wideExtent, localExtent) if useWideArea else None
+	parallel = parallelShadingFromSunPositions(dsm, wideDsm, 1.0, 0.1, windowIndices, days, useWideArea, umepShadow, workers=2)
+	for (altitudes, azimuths), parallelResult in zip(days, parallel):
+		serial = shadingFromSunPositions(dsm, wideDsm, 1.0, 0.1, wideExtent, localExtent, altitudes, azimuths, FakeDialog(QProgressBar()), useWideArea)
+		differences = [np.abs(np.asarray(parallelResult[key]) - np.asarray(serial[key])).max() for key in ('shfinal', 'shlocal', 'shwide', 'shWideClippedArray')]
+		print(f"wide area {useWideArea}: maximum differences {differences}")
@@ -27,6 +27,7 @@ def isDebug():
 
 DATA_STRING = "DATA"
 RESULTS_STRING = "RESULTS"
+CACHE_STRING = "CACHE" # Directory (inside the data directory) for cached intermediate results
 FULL_AREA_BUILDINGS_LAYER_NAME="CUMBRIA_BUILDINGS"  
 LOCAL_EXTENT_LAYER_NAME='Ambleside Extent'
 LOCAL_BUILDINGS_LAYER_NAME="LOCAL_BUILDINGS"
@@ -84,6 +85,7 @@ WALL_HEIGHT_LAYER_NAME="WALL_HEIGHT"
 SORTED_CSV_OUTPUT_FILENAME="SORTED_SOLAR_PV_ROOF_ENERGY_OUTPUT"
 CSV_OUTPUT_FILENAME="SOLAR_PV_ROOF_ENERGY_OUTPUT"
 CSV_SHADOW_OUTPUT_FILENAME="REJECTED_SOLAR_ROOFS"
+CSV_HOURLY_SHADE_OUTPUT_FILENAME="HOURLY_SHADE_PROFILES"
 
 # TODO (low priority): Change this into a parameter in the dialog (with these defaults)
 WALL_LIMIT = 3
@@ -20,13 +20,20 @@
 from __future__ import absolute_import
 from builtins import range
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import scipy.ndimage.interpolation as sc
+from scipy.ndimage import gaussian_filter, sobel
 import math
 from UMEP.WallHeight.wallalgorithms import get_ders
 import linecache
 import sys
 
 
+# Methods of calculating wall aspect
+FILTER_METHOD = 'filter' # rotating line filter from UMEP (the original method)
+GRADIENT_METHOD = 'gradient' # single pass structure tensor of the DSM
+WALL_ASPECT_METHODS = [FILTER_METHOD, GRADIENT_METHOD]
+
 
 class Worker():
     """
@@ -37,69 +44,106 @@ class Worker():
     
     """
 
-    def __init__(self, walls, scale, dsm, feedback):
+    def __init__(self, walls, scale, dsm, feedback, method=FILTER_METHOD):
 
         self.dsm = dsm
         self.scale = scale
         self.walls = walls
         self.feedback = feedback
+        self.method = method
+
+    # Creates a numpy array of the calculated wall aspect using the method chosen in the constructor
+    def run(self):
+        if self.method == GRADIENT_METHOD:
+            return self.runGradient()
+        return self.runFilter()
 
     # May throw exceptions directly in this modified version
     # Creates a numpy array of the calculated wall aspect based on a DSM layer and Wall Height Raster
-    def run(self):
-        ret = None
+    # Batched version of runLegacy - the filter responses of all 180 rotations are calculated for
+    # blocks of wall pixels at once, rather than visiting every pixel in a python loop for every rotation.
+    # Gives the same dirwalls output as runLegacy.
+    def runFilter(self):
         a = self.dsm
         scale = self.scale
         walls = self.walls
 
-        # def filter1Goodwin_as_aspect_v3(walls, scale, a):
-
         row = a.shape[0]
         col = a.shape[1]
 
-        filtersize = np.floor((scale + 0.0000000001) * 9)
-        if filtersize <= 2:
-            filtersize = 3
-        else:
-            if filtersize != 9:
-                if filtersize % 2 == 0:
-                    filtersize = filtersize + 1
+        filtersize, filthalveceil, filthalvefloor = calculateFilterSize(scale)
+        filters = rotatedFilters(filtersize, filthalveceil, filthalvefloor)
+        indices = np.array([index for index, filtmatrix1, filtmatrixbuild in filters])
+        wallFilters = np.stack([filtmatrix1.ravel() for index, filtmatrix1, filtmatrixbuild in filters])
+        buildMasks1 = [filtmatrixbuild.ravel() == 1 for index, filtmatrix1, filtmatrixbuild in filters]
+        buildMasks2 = [filtmatrixbuild.ravel() == 2 for index, filtmatrix1, filtmatrixbuild in filters]
+
+        y = np.zeros((row, col))  # final direction
+        x = np.zeros((row, col))  # building side
+        walls[walls > 0] = 1
+
+        # Same pixel range as the legacy loop
+        rowStart, rowEnd = filthalveceil - 1, row - filthalveceil - 1
+        colStart, colEnd = filthalveceil - 1, col - filthalveceil - 1
+        wallRows, wallCols = np.nonzero(walls[rowStart:rowEnd, colStart:colEnd] == 1)
+        wallRows = wallRows + rowStart
+        wallCols = wallCols + colStart
+
+        numberOfWallPixels = wallRows.size
+        if numberOfWallPixels > 0:
+            # Windows are views onto the original arrays, indexed by their top left corner
+            wallWindows = sliding_window_view(walls, (filtersize, filtersize))
+            dsmWindows = sliding_window_view(a, (filtersize, filtersize))
+
+        for start in range(0, numberOfWallPixels, WALL_PIXEL_BLOCK_SIZE):
+            if self.feedback.isCanceled():
+                break
+            i = wallRows[start:start + WALL_PIXEL_BLOCK_SIZE]
+            j = wallCols[start:start + WALL_PIXEL_BLOCK_SIZE]
+            wallscut = wallWindows[i - filthalvefloor, j - filthalvefloor].reshape(i.size, -1)
+            dsmcut = dsmWindows[i - filthalvefloor, j - filthalvefloor].reshape(i.size, -1)
+
+            # Filter response for every rotation; the legacy loop keeps the first rotation with the largest response
+            response = wallscut @ wallFilters.T
+            best = np.argmax(response, axis=1)
+            found = response[np.arange(i.size), best] > 0
 
-        filthalveceil = int(np.ceil(filtersize / 2.))
-        filthalvefloor = int(np.floor(filtersize / 2.))
+            side = np.zeros(i.size)
+            for h in np.unique(best[found]):
+                selected = found & (best == h)
+                building1 = dsmcut[selected][:, buildMasks1[h]].sum(axis=1)
+                building2 = dsmcut[selected][:, buildMasks2[h]].sum(axis=1)
+                side[selected] = np.where(building1 > building2, 1, 2)
 
-        filtmatrix = np.zeros((int(filtersize), int(filtersize)))
-        buildfilt = np.zeros((int(filtersize), int(filtersize)))
+            x[i[found], j[found]] = side[found]
+            y[i[found], j[found]] = indices[best[found]]
 
-        filtmatrix[:, filthalveceil - 1] = 1
-        buildfilt[filthalveceil - 1, 0:filthalvefloor] = 1
-        buildfilt[filthalveceil - 1, filthalveceil: int(filtersize)] = 2
+            self.feedback.setProgress(int((start + i.size) * 50 / numberOfWallPixels)) # From 0 to 50% as this is the first half of processing
+
+        return finaliseWallDirections(y, x, walls, a, scale)
+
+    # Original pixel by pixel implementation from UMEP, kept so that the batched version can be checked against it
+    def runLegacy(self):
+        ret = None
+        a = self.dsm
+        scale = self.scale
+        walls = self.walls
+
+        # def filter1Goodwin_as_aspect_v3(walls, scale, a):
+
+        row = a.shape[0]
+        col = a.shape[1]
+
+        filtersize, filthalveceil, filthalvefloor = calculateFilterSize(scale)
 
         y = np.zeros((row, col))  # final direction
         z = np.zeros((row, col))  # temporary direction
         x = np.zeros((row, col))  # building side
         walls[walls > 0] = 1
 
-        for h in range(0, 180):  # =0:1:180 #%increased resolution to 1 deg 20140911
+        for h, (index, filtmatrix1, filtmatrixbuild) in enumerate(rotatedFilters(filtersize, filthalveceil, filthalvefloor)):  # =0:1:180 #%increased resolution to 1 deg 20140911
             if self.feedback.isCanceled():
                     break
-            filtmatrix1temp = sc.rotate(filtmatrix, h, order=1, reshape=False, mode='nearest')  # bilinear
-            filtmatrix1 = np.round(filtmatrix1temp)
-            filtmatrixbuildtemp = sc.rotate(buildfilt, h, order=0, reshape=False, mode='nearest')  # Nearest neighbor
-            filtmatrixbuild = np.round(filtmatrixbuildtemp)
-            index = 270-h
-            if h == 150:
-                filtmatrixbuild[:, filtmatrix.shape[0] - 1] = 0
-            if h == 30:
-                filtmatrixbuild[:, filtmatrix.shape[0] - 1] = 0
-            if index == 225:
-                n = filtmatrix.shape[0] - 1
-                filtmatrix1[0, 0] = 1
-                filtmatrix1[n, n] = 1
-            if index == 135:
-                n = filtmatrix.shape[0] - 1
-                filtmatrix1[0, n] = 1
-                filtmatrix1[n, 0] = 1
 
             for i in range(int(filthalveceil)-1, row - int(filthalveceil) - 1):  #i=filthalveceil:sizey-filthalveceil
                 for j in range(int(filthalveceil)-1, col - int(filthalveceil) - 1):  #(j=filthalveceil:sizex-filthalveceil
@@ -117,17 +161,66 @@ class Worker():
 
             self.feedback.setProgress(int(h * 50/180)) # From 0 to 50% as this is the first half of processing
 
-        y[(x == 1)] = y[(x == 1)] - 180
-        y[(y < 0)] = y[(y < 0)] + 360
+        return finaliseWallDirections(y, x, walls, a, scale)
 
-        grad, asp = get_ders(a, scale)
+    # Fast alternative to the 180 rotation filter search, done in a single pass over the DSM.
+    # The wall orientation is the dominant direction of the local structure tensor of the DSM gradient
+    # (smoothed over roughly the same window as the line filter), and the wall faces away from the
+    # building, i.e. down the smoothed height difference across the wall.
+    # Directions are not quantised to whole degrees, so they differ slightly from the filter method -
+    # use compareWallAspects to see by how much for a particular area.
+    def runGradient(self):
+        a = self.dsm
+        scale = self.scale
+        walls = self.walls
 
-        y = y + ((walls == 1) * 1) * ((y == 0) * 1) * (asp / (math.pi / 180.))
+        sigma = gradientSmoothingSigma(scale)
+
+        walls[walls > 0] = 1
+        wallPixels = walls == 1
+
+        fy = sobel(a, 0)  # rows (southwards)
+        fx = sobel(a, 1)  # columns (eastwards)
+        self.feedback.setProgress(10)
+        jxx = gaussian_filter(fx * fx, sigma, truncate=GRADIENT_SMOOTHING_TRUNCATE)
+        jyy = gaussian_filter(fy * fy, sigma, truncate=GRADIENT_SMOOTHING_TRUNCATE)
+        jxy = gaussian_filter(fx * fy, sigma, truncate=GRADIENT_SMOOTHING_TRUNCATE)
+        self.feedback.setProgress(30)
+
+        # Wall pixels where the structure tensor has no orientation (no height change anywhere near them)
+        unoriented = jxx[wallPixels] + jyy[wallPixels] <= WALL_ORIENTATION_TOLERANCE
+
+        # Axis of the wall normal, then pick the end of the axis that points downhill (away from the building)
+        theta = 0.5 * np.arctan2(2 * jxy[wallPixels], jxx[wallPixels] - jyy[wallPixels])
+        normalx = np.cos(theta)
+        normaly = np.sin(theta)
+        side = np.sign(normalx * gaussian_filter(fx, sigma, truncate=GRADIENT_SMOOTHING_TRUNCATE)[wallPixels]
+                       + normaly * gaussian_filter(fy, sigma, truncate=GRADIENT_SMOOTHING_TRUNCATE)[wallPixels])
+        side[side == 0] = 1
+        normalx = -side * normalx
+        normaly = -side * normaly
+
+        directions = np.degrees(np.arctan2(normalx, -normaly)) % 360
+
+        # Those with no orientation fall back to the slope aspect, as in the filter method
+        if unoriented.any():
+            grad, asp = get_ders(a, scale)
+            directions[unoriented] = asp[wallPixels][unoriented] / (math.pi / 180.)
+
+        y = np.zeros(a.shape)
+        y[wallPixels] = directions
+        self.feedback.setProgress(50) # From 0 to 50% as this is the first half of processing
 
         dirwalls = y
 
         return dirwalls
 
+    # Runs both implementations on copies of the inputs and returns the number of pixels where they disagree
+    # (should always be zero)
+    def compareWithLegacy(self):
+        batched = Worker(np.copy(self.walls), self.scale, self.dsm, self.feedback).runFilter()
+        legacy = Worker(np.copy(self.walls), self.scale, self.dsm, self.feedback).runLegacy()
+        return int(np.count_nonzero(batched != legacy))
 
     def print_exception(self):
         exc_type, exc_obj, tb = sys.exc_info()
@@ -138,3 +231,111 @@ class Worker():
         line = linecache.getline(filename, lineno, f.f_globals)
         return 'EXCEPTION IN {}, \nLINE {} "{}" \nERROR MESSAGE: {}'.format(filename, lineno, line.strip(), exc_obj)
 
+
+# Wall pixels whose smoothed squared DSM gradient (the trace of the structure tensor) is no more than this
+# have no orientation in the gradient method
+WALL_ORIENTATION_TOLERANCE = 1e-9
+
+
+# Standard deviations out to which the gaussian smoothing of the gradient method is worked out (scipy's default)
+GRADIENT_SMOOTHING_TRUNCATE = 4.0
+
+
+# Number of wall pixels processed together by the batched wall aspect calculation
+# (memory use is roughly 180 x 8 bytes per pixel for the filter responses)
+WALL_PIXEL_BLOCK_SIZE = 20000
+
+
+# Size of the line filter used to find wall directions, and the size of its two halves
+# The filter size is always odd
+def calculateFilterSize(scale):
+    filtersize = np.floor((scale + 0.0000000001) * 9)
+    if filtersize <= 2:
+        filtersize = 3
+    else:
+        if filtersize != 9:
+            if filtersize % 2 == 0:
+                filtersize = filtersize + 1
+
+    filthalveceil = int(np.ceil(filtersize / 2.))
+    filthalvefloor = int(np.floor(filtersize / 2.))
+    return int(filtersize), filthalveceil, filthalvefloor
+
+
+# Standard deviation (pixels) of the gaussian smoothing of the gradient method, covering roughly the same
+# window as the line filter
+def gradientSmoothingSigma(scale):
+    filtersize, filthalveceil, filthalvefloor = calculateFilterSize(scale)
+    return filthalvefloor / 3.
+
+
+# Number of pixels out from a wall pixel that its aspect depends on in the gradient method: the sobel filter
+# (one pixel), then the gaussian smoothing (its radius as worked out by scipy). The slope aspect of the pixels
+# with no orientation only reaches one pixel.
+def gradientReach(scale):
+    return 1 + int(GRADIENT_SMOOTHING_TRUNCATE * gradientSmoothingSigma(scale) + 0.5)
+
+
+# Returns a list of (index, filtmatrix1, filtmatrixbuild) for each of the 180 filter rotations
+# index is the wall direction in degrees that the rotation represents
+def rotatedFilters(filtersize, filthalveceil, filthalvefloor):
+    filtmatrix = np.zeros((int(filtersize), int(filtersize)))
+    buildfilt = np.zeros((int(filtersize), int(filtersize)))
+
+    filtmatrix[:, filthalveceil - 1] = 1
+    buildfilt[filthalveceil - 1, 0:filthalvefloor] = 1
+    buildfilt[filthalveceil - 1, filthalveceil: int(filtersize)] = 2
+
+    filters = []
+    for h in range(0, 180):  # =0:1:180 #%increased resolution to 1 deg 20140911
+        filtmatrix1temp = sc.rotate(filtmatrix, h, order=1, reshape=False, mode='nearest')  # bilinear
+        filtmatrix1 = np.round(filtmatrix1temp)
+        filtmatrixbuildtemp = sc.rotate(buildfilt, h, order=0, reshape=False, mode='nearest')  # Nearest neighbor
+        filtmatrixbuild = np.round(filtmatrixbuildtemp)
+        index = 270-h
+        if h == 150:
+            filtmatrixbuild[:, filtmatrix.shape[0] - 1] = 0
+        if h == 30:
+            filtmatrixbuild[:, filtmatrix.shape[0] - 1] = 0
+        if index == 225:
+            n = filtmatrix.shape[0] - 1
+            filtmatrix1[0, 0] = 1
+            filtmatrix1[n, n] = 1
+        if index == 135:
+            n = filtmatrix.shape[0] - 1
+            filtmatrix1[0, n] = 1
+            filtmatrix1[n, 0] = 1
+        filters.append((index, filtmatrix1, filtmatrixbuild))
+    return filters
+
+
+# Converts the best filter direction and building side of each wall pixel into the final wall aspect
+def finaliseWallDirections(y, x, walls, a, scale):
+    y[(x == 1)] = y[(x == 1)] - 180
+    y[(y < 0)] = y[(y < 0)] + 360
+
+    grad, asp = get_ders(a, scale)
+
+    y = y + ((walls == 1) * 1) * ((y == 0) * 1) * (asp / (math.pi / 180.))
+
+    dirwalls = y
+
+    return dirwalls
+
+
+# Accuracy of one wall aspect raster against another (normally the gradient method against the filter method)
+# over the wall pixels. Differences are measured around the circle, in degrees.
+def compareWallAspects(referenceDirwalls, dirwalls, walls):
+    wallPixels = walls > 0
+    difference = np.abs((dirwalls[wallPixels] - referenceDirwalls[wallPixels] + 180) % 360 - 180)
+    if difference.size == 0:
+        return {'wallPixels': 0, 'meanDifference': 0., 'medianDifference': 0., 'percentile90Difference': 0.,
+                'within5Degrees': 1., 'within15Degrees': 1., 'within45Degrees': 1.}
+    return {
+        'wallPixels': int(difference.size),
+        'meanDifference': float(difference.mean()),
+        'medianDifference': float(np.median(difference)),
+        'percentile90Difference': float(np.percentile(difference, 90)),
+        'within5Degrees': float(np.mean(difference <= 5)),
+        'within15Degrees': float(np.mean(difference <= 15)),
+        'within45Degrees': float(np.mean(difference <= 45))}
@@ -0,0 +1,84 @@
+"""
+Helpers for the on-disk caches of intermediate results
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import hashlib
+import os
+from pathlib import Path # Post python 3.4
+import numpy as np
+
+DIGEST_LENGTH = 20 # characters of the sha1 hex digest used in cache file names
+FILE_READ_BLOCK_SIZE = 1024 * 1024
+
+
+# Content hash of any mixture of numpy arrays and simple values (numbers, strings, tuples).
+# Arrays are hashed by shape, type and contents.
+def arrayDigest(*items):
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            digest.update(str(item.shape).encode())
+            digest.update(item.dtype.str.encode())
+            digest.update(np.ascontiguousarray(item).tobytes())
+        else:
+            digest.update(repr(item).encode())
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+# Content hash of a file
+def fileDigest(filePath):
+    digest = hashlib.sha1()
+    with open(str(filePath), 'rb') as inputFile:
+        block = inputFile.read(FILE_READ_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = inputFile.read(FILE_READ_BLOCK_SIZE)
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+# Marks a cache file as recently used, so that limitDirectoryUsage deletes it last
+def markFileUsed(filePath):
+    try:
+        os.utime(str(filePath))
+    except OSError:
+        pass # e.g. deleted by another run
+
+
+# Deletes the least recently used (oldest modified) files of a directory matching a glob pattern until they take up
+# no more than maxBytes. Partly written files (.partial) and the file to keep, if given, are left alone.
+def limitDirectoryUsage(directory, pattern, maxBytes, keep=None):
+    files = []
+    for filePath in Path(directory).glob(pattern):
+        if '.partial.' in filePath.name or filePath == keep:
+            continue
+        try:
+            status = filePath.stat()
+        except OSError:
+            continue
+        files.append((status.st_mtime, status.st_size, filePath))
+    bytesUsed = sum(size for modified, size, filePath in files)
+    if keep is not None and Path(keep).exists():
+        bytesUsed += Path(keep).stat().st_size
+    for modified, size, filePath in sorted(files):
+        if bytesUsed <= maxBytes:
+            break
+        try:
+            os.remove(str(filePath))
+            bytesUsed -= size
+        except OSError:
+            pass # e.g. in use by another run
@@ -31,37 +31,196 @@ from scipy.ndimage import zoom
 
 from UMEP.Utilities import shadowingfunctions as shadow
 from UMEP.Utilities.misc import *
-from UMEP.Utilities.SEBESOLWEIGCommonFiles import sun_position as sp
 from UMEP.Utilities.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import shadowingfunction_wallheight_23
 from qgis.core import *
 from .SolarConstants  import *
+from .solar_exception import SolarException
+from .solar_ephemeris import sunPositionsAt, utcTimestamps
+from .point_shadows import sunlitAtPoints
+from .shadow_kernels import compositeWideAreaWindow
+from .timestep_pool import parallelShadingFromSunPositions
+
+# Finest time interval (minutes) of adaptive sampling
+ADAPTIVE_FINE_INTERVAL = 5
 
 
 def dailyshading(clippedHighResArray, lowResWideArray, lonlat, scale, scaleWide, 
             wideExtent, localExtent, 
-            tv, UTC, timeInterval, onetime, dlg, dst, useWideArea):
+            tv, UTC, timeInterval, onetime, dlg, dst, useWideArea, localShadowCaster=None, wideShadowCaster=None, sampling=None, timestepCube=None):
     """
     Calculates solar shading based on landscape 3D profile and obstruction height/location
     We have two arrays - a high resolution "local" array that is our area of interest for calculating roof slopes,
     and a low resolution "wide area" array that is the area for which we are interested in "mountain shadows", and has been scaled down from a high res one.
     The absolute positions of these arrays in geographical coordinates are held in wideExtent and localExtent
-
-    
+    localShadowCaster and wideShadowCaster optionally replace UMEP's shadow casting for the two arrays:
+    functions of (azimuth, altitude) returning the shadow raster, e.g. from a SunShadowCache or HorizonAngles
+    sampling optionally gives the AdaptiveSampling settings, to sample the day adaptively rather than every timeInterval
+    timestepCube optionally gives a created TimestepShadowCube (with a step per sun position) to keep the shadow of every time step in
     """
     # First log the arguments:
     if(isDebug()):
         log(str(locals()))
-    # scaleFactor is the zoom factor between the low resolution and full resolution rasters
-    # We make the assumption that the both rasters are at the same longitude and latitude
+    altitudes, azimuths = sunPositions(lonlat, tv, UTC, sampledInterval(timeInterval, onetime, sampling), onetime, dst)
+    return shadingForDay(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                         altitudes, azimuths, timeInterval, onetime, dlg, useWideArea, localShadowCaster, wideShadowCaster, sampling, timestepCube)
+
+
+def seasonalShading(clippedHighResArray, lowResWideArray, lonlat, scale, scaleWide, 
+            wideExtent, localExtent, 
+            dates, UTC, timeInterval, onetime, dlg, useWideArea, feedback=None, localShadowCaster=None, wideShadowCaster=None, sampling=None,
+            timestepCubes=None):
+    """
+    As dailyshading, but for several days at once with the arrays set up only once.
+    The sun positions of every day are calculated first, then the shadows of each day.
+
+    Attributes
+    ----------
+        dates : list
+            (year, month, day, dst) for each day, dst being 1 in daylight savings time and 0 otherwise
+        feedback : QgsProcessingFeedback
+            optional - progress is reported as each day finishes (from 0 to 80%), and the calculation stops if cancelled
+        localShadowCaster, wideShadowCaster : function
+            optional - as for dailyshading; with a SunShadowCache behind them, a sun position seen on an earlier day isn't cast again
+        sampling : AdaptiveSampling
+            optional - as for dailyshading
+        timestepCubes : list
+            optional - a created TimestepShadowCube per date, as the timestepCube of dailyshading
+    Returns
+    -------
+        list of shadow result dictionaries, one per date, as returned by dailyshading
+    """
+    scheduledSunPositions = [sunPositions(lonlat, [year, month, day, 0, 0, 0], UTC, sampledInterval(timeInterval, onetime, sampling), onetime, dst)
+                             for year, month, day, dst in dates]
+
+    shadowResults = []
+    for dateIndex, (altitudes, azimuths) in enumerate(scheduledSunPositions):
+        if feedback is not None and feedback.isCanceled():
+            break
+        shadowResults.append(shadingForDay(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                           altitudes, azimuths, timeInterval, onetime, dlg, useWideArea, localShadowCaster, wideShadowCaster, sampling,
+                                           None if timestepCubes is None else timestepCubes[dateIndex]))
+        if feedback is not None:
+            feedback.setProgress(int(80 * (dateIndex + 1) / len(dates)))
+    return shadowResults
+
+
+def parallelSeasonalShading(clippedHighResArray, lowResWideArray, lonlat, scale, scaleWide,
+            wideExtent, localExtent,
+            dates, UTC, timeInterval, onetime, useWideArea, castFunction, lowSun=None, workers=None, feedback=None, wideShadowCaster=None):
+    """
+    As seasonalShading, but with the time steps of all the days shared out between worker processes
+    (see parallelShadingFromSunPositions), each casting shadows on the same shared copy of the DSMs.
+
+    Attributes
+    ----------
+        castFunction : function
+            a module level function of (array, scale, azimuth, altitude) casting a shadow in the worker processes,
+            e.g. umepShadow or lineSweepCast from timestep_pool
+        lowSun : tuple
+            optional - (altitude, factor) to cast the local shadows of a lower sun on a coarser DSM
+        workers : int
+            number of worker processes (0 or None = one per CPU core)
+        wideShadowCaster : function
+            optional - a picklable function of (azimuth, altitude) giving the wide area shadow, used by the workers
+            instead of casting it with castFunction (e.g. FarFieldHorizon.shadow)
+    Returns
+    -------
+        list of shadow result dictionaries, one per date, as returned by dailyshading (empty if cancelled)
+    """
+    scheduledSunPositions = [sunPositions(lonlat, [year, month, day, 0, 0, 0], UTC, timeInterval, onetime, dst)
+                             for year, month, day, dst in dates]
+    windowIndices = wideAreaWindowIndices(lowResWideArray.shape, wideExtent, localExtent) if useWideArea else None
+    return parallelShadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, windowIndices, scheduledSunPositions,
+                                           useWideArea, castFunction, lowSun, workers, feedback, wideShadowCaster)
+
+
+def pointSeasonalShading(clippedHighResArray, lowResWideArray, lonlat, scale, scaleWide,
+            wideExtent, localExtent, rows, columns,
+            dates, UTC, timeInterval, onetime, dlg, useWideArea, feedback=None, wideShadowCaster=None):
+    """
+    As seasonalShading, but only at sample points (e.g. on roofs), each marched towards the sun through the local DSM
+    by sunlitAtPoints - the rays of all the points and all the time steps of a day together. The wide area shadow is
+    cast as usual and picked out at the points.
+
+    Attributes
+    ----------
+        rows, columns : Numpy Arrays
+            positions of the points in pixels of the local DSM (pixel i covers i to i + 1)
+    Returns
+    -------
+        list of arrays of the fraction of the day each point is sunlit (as shfinal), one per date
+    """
+    if(useWideArea):
+        # The low res pixel under each point
+        rowIndices, columnIndices = wideAreaWindowIndices(lowResWideArray.shape, wideExtent, localExtent)
+        pointRows, pointColumns = rowIndices[rows.astype(np.int64)], columnIndices[columns.astype(np.int64)]
+
+    shadowResults = []
+    for dateIndex, (year, month, day, dst) in enumerate(dates):
+        if feedback is not None and feedback.isCanceled():
+            break
+        alt, azi = sunPositions(lonlat, [year, month, day, 0, 0, 0], UTC, timeInterval, onetime, dst)
+        sunUp = np.flatnonzero(alt > 0)
+        sunlit = sunlitAtPoints(clippedHighResArray, scale, rows, columns, azi[sunUp], alt[sunUp])
+        if(useWideArea):
+            for step, i in enumerate(sunUp):
+                shLowResWideArea = castShadow(lowResWideArray, azi[i], alt[i], scaleWide, dlg, wideShadowCaster)
+                sunlit[step] &= shLowResWideArea[pointRows, pointColumns] > 0.5
+        shadowResults.append(sunlit.mean(axis=0))
+        if feedback is not None:
+            feedback.setProgress(int(80 * (dateIndex + 1) / len(dates)))
+    return shadowResults
+
+
+# Sun altitudes and azimuths (in degrees) at each step through the day given in tv,
+# all calculated at once from the cached ephemeris
+def sunPositions(lonlat, tv, UTC, timeInterval, onetime, dst):
     lon = lonlat[0]
     lat = lonlat[1]
     year = tv[0]
     month = tv[1]
     day = tv[2]
 
-    alt = np.median(clippedHighResArray)
-    location = {'longitude': lon, 'latitude': lat, 'altitude': alt}
+    if onetime == 1:
+        minutes = np.array([tv[3] * 60 + tv[4]])
+    else:
+        itera = int(1440 / timeInterval)  # number of iterations in 24 hours (timeInterval is in minutes)
+        minutes = (timeInterval * np.arange(itera)).astype(int) # minutes after midnight of each step
 
+    # Local clock time is an hour ahead of standard time in daylight savings time
+    timestamps = utcTimestamps(year, day_of_year(year, month, day), minutes // 60 - dst, minutes % 60, UTC)
+    azi, alt = sunPositionsAt(timestamps, lon, lat)
+    if(isDebug()):
+        for i in range(len(timestamps)):
+            log("Alt = " + str(alt[i]) + " Azi = " + str(azi[i]) + " UTC time: " + str(timestamps[i]))
+    return alt, azi
+
+
+# Time interval (minutes) between the sun positions of a day - the fine interval if sampling adaptively
+def sampledInterval(timeInterval, onetime, sampling):
+    if sampling is None or onetime == 1:
+        return timeInterval
+    return sampling.fineInterval
+
+
+# Average shadows of a day from its sun positions (as given by sampledInterval), at a fixed or adaptive interval
+def shadingForDay(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                  alt, azi, timeInterval, onetime, dlg, useWideArea, localShadowCaster=None, wideShadowCaster=None, sampling=None, timestepCube=None):
+    if sampling is None or onetime == 1:
+        return shadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                       alt, azi, dlg, useWideArea, localShadowCaster, wideShadowCaster, timestepCube=timestepCube)
+    coarseSteps = max(1, int(round(timeInterval / sampling.fineInterval)))
+    return adaptiveShadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                           alt, azi, coarseSteps, sampling, dlg, useWideArea, localShadowCaster, wideShadowCaster, timestepCube)
+
+
+# Averages the shadow rasters over the sun positions that are above the horizon.
+# weights optionally gives each step's share of the average (steps with 0 weight are skipped), and
+# shadowsAt optionally gives the shadows of a step by its index (as StepShadows does), and
+# timestepCube optionally a TimestepShadowCube to keep the (combined) shadow of each step in
+def shadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                            alt, azi, dlg, useWideArea, localShadowCaster=None, wideShadowCaster=None, weights=None, shadowsAt=None,
+                            timestepCube=None):
     shwidefinal = 0
    
     # We will calculate three averages and return these as the result of this function,
@@ -73,87 +232,28 @@ def dailyshading(clippedHighResArray, lowResWideArray, lonlat, scale, scaleWide,
     if(useWideArea):
         shtotWideArea = np.zeros((lowResWideArray.shape[0], lowResWideArray.shape[1])) # average of the low resolution wide area rasters only
 
-    clippedHighResWideAreaArray, highResWideZoomedArray = 0, 0 # only used in the case of a wide area shadow calculation
+    clippedHighResWideAreaArray, highResWideZoomedArray = 0, 0 # only used in the case of a wide area shadow calculation (the zoomed array is no longer made)
+    if shadowsAt is None:
+        # Each step is only needed once, so work them out as we go rather than keeping them
+        shadowsAt = stepShadowsFor(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                   alt, azi, dlg, useWideArea, localShadowCaster, wideShadowCaster).shadowsAt
 
-    if onetime == 1:
-        itera = 1
-    else:
-        itera = int(1440 / timeInterval)  # number of iterations in 24 hours (timeInterval is in minutes)
-
-    alt = np.zeros(itera)
-    azi = np.zeros(itera)
-    hour = int(0)
     index = 0
-    time = dict()
-    time['UTC'] = UTC
-
-
-    for i in range(0, itera):  # calculate raster for each step in the interval (e.g. for hourly this is 24 steps in the day)
-        year, month, day, hour, minu, ut_time = createTimeParameters(tv, timeInterval, onetime, dst, year, month, day, i)
-
-        HHMMSS = dectime_to_timevec(ut_time)
-
-        createTimeDict(year, month, day, time, HHMMSS)
 
-        sun = sp.sun_position(time, location)
-        alt[i] = 90. - sun['zenith']
-        azi[i] = sun['azimuth']
-        if(isDebug):
-            log("Alt = " + str(alt[i]) + " Azi = " + str(azi[i]) + " Hour: " + str(hour) + " Min: " + str(minu) + " Sec: " + str(HHMMSS[2]) + " Day: " + str(day) + " Month: " + str(month) + " Year: " + str(year))
-
-        # time_vector = dt.datetime(year, month, day, HHMMSS[0], HHMMSS[1], HHMMSS[2])
-
-        if alt[i] > 0: # if the sun is above the horizon?
-            if(isDebug):
-                log("starting local shadow calculation")
-            sh = shadow.shadowingfunctionglobalradiation(clippedHighResArray, azi[i], alt[i], scale, dlg, 0) # calculate shadow raster for this time of day
-            if(isDebug):
-                log("Finished Local Calculation")
-            shtotLocalOnly = shtotLocalOnly + sh # total up shadow rasters
-            index += 1 # keep track of how many for averages
+    for i in range(0, len(alt)):  # calculate raster for each step in the interval (e.g. for hourly this is 24 steps in the day)
+        weight = 1 if weights is None else weights[i]
+        if alt[i] > 0 and weight > 0: # if the sun is above the horizon?
+            sh, combinedRaster, shLowResWideArea, clippedHighResWideAreaArray = shadowsAt(i)
+            if timestepCube is not None:
+                timestepCube.writeStep(i, combinedRaster)
+            shtotLocalOnly = shtotLocalOnly + weight * sh # total up shadow rasters
+            index += weight # keep track of how many for averages
             if(useWideArea):
-                # Calculate the low resolution wide area shadow raster
-                shLowResWideArea = shadow.shadowingfunctionglobalradiation(lowResWideArray, azi[i], alt[i], scaleWide, dlg, 0) # calculate shadow raster for this time of day
-                
-                if(isDebug):
-                    log("Finished Wide Calculation")
-
-                # We now have a large (low resolution) raster and a smaller high resolution one, both representing the wide area
-                # First task is to "zoom" up the low res one to a higher one of full size (this is still the "wide" array)
-                zoomHorizontalFactor = wideExtent.width / shLowResWideArea.shape[1]
-                zoomVerticalFactor = wideExtent.height / shLowResWideArea.shape[0]
-                highResWideZoomedArray = zoomResolutionArray(shLowResWideArea, zoomHorizontalFactor, zoomVerticalFactor)
-
-                if(isDebug):
-                    log(f"highResWideZoomedArray size horizontal: {highResWideZoomedArray.shape[1]}, size vertical: {highResWideZoomedArray.shape[0]}")
-
-                # Now we need to clip this wide area shadow raster to the local region 
-                # We can use numpy's array[x:y,a:b] to select a region
-                
-                
-                xmin=localExtent.xmin-wideExtent.xmin
-                xmax=localExtent.xmax-wideExtent.xmin
-                ymin=wideExtent.ymax-localExtent.ymax
-                ymax=wideExtent.ymax-localExtent.ymin
-                
-                if(isDebug):
-                    log(f"xmin={xmin}, xmax={xmax}, ymin={ymin}, ymax={ymax}")
-
-                # Note that x and y are reversed in numpy when it comes to accessing elements:
-                clippedHighResWideAreaArray = highResWideZoomedArray[ymin:ymax, xmin:xmax]
-                if(isDebug):    
-                    log(f"Combining Rasters. sh size: {sh.shape[0]}, {sh.shape[1]}. clippedHighResWideAreaArray size: {clippedHighResWideAreaArray.shape[0]}, {clippedHighResWideAreaArray.shape[1]}")
-
-                combinedRaster = sh * clippedHighResWideAreaArray * 1
-
-                if(isDebug):
-                    log(f"Finished combining rasters, result size: {combinedRaster.shape[0]}, {combinedRaster.shape[1]}")
-               
-                shtotWideArea=shtotWideArea + shLowResWideArea
-                shtot=shtot+combinedRaster
-                shtotLocalOnly=shtotLocalOnly+sh
+                shtotWideArea=shtotWideArea + weight * shLowResWideArea
+                shtot=shtot + weight * combinedRaster
+                shtotLocalOnly=shtotLocalOnly + weight * sh
             else:
-                shtot=shtot+sh
+                shtot=shtot + weight * sh
 
     shfinal = shtot / index # find average of all the shadow rasters added up
     shlocalfinal = shtotLocalOnly / index # find average of all the local shadow rasters added up (not affected by wide area arrays)
@@ -163,38 +263,216 @@ def dailyshading(clippedHighResArray, lowResWideArray, lonlat, scale, scaleWide,
     
     return shadowresult
 
+
+class StepShadows(dict):
+    """
+    The shadows of the time steps of a day, by step index, worked out the first time each is asked for:
+    (local shadow, shadow including the wide area, low res wide area shadow, wide area shadow over the local region).
+    Without a wide area, the last two are 0 and the first two are the same array. The wide area shadow over
+    the local region is a buffer shared by all the steps, so only holds that of the latest step worked out.
+    The shadows are all 1 or 0, so the full resolution ones are kept as booleans to save memory.
+    """
+
+    def __init__(self, shadowsAt):
+        super().__init__()
+        self.shadowsAt = shadowsAt
+
+    def __missing__(self, i):
+        sh, combinedRaster, shLowResWideArea, clippedHighResWideAreaArray = self.shadowsAt(i)
+        combinedRaster = combinedRaster.astype(bool) if combinedRaster is not sh else None
+        sh = sh.astype(bool)
+        self[i] = sh, sh if combinedRaster is None else combinedRaster, shLowResWideArea, clippedHighResWideAreaArray
+        return self[i]
+
+    # The shadows of a step, without keeping them if they haven't been worked out already
+    def lookup(self, i):
+        return self[i] if i in self else self.shadowsAt(i)
+
+
+# The StepShadows of a day's sun positions
+def stepShadowsFor(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                   alt, azi, dlg, useWideArea, localShadowCaster=None, wideShadowCaster=None):
+    if(useWideArea):
+        # The low res pixels that make up each row and column of the local region, worked out once for all time steps
+        rowIndices, columnIndices = wideAreaWindowIndices(lowResWideArray.shape, wideExtent, localExtent)
+    windowBuffer = None # reused by every time step
+
+    def shadowsAt(i):
+        nonlocal windowBuffer
+        if isDebug():
+            log("starting local shadow calculation")
+        sh = castShadow(clippedHighResArray, azi[i], alt[i], scale, dlg, localShadowCaster) # calculate shadow raster for this time of day
+        if isDebug():
+            log("Finished Local Calculation")
+        if not useWideArea:
+            return sh, sh, 0, 0
+
+        # Calculate the low resolution wide area shadow raster
+        shLowResWideArea = castShadow(lowResWideArray, azi[i], alt[i], scaleWide, dlg, wideShadowCaster) # calculate shadow raster for this time of day
+        
+        if isDebug():
+            log("Finished Wide Calculation")
+
+        # We now have a large (low resolution) raster and a smaller high resolution one, both representing the wide area
+        # Only the part of the wide area raster over the local region is needed at high resolution, so rather than
+        # "zooming" up the whole low res raster and clipping it, the local window is picked straight out of the low res one
+        windowBuffer = compositeWideAreaWindow(shLowResWideArea, rowIndices, columnIndices, windowBuffer)
+        clippedHighResWideAreaArray = windowBuffer
+        if isDebug():
+            log(f"Combining Rasters. sh size: {sh.shape[0]}, {sh.shape[1]}. clippedHighResWideAreaArray size: {clippedHighResWideAreaArray.shape[0]}, {clippedHighResWideAreaArray.shape[1]}")
+
+        combinedRaster = sh * clippedHighResWideAreaArray * 1
+
+        if isDebug():
+            log(f"Finished combining rasters, result size: {combinedRaster.shape[0]}, {combinedRaster.shape[1]}")
+        return sh, combinedRaster, shLowResWideArea, clippedHighResWideAreaArray
+
+    return StepShadows(shadowsAt)
+
+
+class AdaptiveSampling():
+    """
+    Settings for sampling a day's shadows adaptively rather than at a fixed interval. The day is first sampled at
+    the usual time interval; wherever the fraction of pixels whose shadow differs between neighbouring samples, times
+    the time between them (in usual time intervals), is more than tolerance, the interval between them is halved,
+    down to fineInterval. The shadows of the fine time steps in between are interpolated linearly from the samples
+    either side, so the result estimates the average over every fine time step - shadows barely move around noon,
+    so most of the casting is spent near sunrise and sunset.
+
+    Attributes
+    ----------
+        tolerance : float
+            fraction of pixels whose shadow may change between neighbouring samples a usual time interval apart
+        fineInterval : int
+            the finest time interval in minutes (a divisor of the usual interval)
+        validate : boolean
+            also work out the average over every fine time step, and report the difference
+    """
+
+    def __init__(self, tolerance, fineInterval=ADAPTIVE_FINE_INTERVAL, validate=False):
+        self.tolerance = tolerance
+        self.fineInterval = fineInterval
+        self.validate = validate
+
+
+# Average shadows of a day sampled adaptively - alt and azi are the sun positions every sampling.fineInterval
+# minutes, coarseSteps the number of these in the usual time interval. Adds the number of samples ('samples'),
+# the number of fine steps with the sun up ('fineSteps'), and if validating, the maximum and mean difference of
+# shfinal from its value over every fine step ('fineDifference'), to the usual result.
+# Each fine step not sampled takes the shadow of the nearest sample in the timestepCube, if there is one.
+def adaptiveShadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                    alt, azi, coarseSteps, sampling, dlg, useWideArea, localShadowCaster=None, wideShadowCaster=None,
+                                    timestepCube=None):
+    stepShadows = stepShadowsFor(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                 alt, azi, dlg, useWideArea, localShadowCaster, wideShadowCaster)
+    weights = adaptiveSampleWeights(alt, coarseSteps, sampling.tolerance, stepShadows)
+    shadowresult = shadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                           alt, azi, dlg, useWideArea, weights=weights, shadowsAt=stepShadows.__getitem__)
+    shadowresult['samples'] = int(np.count_nonzero(weights))
+    if timestepCube is not None:
+        writeNearestSamples(timestepCube, alt, weights, stepShadows)
+    shadowresult['fineSteps'] = int(np.count_nonzero(alt > 0))
+    msg = f"Adaptive sampling: {shadowresult['samples']} shadows cast for {shadowresult['fineSteps']} time steps of {sampling.fineInterval} minutes"
+
+    if sampling.validate:
+        fineResult = shadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, wideExtent, localExtent,
+                                             alt, azi, dlg, useWideArea, shadowsAt=stepShadows.lookup)
+        difference = np.abs(shadowresult['shfinal'] - fineResult['shfinal'])
+        shadowresult['fineDifference'] = (float(difference.max()), float(difference.mean()))
+        msg += f", difference from every time step: maximum {difference.max():.4f}, mean {difference.mean():.5f}"
+    log(msg)
+    return shadowresult
+
+
+# Fills each sun up step of the cube with the shadow of the nearest sample (those with a weight), in time
+def writeNearestSamples(timestepCube, alt, weights, stepShadows):
+    sunUp = np.flatnonzero(alt > 0)
+    samples = np.flatnonzero(weights > 0)
+    if len(samples) == 0:
+        return
+    nearest = np.clip(np.searchsorted(samples, sunUp), 1, max(1, len(samples) - 1))
+    before = samples[nearest - 1]
+    after = samples[np.minimum(nearest, len(samples) - 1)]
+    for step, sample in zip(sunUp, np.where(sunUp - before <= after - sunUp, before, after)):
+        timestepCube.writeStep(step, stepShadows[sample][1])
+
+
+# The weight of each time step in an adaptively sampled day - the share of the sun up time steps for which each
+# sample stands (0 for those not sampled). Starts with every coarseSteps'th sun up step (and the last), then
+# halves the gap between neighbouring samples whose combined shadows differ at more than tolerance of the pixels
+# per coarseSteps - a measure of how much interpolating across the gap could be out.
+def adaptiveSampleWeights(alt, coarseSteps, tolerance, stepShadows):
+    weights = np.zeros(len(alt))
+    sunUp = np.flatnonzero(alt > 0)
+    if len(sunUp) == 0:
+        return weights
+
+    samples = list(range(0, len(sunUp), max(1, coarseSteps))) # positions in sunUp
+    if samples[-1] != len(sunUp) - 1:
+        samples.append(len(sunUp) - 1)
+    gaps = list(zip(samples[:-1], samples[1:]))
+    while gaps:
+        first, last = gaps.pop()
+        if last - first < 2:
+            continue
+        changed = np.count_nonzero(stepShadows[sunUp[first]][1] != stepShadows[sunUp[last]][1]) / stepShadows[sunUp[first]][1].size
+        if changed * (last - first) / coarseSteps > tolerance:
+            middle = (first + last) // 2
+            samples.append(middle)
+            gaps += [(first, middle), (middle, last)]
+
+    # Each sun up step between two samples is shared between them in proportion to how near it is to each -
+    # the same as interpolating each pixel's shadow linearly in time between the samples
+    samples = np.array(sorted(samples))
+    if len(samples) == 1:
+        weights[sunUp[samples]] = 1
+        return weights
+    positions = np.arange(len(sunUp))
+    gap = np.minimum(np.searchsorted(samples, positions, side='right') - 1, len(samples) - 2)
+    fraction = (positions - samples[gap]) / (samples[gap + 1] - samples[gap])
+    sampleWeights = np.zeros(len(samples))
+    np.add.at(sampleWeights, gap, 1 - fraction)
+    np.add.at(sampleWeights, gap + 1, fraction)
+    weights[sunUp[samples]] = sampleWeights
+    return weights
+
+
+# Shadow raster for one sun position, from the shadow caster if there is one
+def castShadow(array, azimuth, altitude, scale, dlg, shadowCaster=None):
+    if shadowCaster is None:
+        return shadow.shadowingfunctionglobalradiation(array, azimuth, altitude, scale, dlg, 0)
+    return shadowCaster(azimuth, altitude)
+
+# Indices of the low resolution wide area pixels making up each row and column of the local region
+# after "zooming" the wide area to full resolution with zoomResolutionArray - so that the pixels picked
+# out, with the same sub-pixel offset, are the ones zoomResolutionArray followed by clipping would give.
+# That holds everywhere except the last row or column of the zoomed wide area: in a few percent of shapes zoom maps
+# it just outside the low resolution raster, where the 2-D zoom gives 0 (shadow) but the index zoom gives no pixel
+# (-1). The local area has to stay off that far edge - wide areas buffered around it always do - so it is checked.
+def wideAreaWindowIndices(lowResShape, wideExtent, localExtent):
+    zoomHorizontalFactor = wideExtent.width / lowResShape[1]
+    zoomVerticalFactor = wideExtent.height / lowResShape[0]
+    # Nearest neighbour zooming maps each axis separately, so the mapping can be found by zooming the indices themselves
+    rowMapping = zoom(np.arange(lowResShape[0], dtype=float), zoomVerticalFactor, order=0, cval=-1).astype(np.intp)
+    columnMapping = zoom(np.arange(lowResShape[1], dtype=float), zoomHorizontalFactor, order=0, cval=-1).astype(np.intp)
+
+    xmin=localExtent.xmin-wideExtent.xmin
+    xmax=localExtent.xmax-wideExtent.xmin
+    ymin=wideExtent.ymax-localExtent.ymax
+    ymax=wideExtent.ymax-localExtent.ymin
+    if(isDebug()):
+        log(f"xmin={xmin}, xmax={xmax}, ymin={ymin}, ymax={ymax}")
+    # Note that x and y are reversed in numpy when it comes to accessing elements:
+    rowIndices, columnIndices = rowMapping[ymin:ymax], columnMapping[xmin:xmax]
+    if (rowIndices < 0).any() or (columnIndices < 0).any():
+        raise SolarException("Value error", "The local area reaches the far edge of the wide area - use a larger wide area")
+    return rowIndices, columnIndices
+
 def zoomResolutionArray(array, zoomHorizontalFactor, zoomVerticalFactor):
     # order is 3 for cubic, 1 for bilinear, 0 for nearest neighbour
     highResWideAreaArray = zoom(array, [zoomVerticalFactor, zoomHorizontalFactor], order=0) # nearest neighbour makes sense with 1s and 0s
     return highResWideAreaArray
 
-def createTimeDict(year, month, day, time, HHMMSS):
-    time['year'] = year
-    time['month'] = month
-    time['day'] = day
-    time['hour'] = HHMMSS[0]
-    time['min'] = HHMMSS[1]
-    time['sec'] = HHMMSS[2]
-
-def createTimeParameters(tv, timeInterval, onetime, dst, year, month, day, i):
-    if onetime == 0:
-        minu = int(timeInterval * i)
-        # number of minutes after midnight in this stepif minu >= 60: # convert to hours and minutes
-        hour = int(np.floor(minu / 60))
-        minu = int(minu - hour * 60)
-    else:
-        minu = tv[4]
-        hour = tv[3]
-    doy = day_of_year(year, month, day)
-    ut_time = doy - 1. + ((hour - dst) / 24.0) + (minu / (60. * 24.0)) + (0. / (60. * 60. * 24.0))
-    if ut_time < 0:
-        year = year - 1
-        month = 12
-        day = 31
-        doy = day_of_year(year, month, day)
-        ut_time = ut_time + doy - 1
-    return year,month,day,hour,minu,ut_time
-
 def day_of_year(yy, month, day):
     if (yy % 4) == 0:
         if (yy % 100) == 0:
@@ -216,19 +494,3 @@ def day_of_year(yy, month, day):
 
     return doy
 
-
-def dectime_to_timevec(dectime):
-    # This subroutine converts dectime to individual hours, minutes and seconds
-
-    doy = np.floor(dectime)
-
-    DH = dectime-doy
-    HOURS = int(24 * DH)
-
-    DM=24*DH - HOURS
-    MINS=int(60 * DM)
-
-    DS = 60 * DM - MINS
-    SECS = int(60 * DS)
-
-    return (HOURS, MINS, SECS)
@@ -0,0 +1,126 @@
+"""
+The distant horizon of a local area, from a coarse wide area DEM, as a stand in for casting the wide area shadows
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from pathlib import Path # Post python 3.4
+import numpy as np
+from .cache_utils import arrayDigest
+
+# Default number of azimuth sectors of the far field horizon (every half degree)
+FAR_FIELD_SECTORS = 720
+# Distance between the samples along each sector's ray, in pixels of the wide area DEM
+FAR_FIELD_SAMPLE_SPACING = 0.5
+
+
+class FarFieldHorizon():
+    """
+    The elevation of the horizon formed by the terrain around a local area, seen from the centre of the local area
+    at the height of its highest point - the height the wide area shadows were cast onto when the local area was
+    merged into the wide area DEM as a flat raster of that height. Terrain inside the local area is left out; its
+    shadows are those of the local DSM.
+
+    The horizon is worked out once, along a ray in each azimuth sector through the wide area DEM. After that the
+    wide area shadow of a time step is a single comparison - the whole local area is in the wide area's shadow when
+    the sun is below the horizon - instead of a shadow cast over the whole wide area.
+
+    The extents are in map units (metres) as those of SolarConstants.Extent. If a cache directory is given the horizon
+    is saved there, named after a hash of the DEM, the extents and the height, so it is only worked out once.
+
+    Attributes
+    ----------
+        wideDem : Numpy Array
+            the coarse wide area DEM (heights in metres)
+        wideExtent : Extent
+            area covered by wideDem
+        localExtent : Extent
+            the local area
+        observerHeight : float
+            height (metres) the horizon is seen from
+        sectors : int
+            number of azimuth sectors, the first centred on north
+        cacheDirectory : Path
+            optional - where the horizon is saved
+    """
+
+    def __init__(self, wideDem, wideExtent, localExtent, observerHeight, sectors=FAR_FIELD_SECTORS, cacheDirectory=None):
+        self.wideBounds = (float(wideExtent.xmin), float(wideExtent.ymax), float(wideExtent.width), float(wideExtent.height))
+        self.localBounds = (float(localExtent.xmin), float(localExtent.ymin), float(localExtent.xmax), float(localExtent.ymax))
+        self.observerHeight = float(observerHeight)
+        self.sectors = int(sectors)
+        self.key = arrayDigest(wideDem, self.wideBounds, self.localBounds, self.observerHeight, self.sectors)
+        self.cacheDirectory = None if cacheDirectory is None else Path(cacheDirectory)
+        self.angles = self.load(wideDem)
+
+    def load(self, wideDem):
+        if self.cacheDirectory is None:
+            return self.calculate(wideDem)
+        filePath = self.cacheDirectory / f"far-field-horizon-{self.key}.npy"
+        if not filePath.exists():
+            self.cacheDirectory.mkdir(parents=True, exist_ok=True)
+            partialFilePath = self.cacheDirectory / f"far-field-horizon-{self.key}.partial.npy"
+            np.save(str(partialFilePath), self.calculate(wideDem))
+            os.replace(str(partialFilePath), str(filePath))
+        return np.load(str(filePath))
+
+    # The highest elevation (degrees) of the wide area DEM outside the local area along each sector's ray
+    def calculate(self, wideDem):
+        wideXmin, wideYmax, wideWidth, wideHeight = self.wideBounds
+        localXmin, localYmin, localXmax, localYmax = self.localBounds
+        pixelWidth = wideWidth / wideDem.shape[1]
+        pixelHeight = wideHeight / wideDem.shape[0]
+        centreX = (localXmin + localXmax) / 2
+        centreY = (localYmin + localYmax) / 2
+
+        spacing = FAR_FIELD_SAMPLE_SPACING * min(pixelWidth, pixelHeight)
+        distances = np.arange(1, int(np.hypot(wideWidth, wideHeight) / spacing) + 1) * spacing
+        angles = np.full(self.sectors, -90.)
+        for sector in range(self.sectors):
+            azimuth = np.radians(self.sectorAzimuth(sector))
+            x = centreX + distances * np.sin(azimuth)
+            y = centreY + distances * np.cos(azimuth)
+            columns = np.floor((x - wideXmin) / pixelWidth).astype(np.int64)
+            rows = np.floor((wideYmax - y) / pixelHeight).astype(np.int64)
+            outside = ~((localXmin <= x) & (x < localXmax) & (localYmin <= y) & (y < localYmax))
+            inWideArea = (rows >= 0) & (rows < wideDem.shape[0]) & (columns >= 0) & (columns < wideDem.shape[1])
+            sampled = np.flatnonzero(outside & inWideArea)
+            if len(sampled):
+                rises = wideDem[rows[sampled], columns[sampled]] - self.observerHeight
+                angles[sector] = np.degrees(np.arctan(rises / distances[sampled])).max()
+        return angles
+
+    def sectorAzimuth(self, sector):
+        return sector * 360. / self.sectors
+
+    def horizon(self, azimuth):
+        """
+        Horizon elevation (degrees) towards the given azimuth (degrees clockwise from north),
+        interpolated between the two nearest sectors
+        """
+        position = np.mod(azimuth, 360.) * self.sectors / 360.
+        below = int(np.floor(position)) % self.sectors
+        above = (below + 1) % self.sectors
+        weight = position - np.floor(position)
+        return (1 - weight) * self.angles[below] + weight * self.angles[above]
+
+    def shadow(self, azimuth, altitude):
+        """
+        The wide area shadow for one sun position as a single pixel covering the local area - 1 if sunlit, 0 in shadow -
+        so that it can stand in for the shadow cast on the wide area DEM (with the local extent as the wide extent)
+        """
+        return np.full((1, 1), float(altitude >= self.horizon(azimuth)))
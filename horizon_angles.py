@@ -0,0 +1,167 @@
+"""
+Per pixel horizon angles of a DSM, so that shadows can be looked up rather than cast
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from pathlib import Path # Post python 3.4
+import numpy as np
+from .cache_utils import arrayDigest
+from .shadow_kernels import sweepSteps
+
+# Default number of azimuth sectors (every 5 degrees)
+HORIZON_SECTORS = 72
+# Horizon angles are stored as whole hundredths of a degree (rounded up) in 16 bit integers
+HORIZON_ANGLE_UNITS = 100
+# The sweep of each sector stops once nothing further away could raise a horizon by more than this (degrees)
+HORIZON_ANGLE_RESOLUTION = 0.005
+
+
+class HorizonAngles():
+    """
+    The elevation of the horizon seen from each pixel of a DSM, in a number of equally spaced
+    azimuth sectors. A pixel is in shadow when the sun is below its horizon, so once these have
+    been worked out (a shadow casting sweep per sector) the shadow for any sun position is just
+    a comparison, and shadow fractions over many time steps cost little more than over a few.
+
+    A pixel is taken to be shaded by anything whose elevation seen from the pixel is above the sun,
+    as in UMEP's shadowingfunctionglobalradiation, so at the sector azimuths the shadows match those
+    of the shadow casting sweep (the angles are rounded up to the next 0.01 degree, so the only differences
+    are pixels shown in shadow when the sun is within 0.01 degrees of their horizon). In between, the
+    horizon is interpolated linearly between the two nearest sectors - with 72 sectors about 2% of pixels
+    differ from the shadow casting sweep, with 360 sectors about 0.4%.
+
+    The angles are kept in a (sectors, rows, columns) array of 16 bit integers - 144 bytes per
+    pixel with 72 sectors. If a cache directory is given this is a memory-mapped .npy file named
+    after a hash of the DSM, so it is only worked out once per DSM. Nothing is worked out until prepare().
+
+    Attributes
+    ----------
+        dsm : Numpy Array
+            the DSM (heights in metres)
+        scale : float
+            pixels per metre of the DSM
+        sectors : int
+            number of azimuth sectors, the first centred on north
+        cacheDirectory : Path
+            optional - where the angles are saved
+    """
+
+    def __init__(self, dsm, scale, sectors=HORIZON_SECTORS, cacheDirectory=None):
+        self.dsm = dsm
+        self.scale = scale
+        self.shape = dsm.shape
+        self.sectors = int(sectors)
+        self.key = arrayDigest(dsm, float(scale), self.sectors)
+        self.cacheDirectory = None if cacheDirectory is None else Path(cacheDirectory)
+        self.angles = None
+
+    def prepare(self, feedback=None):
+        """
+        Works out the horizon angles, or loads them from the cache directory, if not already done.
+        Returns False if cancelled by the feedback.
+        """
+        if self.angles is not None:
+            return True
+        if self.cacheDirectory is None:
+            angles = np.empty((self.sectors,) + self.shape, dtype=np.int16)
+            if self.calculate(self.dsm, self.scale, angles, feedback):
+                self.angles = angles
+            return self.isComplete()
+
+        filePath = self.cacheDirectory / f"horizon-angles-{self.key}.npy"
+        if not filePath.exists():
+            # Written to a temporary file first, so an interrupted calculation never leaves partial angles behind
+            self.cacheDirectory.mkdir(parents=True, exist_ok=True)
+            partialFilePath = self.cacheDirectory / f"horizon-angles-{self.key}.partial.npy"
+            angles = np.lib.format.open_memmap(str(partialFilePath), mode='w+', dtype=np.int16,
+                                               shape=(self.sectors,) + self.shape)
+            complete = self.calculate(self.dsm, self.scale, angles, feedback)
+            angles.flush()
+            del angles
+            if not complete:
+                os.remove(str(partialFilePath))
+                return False
+            os.replace(str(partialFilePath), str(filePath))
+        self.angles = np.load(str(filePath), mmap_mode='r')
+        return True
+
+    def isComplete(self):
+        return self.angles is not None
+
+    # Fills angles with the horizon of each sector. Returns False if cancelled.
+    def calculate(self, dsm, scale, angles, feedback=None):
+        relief = float(dsm.max() - dsm.min())
+        smallestTangent = np.tan(np.radians(HORIZON_ANGLE_RESOLUTION))
+        tangent = np.empty(self.shape)
+        for sector in range(self.sectors):
+            if feedback is not None and feedback.isCanceled():
+                return False
+            tangent.fill(0.) # a horizon below 0 degrees doesn't matter - the sun is down
+            for distance, source, target in sweepSteps(self.sectorAzimuth(sector), self.shape):
+                rise = dsm[source] - dsm[target]
+                np.fmax(tangent[target], rise * (scale / distance), out=tangent[target])
+                if relief * scale / distance < smallestTangent:
+                    break
+            angles[sector] = np.ceil(np.degrees(np.arctan(tangent)) * HORIZON_ANGLE_UNITS - 1e-6) # allowing for rounding error
+        return True
+
+    def sectorAzimuth(self, sector):
+        return sector * 360. / self.sectors
+
+    def horizon(self, azimuth):
+        """
+        Horizon elevation (degrees) of each pixel towards the given azimuth (degrees clockwise from north),
+        interpolated between the two nearest sectors
+        """
+        position = np.mod(azimuth, 360.) * self.sectors / 360.
+        below = int(np.floor(position)) % self.sectors
+        above = (below + 1) % self.sectors
+        weight = position - np.floor(position)
+        if weight == 0:
+            return self.angles[below] / HORIZON_ANGLE_UNITS
+        return ((1 - weight) * self.angles[below] + weight * self.angles[above]) / HORIZON_ANGLE_UNITS
+
+    def shadow(self, azimuth, altitude):
+        """
+        Shadow raster for one sun position - 1 where sunlit, 0 in shadow - as returned by
+        shadowingfunctionglobalradiation
+        """
+        return (altitude >= self.horizon(azimuth)).astype(float)
+
+    def sunlitFraction(self, azimuths, altitudes):
+        """
+        Fraction of the given sun positions (those above the horizon) at which each pixel is sunlit -
+        the average of the shadow rasters of all the positions
+        """
+        sunlit = np.zeros(self.shape)
+        count = 0
+        for azimuth, altitude in zip(azimuths, altitudes):
+            if altitude > 0:
+                sunlit += altitude >= self.horizon(azimuth)
+                count += 1
+        return sunlit / count if count else sunlit
+
+    def sunHours(self, azimuths, altitudes, timeInterval):
+        """
+        Hours of sun at each pixel over the given sun positions, each representing timeInterval minutes
+        """
+        sunlit = np.zeros(self.shape)
+        for azimuth, altitude in zip(azimuths, altitudes):
+            if altitude > 0:
+                sunlit += altitude >= self.horizon(azimuth)
+        return sunlit * timeInterval / 60.
@@ -0,0 +1,109 @@
+"""
+Casting the long shadows of a low sun on a coarser DSM
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import numpy as np
+
+# Default number of pixels (each way) of the DSM in a pixel of the coarse DSM
+LOW_SUN_FACTOR = 4
+# Width in degrees of the altitude bands the errors are reported in
+LOW_SUN_BAND_WIDTH = 2
+
+
+class LowSunCaster():
+    """
+    Shadow casting takes longer the lower the sun - the sweep goes on until the shadows are longer than the
+    highest point of the DSM - just when the shadows are longest and their detail matters least. Below a given
+    altitude, this casts the shadow on a coarser DSM (each pixel the highest of factor x factor pixels, so nothing
+    that casts a shadow is lost) and spreads each coarse pixel's shadow back over the pixels it covers.
+
+    describeDayErrors() reports how much the coarse shadows of each altitude band change a day's shadow fraction.
+
+    Attributes
+    ----------
+        dsm : Numpy Array
+            the DSM
+        scale : float
+            pixels per metre of the DSM
+        castFunction : function
+            casts a shadow, given (array, scale, azimuth, altitude)
+        altitude : float
+            shadows with the sun below this altitude (degrees) are cast on the coarse DSM
+        factor : int
+            pixels (each way) of the DSM in a pixel of the coarse DSM
+    """
+
+    def __init__(self, dsm, scale, castFunction, altitude, factor=LOW_SUN_FACTOR):
+        self.dsm = dsm
+        self.scale = scale
+        self.castFunction = castFunction
+        self.altitude = altitude
+        self.factor = int(factor)
+        self.coarseDsm = maxPool(dsm, self.factor)
+
+    def shadow(self, azimuth, altitude):
+        """
+        Shadow raster for one sun position - 1 where sunlit, 0 in shadow
+        """
+        if altitude >= self.altitude:
+            return self.castFunction(self.dsm, self.scale, azimuth, altitude)
+        coarseShadow = self.castFunction(self.coarseDsm, self.scale / self.factor, azimuth, altitude)
+        return upsample(coarseShadow, self.factor, self.dsm.shape)
+
+    def describeDayErrors(self, azimuths, altitudes):
+        """
+        Text for the log: how much the coarse shadows of each altitude band change the shadow fraction of a day,
+        given the sun positions (degrees) of all the day's time steps. Each low sun shadow is cast again, coarse and
+        at full resolution, whether or not the day's shading took it from a cache, and the differences of each band
+        are added up and divided by the number of time steps with the sun up. The maximum and mean (over the pixels)
+        are given for each band and for all the bands together, e.g.
+        "0-2 degrees (3 of 32 time steps): maximum 0.0417, mean 0.0023"
+        """
+        sunUp = np.flatnonzero(altitudes > 0)
+        bandDifferences = {} # total (coarse - full resolution) shadow of each band, by band index
+        bandSteps = {}
+        for i in sunUp:
+            if altitudes[i] >= self.altitude:
+                continue
+            band = int(altitudes[i] // LOW_SUN_BAND_WIDTH)
+            difference = self.shadow(azimuths[i], altitudes[i]) - self.castFunction(self.dsm, self.scale, azimuths[i], altitudes[i])
+            bandDifferences[band] = bandDifferences.get(band, 0) + difference
+            bandSteps[band] = bandSteps.get(band, 0) + 1
+
+        lines = []
+        for band in sorted(bandDifferences):
+            change = np.abs(bandDifferences[band]) / len(sunUp)
+            lines.append(f"{band * LOW_SUN_BAND_WIDTH}-{(band + 1) * LOW_SUN_BAND_WIDTH} degrees ({bandSteps[band]} of {len(sunUp)} time steps): "
+                         f"maximum {change.max():.4f}, mean {change.mean():.4f}")
+        if bandDifferences:
+            change = np.abs(sum(bandDifferences.values())) / len(sunUp)
+            lines.append(f"all low sun time steps ({sum(bandSteps.values())} of {len(sunUp)}): maximum {change.max():.4f}, mean {change.mean():.4f}")
+        return lines
+
+
+# Highest value of each factor x factor block of an array (the blocks at the far edges may be smaller)
+def maxPool(array, factor):
+    rows = -(-array.shape[0] // factor)
+    columns = -(-array.shape[1] // factor)
+    padded = np.pad(array, ((0, rows * factor - array.shape[0]), (0, columns * factor - array.shape[1])), mode='edge')
+    return padded.reshape(rows, factor, columns, factor).max(axis=(1, 3))
+
+
+# Each pixel of a coarse array repeated factor x factor times, cropped to shape
+def upsample(array, factor, shape):
+    return np.repeat(np.repeat(array, factor, axis=0), factor, axis=1)[:shape[0], :shape[1]]
@@ -0,0 +1,56 @@
+"""
+Peak memory use of the calculation, for sizing the machines that large areas are run on
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import sys
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Peak resident set size in megabytes of this process and, separately, the largest of its finished
+# worker processes. Either may be None where the platform can't report it.
+def peakMemoryUsage():
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS
+        units = 1 if sys.platform == 'darwin' else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * units / 2**20
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * units / 2**20
+        return own, children
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        # peak_wset is the Windows peak working set; elsewhere only the current size is known
+        return getattr(memory, 'peak_wset', memory.rss) / 2**20, None
+    return None, None
+
+
+# Text for the log, e.g. "peak memory 1234 MB (worker processes 567 MB)"
+def describePeakMemoryUsage():
+    own, children = peakMemoryUsage()
+    if own is None:
+        return "peak memory not available on this platform"
+    msg = f"peak memory {own:.0f} MB"
+    if children:
+        msg += f" (worker processes {children:.0f} MB)"
+    return msg
@@ -0,0 +1,103 @@
+"""
+On-disk cache of the SEBE sky patch shadow masks
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from pathlib import Path # Post python 3.4
+import numpy as np
+from .cache_utils import arrayDigest, markFileUsed, limitDirectoryUsage
+
+# Default limit on the disk space used by the cubes of all the DSMs in a cache directory - each takes about 18 bytes
+# per DSM pixel
+PATCH_SHADOW_CACHE_DISK_MB = 2048
+
+
+class PatchShadowCache():
+    """
+    The shadow masks of the 145 SEBE sky patches depend only on the DSM, its scale and the
+    positions of the patches - not on the meteorological data or the albedo. This cache keeps
+    them as a bit-packed cube (one row of packed bits per patch) in a memory-mapped .npy file
+    named after a hash of the DSM, so that a rerun with a different weather file can rebuild the
+    energy raster from the cached masks without casting any shadows.
+
+    The cube is written to a temporary file and only renamed to its final name once every patch
+    has been written, so an interrupted run never leaves a partial cache behind.
+    Once the cubes in the directory take up more than maxDiskMB, the least recently used are deleted.
+    The object can be pickled and handed to worker processes, which open the file themselves.
+    """
+
+    def __init__(self, cacheDirectory, dsm, scale, patchPositions, maxDiskMB=PATCH_SHADOW_CACHE_DISK_MB):
+        self.shape = dsm.shape
+        self.numberOfPatches = patchPositions.shape[0]
+        self.key = arrayDigest(dsm, float(scale), np.ascontiguousarray(patchPositions, dtype=float))
+        self.filePath = Path(cacheDirectory) / f"patch-shadows-{self.key}.npy"
+        self.partialFilePath = Path(cacheDirectory) / f"patch-shadows-{self.key}.partial.npy"
+        self.maxDiskBytes = int(maxDiskMB * 2**20)
+        self.cube = None
+
+    # Don't pickle the memory map - each process opens its own
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cube'] = None
+        return state
+
+    def isComplete(self):
+        return self.filePath.exists()
+
+    # Marks a complete cube as recently used, so it is among the last to be deleted
+    def markUsed(self):
+        markFileUsed(self.filePath)
+
+    # Creates an empty cube ready for writing
+    def create(self):
+        self.filePath.parent.mkdir(parents=True, exist_ok=True)
+        packedLength = (self.shape[0] * self.shape[1] + 7) // 8
+        cube = np.lib.format.open_memmap(str(self.partialFilePath), mode='w+', dtype=np.uint8,
+                                         shape=(self.numberOfPatches, packedLength))
+        cube.flush()
+        del cube
+
+    def writeShadow(self, index, shadow):
+        if self.cube is None:
+            self.cube = np.load(str(self.partialFilePath), mmap_mode='r+')
+        self.cube[index] = np.packbits(shadow.ravel() > 0.5)
+        self.cube.flush()
+
+    # Renames the cube to its final name once all patches have been written, then deletes the least recently used
+    # cubes if the directory has grown too big
+    def complete(self):
+        self.cube = None
+        os.replace(str(self.partialFilePath), str(self.filePath))
+        limitDirectoryUsage(self.filePath.parent, 'patch-shadows-*.npy', self.maxDiskBytes, keep=self.filePath)
+
+    # Removes a partly written cube (e.g. after the calculation has been cancelled)
+    def discard(self):
+        self.cube = None
+        if self.partialFilePath.exists():
+            os.remove(str(self.partialFilePath))
+
+    # The shadow mask of one patch - 1 where sunlit, 0 in shadow, as returned by the shadow kernel
+    def readShadow(self, index):
+        return self.readShadowMask(index).astype(float)
+
+    # As readShadow, but as a boolean array (True where sunlit)
+    def readShadowMask(self, index):
+        if self.cube is None:
+            self.cube = np.load(str(self.filePath), mmap_mode='r')
+        bits = np.unpackbits(self.cube[index], count=self.shape[0] * self.shape[1])
+        return bits.reshape(self.shape).view(bool)
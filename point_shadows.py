@@ -0,0 +1,137 @@
+"""
+Shadows at sample points on roofs, by marching rays from each point towards the sun through the DSM
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import numpy as np
+
+# Default distance between the sample points on the roofs, in metres
+ROOF_SAMPLE_SPACING = 1.0
+# Rays marched at once (each a sample point and sun position)
+RAY_BLOCK_SIZE = 2**20
+
+
+def roofSamplePoints(labels, spacing, seed=0):
+    """
+    Sample points on a jittered grid over labelled areas (e.g. rasterised roofs): a point at a random position
+    in each spacing x spacing cell of the grid, kept if it falls on a labelled pixel. Any label that gets no point
+    this way (an area smaller than a cell) gets one at the centre of its first pixel.
+
+    Attributes
+    ----------
+        labels : Numpy Array
+            integer label of each pixel, or -1 for none
+        spacing : float
+            distance between the points in pixels
+        seed : int
+            seed of the jitter, so that the same roofs always get the same points
+    Returns
+    -------
+        rows, columns, pointLabels : Numpy Arrays
+            position of each point in pixels (pixel i covers i to i + 1) and its label
+    """
+    spacing = max(float(spacing), 1e-3)
+    rng = np.random.default_rng(seed)
+    cellRows, cellColumns = np.meshgrid(np.arange(0, labels.shape[0], spacing), np.arange(0, labels.shape[1], spacing), indexing='ij')
+    rows = np.minimum(cellRows.ravel() + rng.random(cellRows.size) * spacing, labels.shape[0] - 1e-6)
+    columns = np.minimum(cellColumns.ravel() + rng.random(cellColumns.size) * spacing, labels.shape[1] - 1e-6)
+    pointLabels = labels[rows.astype(np.int64), columns.astype(np.int64)]
+    onLabel = pointLabels >= 0
+    rows, columns, pointLabels = rows[onLabel], columns[onLabel], pointLabels[onLabel]
+
+    allLabels, firstPixels = np.unique(labels.ravel(), return_index=True)
+    missing = (allLabels >= 0) & ~np.isin(allLabels, pointLabels)
+    missingRows, missingColumns = np.unravel_index(firstPixels[missing], labels.shape)
+    return (np.concatenate([rows, missingRows + 0.5]), np.concatenate([columns, missingColumns + 0.5]),
+            np.concatenate([pointLabels, allLabels[missing]]))
+
+
+def sunlitAtPoints(dsm, scale, rows, columns, azimuths, altitudes):
+    """
+    Whether each point is sunlit at each sun position, by marching a ray from the point towards the sun until it is
+    blocked by the DSM, leaves the DSM or rises above its highest point. The rays of all the points and sun positions
+    are marched together, those still going getting fewer at each step.
+    Each ray takes the same steps from the pixel the point is in as the shadow casting sweep (sweepSteps) - a pixel at
+    a time along the major axis of the sun direction and the rounded distance along the other - and compares the
+    heights in the same way, so a point is in shadow exactly where roofShadowMask would put its pixel in shadow.
+
+    Attributes
+    ----------
+        dsm : Numpy Array
+            the DSM (heights in metres)
+        scale : float
+            pixels per metre of the DSM
+        rows, columns : Numpy Arrays
+            positions of the points in pixels, e.g. from roofSamplePoints
+        azimuths, altitudes : Numpy Arrays
+            sun positions in degrees (the sun must be above the horizon)
+    Returns
+    -------
+        sunlit : Numpy Array
+            sun positions x points booleans
+    """
+    points = len(rows)
+    positions = len(azimuths)
+    pointRows = rows.astype(np.int64)
+    pointColumns = columns.astype(np.int64)
+    heights = dsm[pointRows, pointColumns]
+    highest = float(dsm.max())
+
+    # As in sweepSteps: the columns are the major axis of the sun direction between 45 and 135 degrees and between
+    # 225 and 315 degrees, the rows otherwise
+    azimuthRadians = np.asarray(azimuths) * (np.pi / 180.)
+    columnsMajor = (((np.pi / 4 <= azimuthRadians) & (azimuthRadians < 3 * np.pi / 4))
+                    | ((5 * np.pi / 4 <= azimuthRadians) & (azimuthRadians < 7 * np.pi / 4)))
+    rowSigns = -np.sign(np.cos(azimuthRadians)) # north is up the rows
+    columnSigns = np.sign(np.sin(azimuthRadians))
+    tangents = np.tan(azimuthRadians)
+    with np.errstate(divide='ignore'):
+        stepLengths = np.where(columnsMajor, np.abs(1. / np.sin(azimuthRadians)), np.abs(1. / np.cos(azimuthRadians)))
+    tanaltitudebyscale = np.tan(np.asarray(altitudes) * np.pi / 180.) / scale
+
+    sunlit = np.ones(positions * points, dtype=bool)
+    for first in range(0, positions * points, RAY_BLOCK_SIZE):
+        rays = np.arange(first, min(first + RAY_BLOCK_SIZE, positions * points))
+        rayPoints = rays % points
+        rayPositions = rays // points
+        step = 0
+        while len(rays):
+            step += 1
+            major = columnsMajor[rayPositions]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rowDistances = np.where(major, np.abs(np.round(step / tangents[rayPositions])), step)
+                columnDistances = np.where(major, step, np.abs(np.round(step * tangents[rayPositions])))
+            rayRows = pointRows[rayPoints] + (rowSigns[rayPositions] * rowDistances).astype(np.int64)
+            rayColumns = pointColumns[rayPoints] + (columnSigns[rayPositions] * columnDistances).astype(np.int64)
+            # The fall of the shadow over the step, worked out as the sweep does, so that shadows level with the
+            # point come out the same
+            dz = stepLengths[rayPositions] * step * tanaltitudebyscale[rayPositions]
+            going = ((rayRows >= 0) & (rayRows < dsm.shape[0]) & (rayColumns >= 0) & (rayColumns < dsm.shape[1])
+                     & (highest - dz > heights[rayPoints]))
+            rays, rayPoints, rayPositions = rays[going], rayPoints[going], rayPositions[going]
+            blocked = dsm[rayRows[going], rayColumns[going]] - dz[going] > heights[rayPoints]
+            sunlit[rays[blocked]] = False
+            rays, rayPoints, rayPositions = rays[~blocked], rayPoints[~blocked], rayPositions[~blocked]
+    return sunlit.reshape(positions, points)
+
+
+# Mean of the values of the points with each label (NaN for labels with no points)
+def labelMeans(values, pointLabels, numberOfLabels):
+    counts = np.bincount(pointLabels, minlength=numberOfLabels)
+    totals = np.bincount(pointLabels, weights=values, minlength=numberOfLabels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return totals / counts
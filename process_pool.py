@@ -0,0 +1,124 @@
+"""
+Helpers for running calculations in a pool of worker processes from inside QGIS
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: this module (and anything the worker processes import) must not import qgis,
+# as the worker processes are plain python interpreters.
+
+import multiprocessing
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python 3.7 and earlier - arrays are copied to each worker process instead
+    shared_memory = None
+
+
+# Inside QGIS sys.executable is the QGIS application rather than python, so worker processes
+# have to be started with the python interpreter that QGIS ships with.
+# Returns None if sys.executable is already a python interpreter.
+def pythonExecutable():
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return None
+    for name in ['pythonw.exe', 'python.exe', 'python3.exe', os.path.join('bin', 'python3'), os.path.join('bin', 'python')]:
+        candidate = os.path.join(sys.exec_prefix, name)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+# Number of worker processes to use - 0 or None means one per CPU core
+def numberOfWorkers(workers):
+    if not workers:
+        return os.cpu_count() or 1
+    return int(workers)
+
+
+# Creates a process pool using the "spawn" start method (the only one available on Windows,
+# and the only safe one from inside a running QGIS session)
+def createProcessPool(workers=None, initializer=None, initargs=()):
+    context = multiprocessing.get_context('spawn')
+    executable = pythonExecutable()
+    if executable is not None:
+        context.set_executable(executable)
+    return ProcessPoolExecutor(max_workers=numberOfWorkers(workers), mp_context=context,
+                               initializer=initializer, initargs=initargs)
+
+
+# Cancels any futures that haven't started yet, e.g. after the user presses cancel
+def cancelFutures(futures):
+    for future in futures:
+        future.cancel()
+
+
+# Feedback object for use inside worker processes, where there is no QGIS feedback object.
+# Progress and cancellation are handled by the main process instead.
+class SilentFeedback():
+
+    def isCanceled(self):
+        return False
+
+    def setProgress(self, progress):
+        pass
+
+
+class SharedArrays():
+    """
+    Copies of numpy arrays in shared memory, so that worker processes can read them without each
+    getting their own copy. Falls back to passing the arrays themselves where shared memory isn't
+    available (before python 3.8).
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.blocks = {}
+        if shared_memory is None:
+            return
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+
+    # Picklable description of the arrays to hand to the worker processes
+    def descriptors(self):
+        if shared_memory is None:
+            return {name: (None, array) for name, array in self.arrays.items()}
+        return {name: (self.blocks[name].name, (array.shape, array.dtype.str)) for name, array in self.arrays.items()}
+
+    def release(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+# Opens the arrays described by SharedArrays.descriptors inside a worker process
+# Returns a dictionary of arrays, and a list of shared memory blocks that must be kept open while they are used
+def attachSharedArrays(descriptors):
+    arrays = {}
+    blocks = []
+    for name, (blockName, description) in descriptors.items():
+        if blockName is None:
+            arrays[name] = description
+            continue
+        shape, dtype = description
+        block = shared_memory.SharedMemory(name=blockName)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return arrays, blocks
@@ -0,0 +1,65 @@
+"""
+Shadows worked out only at receiver pixels (e.g. roofs), kept per receiver rather than as rasters
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from pathlib import Path # Post python 3.4
+import numpy as np
+
+
+class ReceiverShadowStore():
+    """
+    The fraction of each day that each receiver pixel is sunlit, for several days - a value per receiver
+    per day rather than a raster, as only the receivers' shadows were worked out.
+
+    Attributes
+    ----------
+        shape : tuple
+            shape of the DSM the receivers are in
+        receivers : Numpy Array
+            flat indices of the receiver pixels in the DSM
+        sunlit : list
+            an array of the sunlit fraction of each receiver, per day
+    """
+
+    def __init__(self, shape, receivers, sunlit=None):
+        self.shape = tuple(shape)
+        self.receivers = np.asarray(receivers, dtype=np.int64)
+        self.sunlit = [] if sunlit is None else list(sunlit)
+
+    # Raster of values given per receiver, with fill everywhere else
+    def toRaster(self, values, fill=np.nan):
+        raster = np.full(self.shape, fill, dtype=float)
+        raster.ravel()[self.receivers] = values
+        return raster
+
+    def receiverMask(self):
+        return self.toRaster(1., 0.) > 0
+
+    # Saves the store as a .npz file (via a temporary file, so an interrupted write never leaves a partial store behind)
+    def save(self, filePath):
+        filePath = Path(filePath)
+        partialFilePath = filePath.with_suffix('.partial.npz')
+        np.savez(str(partialFilePath), shape=np.array(self.shape), receivers=self.receivers,
+                 sunlit=np.array(self.sunlit, dtype=np.float32).reshape(len(self.sunlit), len(self.receivers)))
+        os.replace(str(partialFilePath), str(filePath))
+
+    @classmethod
+    def load(cls, filePath):
+        with np.load(str(filePath)) as stored:
+            return cls(tuple(stored['shape']), stored['receivers'], list(stored['sunlit']))
@@ -0,0 +1,281 @@
+"""
+Wide area shadows of a region cast once for each date and time step, shared by all the local areas inside it
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from collections import OrderedDict
+from pathlib import Path # Post python 3.4
+import numpy as np
+from .cache_utils import arrayDigest, markFileUsed, limitDirectoryUsage
+
+# Default limits on the memory used by the shadows kept by one regional cache, and on the disk space used by the
+# shadows and DSMs of all the regions in the cache directory
+REGIONAL_SHADOW_CACHE_MEMORY_MB = 512
+REGIONAL_SHADOW_CACHE_DISK_MB = 2048
+# A sun position within this many degrees of that of a date and time step of the region is taken to be that step -
+# the sun positions of the same step differ by a fraction of this across a region tens of kilometres wide
+REGIONAL_STEP_TOLERANCE = 0.5
+# Number of regional caches kept in memory between runs (the least recently used is dropped first)
+REGIONAL_SHADOW_CACHES_KEPT = 2
+
+# The regional caches kept between runs, by key
+regionalShadowCaches = OrderedDict()
+
+
+class RegionalShadowCache():
+    """
+    In a batch of neighbouring local areas, each used to cast the same mountain shadows on its own wide area DSM.
+    This cache keeps the shadows cast on a coarse DEM of the whole region instead, one for each date and time step,
+    so that every local area inside the region just crops its wide area shadows out of them.
+
+    Each local area's own wide area DEM has the local area flattened at its highest point, so that the coarse local
+    terrain doesn't shade the local roofs (their shadows are cast on the local DSM). The region's DEM can't be
+    flattened for all of its local areas at once, so the cache keeps the depth of each pixel below the shadow cast
+    over it (see roofShadowDepth) rather than just whether it is sunlit. A local area given as flatArea, of height
+    flatHeight, is then sunlit where its depth is no more than flatHeight less the DEM: the shadows of the terrain
+    around it are those it would have had flattened, and its own pixels, no higher than flatHeight, cast no shadows
+    that reach that height.
+
+    The dates and time steps are added with the sun positions seen from the region (addSteps). A shadow is asked for
+    by sun position, as seen from a local area, and is that of the date and time step with the nearest sun position
+    (within REGIONAL_STEP_TOLERANCE degrees), cast for the region's sun position - so the shadows are the same
+    whichever local area asks first. A sun position with no step near it is cast but not kept.
+
+    Shadows are kept as the bit-packed sunlit pixels and the depths (half precision) of the others, least recently
+    used first out once maxMemoryMB is reached. If a directory is given, shadows pushed out of memory are written
+    there (named after a hash of the DEM) and read back rather than recast, so later runs on the same region reuse
+    them; once the files of all the regions there (with their DSMs) take more than maxDiskMB, the least recently used
+    are deleted.
+
+    Attributes
+    ----------
+        dem : Numpy Array
+            the coarse DEM of the region
+        geoTransform : tuple
+            GDAL geotransform of the DEM (north up)
+        scale : float
+            pixels per metre of the DEM
+        method : str
+            name of the shadow method, so that shadows cast by different methods are kept apart
+        directory : Path
+            optional - where shadows are written when pushed out of memory
+        maxMemoryMB, maxDiskMB : float
+            limits on the memory used by the shadows held in memory and the disk used by the files in the directory
+    """
+
+    def __init__(self, dem, geoTransform, scale, method='', directory=None,
+                 maxMemoryMB=REGIONAL_SHADOW_CACHE_MEMORY_MB, maxDiskMB=REGIONAL_SHADOW_CACHE_DISK_MB):
+        self.dem = dem
+        self.shape = dem.shape
+        self.geoTransform = tuple(float(value) for value in geoTransform)
+        self.key = arrayDigest(dem, float(scale), self.geoTransform, method)
+        self.directory = None if directory is None else Path(directory)
+        self.maxBytes = int(maxMemoryMB * 2**20)
+        self.maxDiskBytes = int(maxDiskMB * 2**20)
+        self.shadows = OrderedDict()
+        self.bytesUsed = 0
+        self.steps = {} # sun position (azimuth, altitude) of each (date, minutes) step
+        self.stepKeys = []
+        self.stepPositions = np.empty((0, 2))
+        self.hits = 0
+        self.misses = 0
+        self.diskReads = 0
+        self.unmatched = 0
+
+    def addSteps(self, date, minutes, azimuths, altitudes):
+        """
+        Adds the time steps of a date, with the sun positions seen from the region
+
+        Attributes
+        ----------
+            date : str
+                the date, e.g. '20201222'
+            minutes : Numpy Array
+                minutes after midnight of each step
+            azimuths, altitudes : Numpy Arrays
+                sun positions of the steps in degrees (those with the sun down are left out)
+        """
+        for minute, azimuth, altitude in zip(minutes, azimuths, altitudes):
+            if altitude > 0:
+                self.steps[(date, int(minute))] = (float(azimuth), float(altitude))
+        self.stepKeys = list(self.steps)
+        self.stepPositions = np.array([self.steps[stepKey] for stepKey in self.stepKeys]).reshape(-1, 2)
+
+    # The step whose sun position is nearest the given one, or None if none is within REGIONAL_STEP_TOLERANCE
+    def matchStep(self, azimuth, altitude):
+        if len(self.stepKeys) == 0:
+            return None
+        azimuthDifferences = (self.stepPositions[:, 0] - azimuth + 180.) % 360. - 180.
+        distances = np.hypot(azimuthDifferences * np.cos(np.radians(altitude)), self.stepPositions[:, 1] - altitude)
+        nearest = int(np.argmin(distances))
+        return self.stepKeys[nearest] if distances[nearest] <= REGIONAL_STEP_TOLERANCE else None
+
+    def shadow(self, azimuth, altitude, castDepth, window=None, flatArea=None, flatHeight=None):
+        """
+        The shadow for a sun position - 1 where sunlit, 0 in shadow - over the whole region or just the given
+        RegionWindow (from regionWindow), with the pixels of the RegionWindow flatArea (if given) taken to be at
+        flatHeight. From the cache if possible, otherwise worked out from castDepth(azimuth, altitude), the depths
+        below the shadow cast on the whole region (as roofShadowDepth).
+        """
+        rows = slice(0, self.shape[0]) if window is None else window.rows
+        columns = slice(0, self.shape[1]) if window is None else window.columns
+        stepKey = self.matchStep(azimuth, altitude)
+        if stepKey is None:
+            self.unmatched += 1
+            depths = castDepth(azimuth, altitude)[rows]
+        else:
+            packed = self.shadows.get(stepKey)
+            if packed is not None:
+                self.shadows.move_to_end(stepKey)
+                self.hits += 1
+            else:
+                packed = self.readFile(stepKey)
+                if packed is not None:
+                    self.diskReads += 1
+                else:
+                    self.misses += 1
+                    packed = self.pack(castDepth(*self.steps[stepKey]))
+                self.store(stepKey, packed)
+            depths = self.unpack(packed, rows)
+
+        sunlit = (depths[:, columns] <= 0).astype(float)
+        if flatArea is not None:
+            flatRows = slice(max(flatArea.rows.start, rows.start), min(flatArea.rows.stop, rows.stop))
+            flatColumns = slice(max(flatArea.columns.start, columns.start), min(flatArea.columns.stop, columns.stop))
+            if flatRows.start < flatRows.stop and flatColumns.start < flatColumns.stop:
+                flatDepths = depths[flatRows.start - rows.start:flatRows.stop - rows.start, flatColumns]
+                sunlit[flatRows.start - rows.start:flatRows.stop - rows.start, flatColumns.start - columns.start:flatColumns.stop - columns.start] = \
+                    flatDepths <= flatHeight - self.dem[flatRows, flatColumns]
+        return sunlit
+
+    # The shadow of a step as kept: (bit-packed sunlit pixels, the depths of the others in row order, and the
+    # number of those before each row)
+    def pack(self, depths):
+        shaded = depths > 0
+        rowStarts = np.concatenate(([0], np.cumsum(np.count_nonzero(shaded, axis=1))))
+        return np.packbits(~shaded.ravel()), depths[shaded].astype(np.float16), rowStarts
+
+    # The depths of the given rows of a packed shadow, over the whole width of the region
+    def unpack(self, packed, rows):
+        sunlitBits, shadedDepths, rowStarts = packed
+        firstBit = rows.start * self.shape[1]
+        bits = (rows.stop - rows.start) * self.shape[1]
+        sunlit = np.unpackbits(sunlitBits[firstBit // 8:-(-(firstBit + bits) // 8)])[firstBit % 8:firstBit % 8 + bits]
+        depths = np.zeros(bits)
+        depths[sunlit == 0] = shadedDepths[rowStarts[rows.start]:rowStarts[rows.stop]]
+        return depths.reshape(rows.stop - rows.start, self.shape[1])
+
+    def store(self, stepKey, packed):
+        self.shadows[stepKey] = packed
+        self.bytesUsed += sum(array.nbytes for array in packed)
+        while self.bytesUsed > self.maxBytes and len(self.shadows) > 1:
+            evictedKey, evicted = self.shadows.popitem(last=False)
+            self.bytesUsed -= sum(array.nbytes for array in evicted)
+            self.writeFile(evictedKey, evicted)
+
+    def filePath(self, stepKey):
+        date, minutes = stepKey
+        return self.directory / f"regional-shadow-{self.key}-{date}-{minutes:04d}.npz"
+
+    # Writes a shadow to the directory (via a temporary file, so an interrupted write never leaves a partial shadow
+    # behind), then deletes the least recently used files of the regions if the directory has grown too big
+    def writeFile(self, stepKey, packed):
+        if self.directory is None:
+            return
+        filePath = self.filePath(stepKey)
+        if filePath.exists():
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        partialFilePath = filePath.with_suffix('.partial.npz')
+        sunlitBits, shadedDepths, rowStarts = packed
+        np.savez(str(partialFilePath), sunlitBits=sunlitBits, shadedDepths=shadedDepths, rowStarts=rowStarts)
+        os.replace(str(partialFilePath), str(filePath))
+        limitDirectoryUsage(self.directory, 'regional-*', self.maxDiskBytes, keep=filePath)
+
+    def readFile(self, stepKey):
+        if self.directory is None:
+            return None
+        filePath = self.filePath(stepKey)
+        if not filePath.exists():
+            return None
+        markFileUsed(filePath)
+        with np.load(str(filePath)) as stored:
+            return stored['sunlitBits'], stored['shadedDepths'], stored['rowStarts']
+
+    # Writes the shadows still in memory to the directory too, so that later runs can use them
+    def writeAll(self):
+        for stepKey, packed in self.shadows.items():
+            self.writeFile(stepKey, packed)
+
+    # Text for the log, e.g. "96 sun positions: 52 cast, 44 from memory, 0 from disk, 0 not a time step of the region"
+    def describeUsage(self):
+        total = self.hits + self.misses + self.diskReads + self.unmatched
+        return (f"{total} sun positions: {self.misses} cast, {self.hits} from memory, {self.diskReads} from disk, "
+                f"{self.unmatched} not a time step of the region")
+
+
+class RegionWindow():
+    """
+    The pixels of a regional DEM covering an extent: their rows and columns (slices) and map extent, with the same
+    attributes as SolarConstants.Extent, and whether the extent is wholly inside the region
+    """
+
+    def __init__(self, rows, columns, xmin, ymin, xmax, ymax, inside):
+        self.rows = rows
+        self.columns = columns
+        self.xmin = int(round(xmin))
+        self.ymin = int(round(ymin))
+        self.xmax = int(round(xmax))
+        self.ymax = int(round(ymax))
+        self.width = self.xmax - self.xmin
+        self.height = self.ymax - self.ymin
+        self.inside = inside
+
+
+def regionWindow(geoTransform, shape, extent):
+    """
+    The rows and columns of a regional DEM (of the given GDAL geotransform, north up, and shape) covering an extent,
+    e.g. the wide area of a local area, and the extent of those pixels, as a RegionWindow
+    """
+    xmin, pixelWidth, _, ymax, _, pixelHeight = geoTransform
+    pixelHeight = abs(pixelHeight)
+    firstColumn = max(0, int(np.floor((extent.xmin - xmin) / pixelWidth)))
+    lastColumn = min(shape[1], int(np.ceil((extent.xmax - xmin) / pixelWidth)))
+    firstRow = max(0, int(np.floor((ymax - extent.ymax) / pixelHeight)))
+    lastRow = min(shape[0], int(np.ceil((ymax - extent.ymin) / pixelHeight)))
+    inside = (xmin <= extent.xmin and extent.xmax <= xmin + shape[1] * pixelWidth
+              and ymax - shape[0] * pixelHeight <= extent.ymin and extent.ymax <= ymax)
+    return RegionWindow(slice(firstRow, lastRow), slice(firstColumn, lastColumn),
+                        xmin + firstColumn * pixelWidth, ymax - lastRow * pixelHeight,
+                        xmin + lastColumn * pixelWidth, ymax - firstRow * pixelHeight, inside)
+
+
+def regionalShadowCacheFor(dem, geoTransform, scale, method='', directory=None,
+                           maxMemoryMB=REGIONAL_SHADOW_CACHE_MEMORY_MB, maxDiskMB=REGIONAL_SHADOW_CACHE_DISK_MB):
+    """
+    The RegionalShadowCache of a region's DEM, kept between runs so that the local areas of a batch share its shadows
+    in memory as well as on disk. Only the REGIONAL_SHADOW_CACHES_KEPT most recently used are kept; the shadows of
+    those dropped are written to their directory first.
+    """
+    regionalCache = RegionalShadowCache(dem, geoTransform, scale, method, directory, maxMemoryMB, maxDiskMB)
+    regionalCache = regionalShadowCaches.pop(regionalCache.key, regionalCache)
+    regionalShadowCaches[regionalCache.key] = regionalCache
+    while len(regionalShadowCaches) > REGIONAL_SHADOW_CACHES_KEPT:
+        droppedKey, dropped = regionalShadowCaches.popitem(last=False)
+        dropped.writeAll()
+    return regionalCache
@@ -37,11 +37,22 @@ from UMEP.Utilities.misc import *
 from osgeo import gdal, osr
 import numpy as np
 from .sebeworker_modified import Worker as ModifiedWorker
-from UMEP.Utilities.SEBESOLWEIGCommonFiles.Solweig_v2015_metdata_noload import Solweig_2015a_metdata_noload
 from UMEP.SEBE.SEBEfiles.sunmapcreator_2015a import sunmapcreator_2015a
 import webbrowser
 from UMEP.SEBE import WriteMetaDataSEBE
 from .SolarConstants  import *
+from .solar_exception import SolarException
+from .cache_utils import arrayDigest
+from .solar_ephemeris import metdataSolarGeometry
+from pathlib import Path # Post python 3.4
+
+# Names of the per row solar geometry arrays returned by metdataSolarGeometry (as Solweig_2015a_metdata_noload), in order
+SOLAR_GEOMETRY_NAMES = ['YYYY', 'altitude', 'azimuth', 'zen', 'jday', 'leafon', 'dectime', 'altmax']
+# Rounding of the location for the radiation matrix cache: about 1km of latitude, and 10m of altitude
+RADIATION_CACHE_LOCATION_DECIMALS = 2
+RADIATION_CACHE_ALTITUDE_STEP = 10
+# Part of the radiation cache key, so that cached results from a different sun position calculation aren't reused
+SOLAR_GEOMETRY_METHOD = 'noaa-ephemeris'
 
 
 class SEBE(object):
@@ -94,7 +105,7 @@ class SEBE(object):
                 "the Pre-processor")
 
     
-    def calculateSebeParameters(self, dsmlayer, UTC, albedo):   
+    def calculateSebeParameters(self, dsmlayer, UTC, albedo, calcMonth=False, cacheDirectory=None):   
 #         self.folderPath = [dataDirectoryFilePath] # hack this as an array     
         provider = dsmlayer.dataProvider()
         filepath_dsm = str(provider.dataSourceUri())
@@ -184,12 +195,74 @@ class SEBE(object):
         if alt < 0:
             alt = 3
         location = {'longitude':lon, 'latitude':lat, 'altitude':alt}
-        YYYY, altitude, azimuth, zen, jday, leafon, dectime, altmax = Solweig_2015a_metdata_noload(self.metdata, location, UTC)
-        radmatI, radmatD, radmatR = sunmapcreator_2015a(self.metdata, altitude, azimuth, 
-            onlyglobal, output, jday, albedo, location, zen)
+        # Monthly energy is accumulated by the worker in the same pass over the sky patches as the annual energy,
+        # using one set of radiation matrices per month
+        calc_month = calcMonth
+        radmatI, radmatD, radmatR = self.calculateRadiationMatrices(location, UTC, albedo, onlyglobal, output, calc_month, cacheDirectory)
             # Hack - save sky irradiance is always false
         building_slope, building_aspect = get_ders(self.dsm, self.scale)
-        calc_month = False # TODO: Month not implemented
         return building_slope, building_aspect, scale, voxelheight, sizey, sizex, radmatI, radmatD, radmatR, calc_month, dSM
-    
-    
+
+    # Sky patch radiation matrices (radmatI, radmatD, radmatR) for the meteorological data, also setting
+    # self.solarGeometry to the solar position of each row of the data and, with calcMonth,
+    # self.monthlyRadiationMatrices to the matrices for each month.
+    # With a cache directory the results are kept in an .npz file named after a hash of the meteorological data,
+    # the location (rounded, so that neighbouring areas share the file), UTC offset and albedo, and the
+    # sun positions and radiation are calculated for the rounded location.
+    def calculateRadiationMatrices(self, location, UTC, albedo, onlyglobal, output, calcMonth=False, cacheDirectory=None):
+        cacheFilePath = None
+        if cacheDirectory is not None:
+            location = {'longitude': round(location['longitude'], RADIATION_CACHE_LOCATION_DECIMALS),
+                        'latitude': round(location['latitude'], RADIATION_CACHE_LOCATION_DECIMALS),
+                        'altitude': round(location['altitude'] / RADIATION_CACHE_ALTITUDE_STEP) * RADIATION_CACHE_ALTITUDE_STEP}
+            key = arrayDigest(self.metdata, location['longitude'], location['latitude'], location['altitude'],
+                              float(UTC), float(albedo), onlyglobal, SOLAR_GEOMETRY_METHOD)
+            cacheFilePath = Path(cacheDirectory) / f"radiation-matrices-{key}.npz"
+            if cacheFilePath.exists():
+                with np.load(str(cacheFilePath)) as cached:
+                    if not calcMonth or 'monthlyRadmatI' in cached:
+                        self.solarGeometry = {name: cached[name] for name in SOLAR_GEOMETRY_NAMES}
+                        self.monthlyRadiationMatrices = None
+                        if calcMonth:
+                            self.monthlyRadiationMatrices = list(zip(cached['monthlyRadmatI'], cached['monthlyRadmatD'], cached['monthlyRadmatR']))
+                        return cached['radmatI'], cached['radmatD'], cached['radmatR']
+
+        # Vectorised replacement for UMEP's Solweig_2015a_metdata_noload
+        YYYY, altitude, azimuth, zen, jday, leafon, dectime, altmax = metdataSolarGeometry(self.metdata, location, UTC)
+        self.solarGeometry = dict(zip(SOLAR_GEOMETRY_NAMES, (YYYY, altitude, azimuth, zen, jday, leafon, dectime, altmax)))
+        radmatI, radmatD, radmatR = sunmapcreator_2015a(self.metdata, altitude, azimuth, 
+            onlyglobal, output, jday, albedo, location, zen)
+        self.monthlyRadiationMatrices = None
+        if calcMonth:
+            self.monthlyRadiationMatrices = self.calculateMonthlyRadiationMatrices(altitude, azimuth, zen, jday, onlyglobal, output, albedo, location)
+
+        if cacheFilePath is not None:
+            arrays = dict(self.solarGeometry, radmatI=radmatI, radmatD=radmatD, radmatR=radmatR)
+            if calcMonth:
+                arrays['monthlyRadmatI'], arrays['monthlyRadmatD'], arrays['monthlyRadmatR'] = [np.stack(radmats) for radmats in zip(*self.monthlyRadiationMatrices)]
+            cacheFilePath.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so that another run never sees a partly written file
+            partialFilePath = cacheFilePath.with_suffix('.partial')
+            with open(str(partialFilePath), 'wb') as cacheFile:
+                np.savez(cacheFile, **arrays)
+            os.replace(str(partialFilePath), str(cacheFilePath))
+        return radmatI, radmatD, radmatR
+
+    # Sky patch radiation matrices for each calendar month, calculated from the rows of the meteorological
+    # data (and the matching solar positions) that fall in that month.
+    # Returns a list of 12 (radmatI, radmatD, radmatR) tuples, January first.
+    def calculateMonthlyRadiationMatrices(self, altitude, azimuth, zen, jday, onlyglobal, output, albedo, location):
+        years = self.metdata[:, 0].astype(int)
+        daysOfYear = self.metdata[:, 1].astype(int)
+        dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (daysOfYear - 1)
+        months = dates.astype('datetime64[M]').astype(int) % 12 + 1
+
+        monthlyRadiationMatrices = []
+        for month in range(1, 13):
+            rows = months == month
+            if not rows.any():
+                raise SolarException("Value error", f"Meteorological data has no rows for month {month} - monthly energy needs a full year")
+            monthlyRadiationMatrices.append(sunmapcreator_2015a(self.metdata[rows],
+                np.compress(rows, altitude, axis=-1), np.compress(rows, azimuth, axis=-1),
+                onlyglobal, output, np.compress(rows, jday, axis=-1), albedo, location, np.compress(rows, zen, axis=-1)))
+        return monthlyRadiationMatrices
@@ -27,7 +27,9 @@
 from __future__ import print_function
 from builtins import range
 import numpy as np
-from UMEP.Utilities.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_13 import shadowingfunction_wallheight_13
+from concurrent.futures import FIRST_COMPLETED, wait
+from .shadow_kernels import roofShadow, roofShadowMask
+from .process_pool import createProcessPool, cancelFutures, numberOfWorkers, SharedArrays, attachSharedArrays
 import linecache
 import sys
 
@@ -36,11 +38,22 @@ import sys
 # @author Tom Nicholls Lancaster University CUSP project
 # code written for CAFS
 
+# Skyvault of patches of constant radians (Tregeneza and Sharples, 1993)
+SKY_VAULT_ALTITUDES = np.array([6, 18, 30, 42, 54, 66, 78, 90])
+SKY_VAULT_AZIMUTH_PATCHES = np.array([30, 30, 24, 24, 18, 12, 6, 1])
+NUMBER_OF_SKY_PATCHES = int(SKY_VAULT_AZIMUTH_PATCHES.sum()) # 145
+
+# Number of chunks of sky patches handed to each worker process in the parallel calculation.
+# More chunks gives smoother progress reporting and quicker cancellation, fewer gives less copying of results.
+CHUNKS_PER_WORKER = 3
+
 class Worker():
 
 
     def __init__(self, dsm, scale, building_slope, building_aspect, voxelheight, sizey, sizex,
-                 wheight, waspect, albedo, psi, radmatI, radmatD, radmatR, calc_month, feedback):
+                 wheight, waspect, albedo, psi, radmatI, radmatD, radmatR, calc_month, feedback,
+                 parallel=False, processes=None, shadowCache=None, patchErrorBudget=0, monthlyRadiationMatrices=None,
+                 lowMemory=False, singlePrecision=False):
 
         self.dsm = dsm
         self.scale = scale
@@ -58,77 +71,338 @@ class Worker():
         self.radmatR = radmatR
         self.calc_month = calc_month
         self.feedback = feedback
+        self.parallel = parallel
+        self.processes = processes
+        self.shadowCache = shadowCache
+        self.patchErrorBudget = patchErrorBudget
+        # With calc_month, a list of 12 (radmatI, radmatD, radmatR) tuples - see SEBE.calculateMonthlyRadiationMatrices
+        self.monthlyRadiationMatrices = monthlyRadiationMatrices if calc_month else None
+        # Set by run when monthly energy is calculated: array of 12 monthly energy rasters, January first
+        self.Energymonthroof = None
+        # Low memory mode preallocates its arrays and works in place, optionally in single precision
+        # (always in this process - it takes precedence over parallel)
+        self.lowMemory = lowMemory
+        self.singlePrecision = singlePrecision
+        # Set by run: the sky patches actually calculated, and the fraction of the unshaded annual energy moved onto
+        # them from the patches skipped (not a bound on the error at any one pixel)
+        self.patches = np.arange(NUMBER_OF_SKY_PATCHES)
+        self.patchEnergyMoved = 0.
+        # Set by run: the radiation matrices used - those given, with the radiation of any skipped patches merged
+        # into their nearest calculated patch
+        self.patchRadiationMatrices = (radmatI, radmatD, radmatR)
+        self.patchMonthlyRadiationMatrices = self.monthlyRadiationMatrices
 
     # Returns a numpy array of the solar energy pattern on roofs
+    # (and sets Energymonthroof to the monthly patterns if calc_month is set)
     def run(self):
+        self.patches, self.patchEnergyMoved = selectSkyPatches(self.radmatI, self.radmatD, self.radmatR, self.patchErrorBudget)
+        self.patchRadiationMatrices = mergeSkippedPatches(self.patches, self.radmatI, self.radmatD, self.radmatR)
+        self.patchMonthlyRadiationMatrices = self.monthlyRadiationMatrices
+        if self.monthlyRadiationMatrices is not None:
+            self.patchMonthlyRadiationMatrices = [mergeSkippedPatches(self.patches, *monthlyRadiationMatrices)
+                                                  for monthlyRadiationMatrices in self.monthlyRadiationMatrices]
+
+        # Without a complete cache of the patch shadows, cast them and fill the cache on the way
+        # (unless some patches are being skipped, which would leave gaps in the cache)
+        shadowCache = self.shadowCache
+        fillCache = shadowCache is not None and not shadowCache.isComplete()
+        if fillCache and len(self.patches) < NUMBER_OF_SKY_PATCHES:
+            shadowCache = None
+            fillCache = False
+        if fillCache:
+            self.shadowCache.create()
+        try:
+            if self.lowMemory:
+                Energyyearroof, Energymonthroof = self.runLowMemory(shadowCache)
+            elif self.parallel:
+                Energyyearroof, Energymonthroof = self.runParallel(shadowCache)
+            else:
+                Energyyearroof, Energymonthroof = self.runSerial(shadowCache)
+        except BaseException:
+            if fillCache:
+                self.shadowCache.discard()
+            raise
+        if fillCache:
+            if self.feedback.isCanceled():
+                self.shadowCache.discard()
+            else:
+                self.shadowCache.complete()
+
+        Energyyearroof /= 1000
+        if Energymonthroof is not None:
+            Energymonthroof /= 1000
+        self.Energymonthroof = Energymonthroof
+        return Energyyearroof
+
+    # Main loop - one sky patch at a time
+    def runSerial(self, shadowCache=None):
         a = self.dsm
         scale = self.scale
         slope = self.building_slope
         aspect = self.building_aspect
-        voxelheight = self.voxelheight
         sizey = self.sizey
         sizex = self.sizex
-        walls = self.wheight
-        dirwalls = self.waspect
-        albedo = self.albedo
-        psi = self.psi
-        radmatI = self.radmatI
-        radmatD = self.radmatD
-        radmatR = self.radmatR
-        calc_month = self.calc_month
-
-        # Parameters
+        radmatI, radmatD, radmatR = self.patchRadiationMatrices
+
+        Energyyearroof = np.zeros((sizex, sizey))
+        Energymonthroof = None
+        if self.patchMonthlyRadiationMatrices is not None:
+            Energymonthroof = np.zeros((12, sizex, sizey))
+
+        for patchesDone, index in enumerate(self.patches, 1):
+            if self.feedback.isCanceled():
+                break
+
+            # Each shadow is cast once and feeds both the annual and the monthly totals
+            shadow, suniroof = patchShadowAndIncidence(a, scale, slope, aspect, radmatI, index, shadowCache)
+            I, D, R = irradianceFromShadow(shadow, suniroof, radmatI, radmatD, radmatR, index)
+            Energyyearroof = np.copy(Energyyearroof+D+R+I)
+            if Energymonthroof is not None:
+                accumulateMonthlyIrradiance(Energymonthroof, shadow, suniroof, self.patchMonthlyRadiationMatrices, index)
+
+            self.feedback.setProgress(50 + int(50 * patchesDone / len(self.patches))) # From 50 to 100% as this is the second half of processing
+
+        return Energyyearroof, Energymonthroof
+
+    # Same calculation as runSerial, but all the full size arrays are allocated once before the loop and
+    # updated in place (optionally in single precision - the shadows are still cast from the double precision DSM),
+    # so that memory use doesn't grow with temporaries on large areas. Two identities help:
+    # cos(azimuth - aspect) = cos(azimuth)cos(aspect) + sin(azimuth)sin(aspect), so the slope and aspect
+    # trigonometry is done once rather than for every patch, and
+    # shadow*(I + D) + (1 - shadow)*R = shadow*(I + D - R) + R, so the reflected radiation is added once at the end.
+    def runLowMemory(self, shadowCache=None):
+        a = self.dsm
+        scale = self.scale
+        radmatI, radmatD, radmatR = self.patchRadiationMatrices
+        monthlyRadiationMatrices = self.patchMonthlyRadiationMatrices
         deg2rad = np.pi/180
-        Knight = np.zeros((sizex, sizey))
-        Energyyearroof = np.copy(Knight)
+        dtype = np.float32 if self.singlePrecision else np.float64
+        shape = (self.sizex, self.sizey)
 
-        # Main loop - Creating skyvault of patches of constant radians (Tregeneza and Sharples, 1993)
-        skyvaultaltint = np.array([6, 18, 30, 42, 54, 66, 78, 90])
-        aziinterval = np.array([30, 30, 24, 24, 18, 12, 6, 1])
+        incidence = np.empty(shape, dtype)
+        term = np.empty(shape, dtype)
+        work = np.empty(a.shape, a.dtype)
+        sunlit = np.empty(a.shape, bool)
+        cosSlope = np.empty(shape, dtype)
+        sinSlopeCosAspect = np.empty(shape, dtype)
+        sinSlopeSinAspect = np.empty(shape, dtype)
+        np.cos(self.building_slope, out=cosSlope)
+        np.cos(self.building_aspect, out=sinSlopeCosAspect)
+        np.sin(self.building_aspect, out=sinSlopeSinAspect)
+        np.sin(self.building_slope, out=incidence)
+        sinSlopeCosAspect *= incidence
+        sinSlopeSinAspect *= incidence
 
-        index = 0
-        iRange = skyvaultaltint.size
-        for i in range(iRange):
-            
-            jRange = aziinterval[i]
-            for j in range(jRange):
+        Energyyearroof = np.zeros(shape, dtype)
+        Energymonthroof = None
+        if monthlyRadiationMatrices is not None:
+            Energymonthroof = np.zeros((12,) + shape, dtype)
 
-                if self.feedback.isCanceled():
-                    break
+        for patchesDone, index in enumerate(self.patches, 1):
+            if self.feedback.isCanceled():
+                break
 
+            altitude = radmatI[index, 0] * deg2rad
+            azimuth = radmatI[index, 1] * deg2rad
+            # Solar incidence angle (roofs)
+            np.multiply(sinSlopeCosAspect, np.cos(altitude) * np.cos(azimuth), out=incidence)
+            np.multiply(sinSlopeSinAspect, np.cos(altitude) * np.sin(azimuth), out=term)
+            incidence += term
+            np.multiply(cosSlope, np.sin(altitude), out=term)
+            incidence += term
+            np.maximum(incidence, 0, out=incidence)
 
-                #################### SOLAR RADIATION POSITIONS ###################
-                #Solar Incidence angle (Roofs)
-                suniroof = np.sin(slope) * np.cos(radmatI[index, 0] * deg2rad) * \
-                           np.cos((radmatI[index, 1]*deg2rad)-aspect) + \
-                           np.cos(slope) * np.sin((radmatI[index, 0] * deg2rad))
+            if shadowCache is not None and shadowCache.isComplete():
+                np.copyto(sunlit, shadowCache.readShadowMask(index))
+            else:
+                roofShadowMask(a, radmatI[index, 1], radmatI[index, 0], scale, work, sunlit)
+                if shadowCache is not None:
+                    shadowCache.writeShadow(index, sunlit)
 
-                suniroof[suniroof < 0] = 0
+            accumulateSunlitIrradiance(Energyyearroof, term, incidence, sunlit, radmatI, radmatD, radmatR, index)
+            if Energymonthroof is not None:
+                for month, (monthI, monthD, monthR) in enumerate(monthlyRadiationMatrices):
+                    accumulateSunlitIrradiance(Energymonthroof[month], term, incidence, sunlit, monthI, monthD, monthR, index)
 
-                sh, wallsh, wallsun, facesh, facesun = shadowingfunction_wallheight_13(a, radmatI[index, 1],
-                                                            radmatI[index, 0], scale, walls, dirwalls * deg2rad)
-                shadow = np.copy(sh)
+            self.feedback.setProgress(50 + int(50 * patchesDone / len(self.patches))) # From 50 to 100% as this is the second half of processing
 
-                # roof irradiance calculation
-                # direct radiation
-                if radmatI[index, 2] > 0:
-                    I = shadow * radmatI[index, 2] * suniroof
-                else:
-                    I = np.copy(Knight)
+        # Reflected radiation of the patches calculated
+        Energyyearroof += radmatR[self.patches, 2].sum()
+        if Energymonthroof is not None:
+            for month, (monthI, monthD, monthR) in enumerate(monthlyRadiationMatrices):
+                Energymonthroof[month] += monthR[self.patches, 2].sum()
 
-                # roof diffuse and reflected radiation
-                D = radmatD[index, 2] * shadow
-                R = radmatR[index, 2] * (shadow*-1 + 1)
+        return Energyyearroof, Energymonthroof
 
-                Energyyearroof = np.copy(Energyyearroof+D+R+I)
+    # The sky patches are independent, so they are shared out between worker processes in chunks.
+    # The DSM, slope and aspect rasters are placed in shared memory once rather than copied for every chunk,
+    # and each chunk returns its partial energy rasters, which are summed here.
+    # (The wall height and aspect rasters aren't needed as wall irradiance isn't calculated)
+    def runParallel(self, shadowCache=None):
+        workers = numberOfWorkers(self.processes)
+        chunks = np.array_split(self.patches, workers * CHUNKS_PER_WORKER)
+        chunks = [chunk for chunk in chunks if chunk.size > 0]
 
-                index = index + 1
+        Energyyearroof = np.zeros((self.sizex, self.sizey))
+        Energymonthroof = None
+        if self.patchMonthlyRadiationMatrices is not None:
+            Energymonthroof = np.zeros((12, self.sizex, self.sizey))
+        sharedArrays = SharedArrays({'dsm': self.dsm, 'slope': self.building_slope, 'aspect': self.building_aspect})
+        try:
+            initargs = (sharedArrays.descriptors(), self.scale, *self.patchRadiationMatrices, shadowCache,
+                        self.patchMonthlyRadiationMatrices)
+            with createProcessPool(workers, initialiseSkyPatchWorker, initargs) as pool:
+                futures = {pool.submit(calculateSkyPatchChunk, chunk) for chunk in chunks}
+                patchesDone = 0
+                while futures:
+                    if self.feedback.isCanceled():
+                        cancelFutures(futures)
+                        break
+                    done, futures = wait(futures, timeout=1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        partialEnergy, partialMonthlyEnergy, numberOfPatches = future.result()
+                        Energyyearroof += partialEnergy
+                        if Energymonthroof is not None:
+                            Energymonthroof += partialMonthlyEnergy
+                        patchesDone += numberOfPatches
+                        self.feedback.setProgress(50 + int(50 * patchesDone / len(self.patches))) # From 50 to 100% as this is the second half of processing
+        finally:
+            sharedArrays.release()
 
-                self.feedback.setProgress(50 + int(50 * (((i + 1) / iRange) + ((j + 1) / (iRange * jRange))))) # From 50 to 100% as this is the second half of processing
+        return Energyyearroof, Energymonthroof
 
 
-        Energyyearroof /= 1000
-        return Energyyearroof
-    
+# Chooses which sky patches to calculate, skipping those with the least radiation while their share of the unshaded
+# annual energy stays within errorBudget (e.g. 0.01 for 1%). Their radiation is then merged into the nearest patch
+# calculated (mergeSkippedPatches), so it isn't lost.
+# A patch can add at most max(radmatI + radmatD, radmatR) to any pixel (sunlit: direct at normal incidence
+# plus diffuse, shaded: reflected), and the share is that of the sum of those weights over all patches - the energy
+# of a fully exposed, optimally facing surface. It is not a bound on the relative error at any one pixel: a partly
+# shaded pixel gets much less than that energy, so the same absolute error is a larger part of its total.
+# Returns the indices of the patches to calculate (in their original order) and the share of the energy moved.
+def selectSkyPatches(radmatI, radmatD, radmatR, errorBudget=0):
+    weights = np.maximum(np.maximum(radmatI[:, 2], 0) + radmatD[:, 2], radmatR[:, 2])
+    totalWeight = weights.sum()
+    if errorBudget <= 0 or totalWeight <= 0:
+        return np.arange(len(weights)), 0.
+
+    order = np.argsort(weights, kind='stable')
+    skippedWeight = np.cumsum(weights[order])
+    numberSkipped = int(np.searchsorted(skippedWeight, errorBudget * totalWeight, side='right'))
+    patches = np.sort(order[numberSkipped:])
+    energyMoved = skippedWeight[numberSkipped - 1] / totalWeight if numberSkipped > 0 else 0.
+    return patches, energyMoved
+
+
+# Copies of the radiation matrices with the radiation of each patch not in patches added to the nearest patch in
+# patches (by angle across the sky), so that the totals over the sky are unchanged by skipping patches
+def mergeSkippedPatches(patches, *radiationMatrices):
+    skipped = np.setdiff1d(np.arange(radiationMatrices[0].shape[0]), patches)
+    if len(skipped) == 0:
+        return radiationMatrices
+    deg2rad = np.pi/180
+    altitude = radiationMatrices[0][:, 0] * deg2rad
+    azimuth = radiationMatrices[0][:, 1] * deg2rad
+    directions = np.c_[np.cos(altitude) * np.sin(azimuth), np.cos(altitude) * np.cos(azimuth), np.sin(altitude)]
+    nearest = patches[np.argmax(directions[skipped] @ directions[patches].T, axis=1)]
+    merged = []
+    for radmat in radiationMatrices:
+        radmat = np.copy(radmat)
+        np.add.at(radmat[:, 2], nearest, radmat[skipped, 2])
+        radmat[skipped, 2] = 0
+        merged.append(radmat)
+    return tuple(merged)
+
+
+# Shadow (1 = sunlit) and solar incidence on the roofs for one sky patch. Neither depends on the radiation.
+# With a shadow cache the patch shadow is read from the cache if it is complete, and written to it otherwise.
+def patchShadowAndIncidence(a, scale, slope, aspect, radmatI, index, shadowCache=None):
+    # Parameters
+    deg2rad = np.pi/180
+
+    #################### SOLAR RADIATION POSITIONS ###################
+    #Solar Incidence angle (Roofs)
+    suniroof = np.sin(slope) * np.cos(radmatI[index, 0] * deg2rad) * \
+               np.cos((radmatI[index, 1]*deg2rad)-aspect) + \
+               np.cos(slope) * np.sin((radmatI[index, 0] * deg2rad))
+
+    suniroof[suniroof < 0] = 0
+
+    # Roof and ground shadow only - wall irradiance isn't used, so wall shadows aren't calculated
+    if shadowCache is not None and shadowCache.isComplete():
+        shadow = shadowCache.readShadow(index)
+    else:
+        shadow = roofShadow(a, radmatI[index, 1], radmatI[index, 0], scale)
+        if shadowCache is not None:
+            shadowCache.writeShadow(index, shadow)
+
+    return shadow, suniroof
+
+
+# Direct (I), diffuse (D) and reflected (R) irradiance on the roofs from one sky patch, given its shadow and incidence
+def irradianceFromShadow(shadow, suniroof, radmatI, radmatD, radmatR, index):
+    # roof irradiance calculation
+    # direct radiation
+    if radmatI[index, 2] > 0:
+        I = shadow * radmatI[index, 2] * suniroof
+    else:
+        I = np.zeros(shadow.shape)
+
+    # roof diffuse and reflected radiation
+    D = radmatD[index, 2] * shadow
+    R = radmatR[index, 2] * (shadow*-1 + 1)
+
+    return I, D, R
+
+
+# Low memory mode: adds one sky patch's sunlit*(I + D - R) to energy in place, using term as workspace.
+# (The reflected radiation R itself is added separately)
+def accumulateSunlitIrradiance(energy, term, incidence, sunlit, radmatI, radmatD, radmatR, index):
+    if radmatI[index, 2] > 0:
+        np.multiply(incidence, radmatI[index, 2], out=term)
+    else:
+        term.fill(0)
+    term += radmatD[index, 2] - radmatR[index, 2]
+    np.multiply(term, sunlit, out=term)
+    energy += term
+
+
+# Adds one sky patch's irradiance to each of the 12 monthly energy rasters
+def accumulateMonthlyIrradiance(Energymonthroof, shadow, suniroof, monthlyRadiationMatrices, index):
+    for month, (radmatI, radmatD, radmatR) in enumerate(monthlyRadiationMatrices):
+        I, D, R = irradianceFromShadow(shadow, suniroof, radmatI, radmatD, radmatR, index)
+        Energymonthroof[month] += D+R+I
+
+
+# Per process state of the sky patch worker processes
+skyPatchWorkerState = {}
+
+def initialiseSkyPatchWorker(descriptors, scale, radmatI, radmatD, radmatR, shadowCache=None, monthlyRadiationMatrices=None):
+    arrays, blocks = attachSharedArrays(descriptors)
+    skyPatchWorkerState.update(arrays)
+    skyPatchWorkerState['blocks'] = blocks
+    skyPatchWorkerState['scale'] = scale
+    skyPatchWorkerState['radmatI'] = radmatI
+    skyPatchWorkerState['radmatD'] = radmatD
+    skyPatchWorkerState['radmatR'] = radmatR
+    skyPatchWorkerState['shadowCache'] = shadowCache
+    skyPatchWorkerState['monthlyRadiationMatrices'] = monthlyRadiationMatrices
 
 
+# Runs in a worker process: the summed annual (and monthly, if wanted) energy of a chunk of sky patches
+def calculateSkyPatchChunk(indices):
+    state = skyPatchWorkerState
+    a = state['dsm']
+    monthlyRadiationMatrices = state['monthlyRadiationMatrices']
+    Energyyearroof = np.zeros(a.shape)
+    Energymonthroof = None
+    if monthlyRadiationMatrices is not None:
+        Energymonthroof = np.zeros((12,) + a.shape)
+    for index in indices:
+        shadow, suniroof = patchShadowAndIncidence(a, state['scale'], state['slope'], state['aspect'],
+                                                   state['radmatI'], index, state['shadowCache'])
+        I, D, R = irradianceFromShadow(shadow, suniroof, state['radmatI'], state['radmatD'], state['radmatR'], index)
+        Energyyearroof = Energyyearroof+D+R+I
+        if Energymonthroof is not None:
+            accumulateMonthlyIrradiance(Energymonthroof, shadow, suniroof, monthlyRadiationMatrices, index)
+    return Energyyearroof, Energymonthroof, len(indices)
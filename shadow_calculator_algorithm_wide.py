@@ -29,20 +29,45 @@ __copyright__ = '(C) 2021 by Cumbria Action for Sustainability'
 
 __revision__ = '$Format:%H$'
 
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import *
 from PyQt5.QtWidgets import QProgressBar # Need this for the QGIS plugin progress bar
 
 from osgeo import gdal
 
 from .SolarConstants  import *
-from .shadow_generator_modified import ShadowGenerator
+from .shadow_generator_modified import ShadowGenerator, SHADOW_METHODS, SHADOW_ENGINES, RASTER_ENGINE, RECEIVER_ENGINE, POINT_ENGINE, WIDE_AREA_METHODS, MERGED_WIDE_AREA, FAR_FIELD_WIDE_AREA
+from .dailyshading_modified import AdaptiveSampling, ADAPTIVE_FINE_INTERVAL
+from .horizon_angles import HORIZON_SECTORS
+from .timestep_shadow_cube import hourlyProfiles
+from .point_shadows import roofSamplePoints, labelMeans, ROOF_SAMPLE_SPACING
+from .low_sun_resolution import LOW_SUN_FACTOR
+from .far_field_horizon import FAR_FIELD_SECTORS
+from .regional_shadow_cache import REGIONAL_SHADOW_CACHE_DISK_MB
+from .cache_utils import arrayDigest, fileDigest, markFileUsed, limitDirectoryUsage
+import os
 import numpy as np
 from pathlib import Path # Post python 3.4
 from .SolarDirectoryPaths import SolarDirectoryPaths
 
 import processing
 
+# The days the shadows are calculated for: name, label used in the file names, (year, month, day, dst)
+# with dst 1 for daylight savings time, and the fraction of the day a pixel must be sunlit to count as sunny
+# Note Bugfix - threshold for March and September is 0.5, for June is 0.6 and for December is 0.4
+SEASONAL_SHADOW_DATES = [
+    ('March', '200320', (2020, 3, 20, 0), 0.5),
+    ('June', '200621', (2020, 6, 21, 1), 0.6),
+    ('September', '200923', (2020, 9, 23, 1), 0.5),
+    ('December', '201222', (2020, 12, 22, 0), 0.4),
+]
+
+
+# 1 where a day's shadow raster (the fraction of the day each pixel is sunlit) is above the threshold, 0 elsewhere -
+# as the reclassification table [0, threshold, 0, threshold, 1, 1] did
+def seasonalBinary(shadowArray, threshold):
+    return (shadowArray > threshold).astype(np.float32)
+
 class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
     """
     """
@@ -57,6 +82,25 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
     # DSM_CLIPPED='DSM_CLIPPED'
     DATA_DIRECTORY = "DATA_DIRECTORY"   
     CHECKBOX='USE_WIDE_AREA'
+    SUN_POSITION_TOLERANCE = 'SUN_POSITION_TOLERANCE'
+    KEEP_SHADOW_CACHE = 'KEEP_SHADOW_CACHE'
+    SHADOW_METHOD = 'SHADOW_METHOD'
+    SHADOW_ENGINE = 'SHADOW_ENGINE'
+    WIDE_AREA_METHOD = 'WIDE_AREA_METHOD'
+    FAR_FIELD_SECTORS = 'FAR_FIELD_SECTORS'
+    REGIONAL_AREA = 'REGIONAL_AREA'
+    ROOF_SAMPLE_SPACING = 'ROOF_SAMPLE_SPACING'
+    HORIZON_SECTORS = 'HORIZON_SECTORS'
+    ADAPTIVE_TOLERANCE = 'ADAPTIVE_TOLERANCE'
+    ADAPTIVE_FINE_INTERVAL = 'ADAPTIVE_FINE_INTERVAL'
+    VALIDATE_ADAPTIVE = 'VALIDATE_ADAPTIVE'
+    LOW_SUN_ALTITUDE = 'LOW_SUN_ALTITUDE'
+    LOW_SUN_FACTOR = 'LOW_SUN_FACTOR'
+    VALIDATE_LOW_SUN = 'VALIDATE_LOW_SUN'
+    WRITE_SEASONAL_RASTERS = 'WRITE_SEASONAL_RASTERS'
+    KEEP_TIMESTEP_SHADOWS = 'KEEP_TIMESTEP_SHADOWS'
+    PROCESSES = 'PROCESSES'
+    PARALLEL_TIMESTEPS = 'PARALLEL_TIMESTEPS'
 
     def initAlgorithm(self, config):
         """
@@ -105,6 +149,146 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.REGIONAL_AREA,
+                self.tr('Region around a batch of local areas (optional - its wide area shadows are cast once and shared by them)'),
+                [QgsProcessing.TypeVectorAnyGeometry],
+                optional=True
+            )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.SUN_POSITION_TOLERANCE,
+                self.tr('Reuse shadows cast for sun positions within this many degrees (0 = identical positions only)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=5,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.KEEP_SHADOW_CACHE,
+                                                        self.tr('Keep shadows that don\'t fit in memory on disk, for reuse by later runs on the same DSM'),
+                                                        defaultValue=False))
+
+        # Order must match SHADOW_METHODS
+        self.addParameter(QgsProcessingParameterEnum(
+                self.SHADOW_METHOD,
+                self.tr('Shadow method'),
+                options=[self.tr('Shadow casting for every sun position (original)'), self.tr('Per pixel horizon angles (fast for many time steps)'),
+                         self.tr('Line sweep (the same shadows as casting, faster at low sun)')],
+                defaultValue=0
+        ))
+
+        # Order must match SHADOW_ENGINES
+        self.addParameter(QgsProcessingParameterEnum(
+                self.SHADOW_ENGINE,
+                self.tr('Shadows worked out for'),
+                options=[self.tr('Every pixel of the DSM (original)'),
+                         self.tr('Roof pixels only, by marching rays towards the sun (the whole DSM still casts shadows)'),
+                         self.tr('Sample points on the roofs, by marching rays towards the sun (writes Shade_mean directly)')],
+                defaultValue=0
+        ))
+
+        # Order must match WIDE_AREA_METHODS
+        self.addParameter(QgsProcessingParameterEnum(
+                self.WIDE_AREA_METHOD,
+                self.tr('Wide area shadows'),
+                options=[self.tr('Cast on the low resolution wide area DSM at every time step (original)'),
+                         self.tr('Far field horizon of the local area, worked out once from the low resolution wide area DSM')],
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.FAR_FIELD_SECTORS,
+                self.tr('Azimuth sectors of the far field horizon'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=8,
+                maxValue=3600,
+                defaultValue=FAR_FIELD_SECTORS
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.ROOF_SAMPLE_SPACING,
+                self.tr('Distance between sample points on the roofs in metres (sample points only)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.1,
+                defaultValue=ROOF_SAMPLE_SPACING
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.HORIZON_SECTORS,
+                self.tr('Number of horizon angle azimuth sectors'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=8,
+                maxValue=720,
+                defaultValue=HORIZON_SECTORS
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.ADAPTIVE_TOLERANCE,
+                self.tr('Adaptive time sampling tolerance - fraction of pixels whose shadow may change between samples an hour apart (0 = sample every hour)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=0.5,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.ADAPTIVE_FINE_INTERVAL,
+                self.tr('Finest adaptive time sampling interval (minutes)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                maxValue=30,
+                defaultValue=ADAPTIVE_FINE_INTERVAL
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.VALIDATE_ADAPTIVE,
+                                                        self.tr('Report the difference of adaptive time sampling from sampling at every finest interval'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.LOW_SUN_ALTITUDE,
+                self.tr('Cast shadows on a coarser DSM with the sun below this altitude in degrees (0 = never)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=90,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.LOW_SUN_FACTOR,
+                self.tr('Times coarser the DSM for a low sun'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=2,
+                maxValue=32,
+                defaultValue=LOW_SUN_FACTOR
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.VALIDATE_LOW_SUN,
+                                                        self.tr('Report the error the low sun shadows add to each day\'s shadow fraction, by altitude band (casts them at full resolution too)'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.WRITE_SEASONAL_RASTERS,
+                                                        self.tr('Also write the shadow and binary rasters of each seasonal day'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.KEEP_TIMESTEP_SHADOWS,
+                                                        self.tr('Keep the shadow of every time step and write the hourly shade profile of each roof'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.PROCESSES,
+                self.tr('Number of worker processes (0 = one per CPU core)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL_TIMESTEPS,
+                                                        self.tr('Calculate the time steps of the seasonal days in parallel (not with horizon angles, adaptive sampling or kept time step shadows)'),
+                                                        defaultValue=False))
+
 
     def processAlgorithm(self, parameters, context, feedback):
         """
@@ -124,8 +308,30 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
         dsmLayer = self.parameterAsRasterLayer(parameters, self.DSM, context)
         wideAreaHighResLayer = self.parameterAsVectorLayer(parameters, self.WIDE_AREA, context)
         localAreaLayer = self.parameterAsVectorLayer(parameters, self.LOCAL_AREA, context)
+        regionalAreaLayer = self.parameterAsVectorLayer(parameters, self.REGIONAL_AREA, context)
         shadowBinaryFilePath =  dataPath / "SHADOW" / (SHADOW_BINARY_LAYER_NAME + '.tif')
         useWideArea = self.parameterAsBool(parameters, self.CHECKBOX, context)
+        sunPositionTolerance = self.parameterAsDouble(parameters, self.SUN_POSITION_TOLERANCE, context)
+        keepShadowCache = self.parameterAsBool(parameters, self.KEEP_SHADOW_CACHE, context)
+        shadowMethod = SHADOW_METHODS[self.parameterAsEnum(parameters, self.SHADOW_METHOD, context)]
+        shadowEngine = SHADOW_ENGINES[self.parameterAsEnum(parameters, self.SHADOW_ENGINE, context)]
+        wideAreaMethod = WIDE_AREA_METHODS[self.parameterAsEnum(parameters, self.WIDE_AREA_METHOD, context)]
+        farFieldSectors = self.parameterAsInt(parameters, self.FAR_FIELD_SECTORS, context)
+        roofSampleSpacing = self.parameterAsDouble(parameters, self.ROOF_SAMPLE_SPACING, context)
+        horizonSectors = self.parameterAsInt(parameters, self.HORIZON_SECTORS, context)
+        adaptiveTolerance = self.parameterAsDouble(parameters, self.ADAPTIVE_TOLERANCE, context)
+        adaptiveFineInterval = self.parameterAsInt(parameters, self.ADAPTIVE_FINE_INTERVAL, context)
+        validateAdaptive = self.parameterAsBool(parameters, self.VALIDATE_ADAPTIVE, context)
+        lowSunAltitude = self.parameterAsDouble(parameters, self.LOW_SUN_ALTITUDE, context)
+        lowSunFactor = self.parameterAsInt(parameters, self.LOW_SUN_FACTOR, context)
+        validateLowSun = self.parameterAsBool(parameters, self.VALIDATE_LOW_SUN, context)
+        writeSeasonalRasters = self.parameterAsBool(parameters, self.WRITE_SEASONAL_RASTERS, context)
+        keepTimestepShadows = self.parameterAsBool(parameters, self.KEEP_TIMESTEP_SHADOWS, context)
+        processes = self.parameterAsInt(parameters, self.PROCESSES, context)
+        parallelTimesteps = self.parameterAsBool(parameters, self.PARALLEL_TIMESTEPS, context)
+        if keepTimestepShadows and shadowEngine != RASTER_ENGINE:
+            log("The shadows of every time step are only kept when working out the shadows of every pixel")
+            keepTimestepShadows = False
                 
         
         # We just need to pass in a progressBar inside a "dlg" class to the shadowing methods just for consistency - it doesn't seem to do anything
@@ -147,17 +353,45 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
         wideExtent, localExtent = 0,0
         wideAreaDSMLayer=0
         lowResWideAreaRaster=0
-        highResWideLayer, lowResMergedWideLayer = 0, 0
+        highResWideLayer, lowResWideLayer = 0, 0
 
         
         shadowGenerator = ShadowGenerator()
+        shadowGenerator.sunPositionTolerance = sunPositionTolerance
+        if keepShadowCache:
+            shadowGenerator.shadowCacheDirectory = dataPath / CACHE_STRING
+        shadowGenerator.shadowMethod = shadowMethod
+        shadowGenerator.horizonSectors = horizonSectors
+        shadowGenerator.horizonCacheDirectory = dataPath / CACHE_STRING
+        if adaptiveTolerance > 0:
+            shadowGenerator.adaptiveSampling = AdaptiveSampling(adaptiveTolerance, adaptiveFineInterval, validateAdaptive)
+        if keepTimestepShadows:
+            shadowGenerator.timestepCubeDirectory = shadowPath
+        shadowGenerator.lowSunAltitude = lowSunAltitude
+        shadowGenerator.lowSunFactor = lowSunFactor
+        shadowGenerator.validateLowSun = validateLowSun
+        shadowGenerator.parallelTimesteps = parallelTimesteps
+        shadowGenerator.workers = processes
+        shadowGenerator.wideAreaMethod = wideAreaMethod
+        shadowGenerator.farFieldSectors = farFieldSectors
 
         # Load a layer from a file
         dsmClippedFilePath = dataPath / (DSM_1M_CLIPPED_LAYER_NAME + '.tif')
         dsmClippedLayer = QgsProcessingUtils.mapLayerFromString(str(dsmClippedFilePath), context) 
 
         # Set up the wide area parameters, if the checkbox is ticked
-        if useWideArea is True:
+        if useWideArea is True and regionalAreaLayer is not None:
+            # The wide area is cropped from the low resolution DSM of the whole region, which (with its shadows) is
+            # made once and shared by all the local areas of the batch, rather than clipped and resampled each time.
+            # There is no merge of a flat raster over the local area (steps 3 to 5): the generator takes the local area
+            # to be flat at its highest point when it crops the regional shadows (see RegionalShadowCache)
+            sharedCachePath = paths.dataDirectoryPath / CACHE_STRING
+            lowResWideLayer = self.regionalWideAreaLayer(dsmLayer, regionalAreaLayer, sharedCachePath, dataPath, context, feedback)
+            shadowGenerator.regionalWideArea = True
+            shadowGenerator.regionalShadowDirectory = sharedCachePath
+            wideExtent = Extent(wideAreaHighResLayer)
+
+        elif useWideArea is True:
 
             # 1. Clip the DSM by the wide area polygon
             tempResultOutputPath = dataPath / 'wide_area_dsm_clipped.tif'
@@ -190,32 +424,36 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
             lowResWideAreaRaster = results['OUTPUT']
 
 
-            # 3. Find the maximum value of the DSM (local area)
-            provider = dsmClippedLayer.dataProvider()
-            stats = provider.bandStatistics(1, QgsRasterBandStats.All)
-            maximumValueOfLocalAreaDSM = stats.maximumValue
-
-            # 4. Create a raster of constant value:
-            tempResultOutputPath = dataPath / 'constant-raster.tif'
-            parameters = {
-                'EXTENT': localAreaLayer,
-                'PIXEL_SIZE': 10,
-                'NUMBER': maximumValueOfLocalAreaDSM,
-                'TARGET_CRS':'EPSG:27700',
-                'OUTPUT':str(tempResultOutputPath)}
-            results = processing.run('qgis:createconstantrasterlayer',parameters, context=context, feedback=feedback)
-            constantRaster = results['OUTPUT']
-
-            # 5. Merge constant layer over the reduced resolution layer:
-            tempResultOutputPath = dataPath / 'low-res-wide-area-merged.tif'
-            parameters = {
-                'INPUT':[lowResWideAreaRaster, constantRaster],
-                'DATA_TYPE':6, # Float32
-                'OUTPUT':str(tempResultOutputPath)}
-            results = processing.run('gdal:merge',parameters, context=context, feedback=feedback)
-            lowResMergedRaster = results['OUTPUT']
-            lowResMergedWideLayer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context) # Load the layer from the filepath into the context
-            # Note: wideLayer is now a low-resolution merge between the low res raster and the flat constant local region raster
+            if wideAreaMethod == FAR_FIELD_WIDE_AREA:
+                # The far field horizon leaves out the local area itself, so the low res wide area DSM is used as it is
+                lowResWideLayer = QgsProcessingUtils.mapLayerFromString(lowResWideAreaRaster, context)
+            else:
+                # 3. Find the maximum value of the DSM (local area)
+                provider = dsmClippedLayer.dataProvider()
+                stats = provider.bandStatistics(1, QgsRasterBandStats.All)
+                maximumValueOfLocalAreaDSM = stats.maximumValue
+
+                # 4. Create a raster of constant value:
+                tempResultOutputPath = dataPath / 'constant-raster.tif'
+                parameters = {
+                    'EXTENT': localAreaLayer,
+                    'PIXEL_SIZE': 10,
+                    'NUMBER': maximumValueOfLocalAreaDSM,
+                    'TARGET_CRS':'EPSG:27700',
+                    'OUTPUT':str(tempResultOutputPath)}
+                results = processing.run('qgis:createconstantrasterlayer',parameters, context=context, feedback=feedback)
+                constantRaster = results['OUTPUT']
+
+                # 5. Merge constant layer over the reduced resolution layer:
+                tempResultOutputPath = dataPath / 'low-res-wide-area-merged.tif'
+                parameters = {
+                    'INPUT':[lowResWideAreaRaster, constantRaster],
+                    'DATA_TYPE':6, # Float32
+                    'OUTPUT':str(tempResultOutputPath)}
+                results = processing.run('gdal:merge',parameters, context=context, feedback=feedback)
+                lowResMergedRaster = results['OUTPUT']
+                lowResWideLayer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context) # Load the layer from the filepath into the context
+                # Note: wideLayer is now a low-resolution merge between the low res raster and the flat constant local region raster
 
             msg = "dsmClippedLayer is: " + str(dsmClippedLayer.source())
             log(msg)
@@ -231,138 +469,75 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
         log("Local Extent + str(localExtent)")
 
 
-        # March 20th 2020
-        msg = "March 20th 2020"
-        log(msg)
-        dst=0
-        shadowResult = shadowGenerator.calculateShadowRaster(dsmClippedLayer, lowResMergedWideLayer, useWideArea, 
-                                         wideExtent, localExtent, 
-                                         2020, 3, 20, hour, min, sec, UTC, timeInterval, dst, onetime, dlg) # step 65
-
-        array200320, local200320, wide200320 = shadowResult["shfinal"], shadowResult["shlocal"], shadowResult["shwide"] # numpy arrays
-        filepath200320 = shadowPath / '200320-shadow.tif'
-        self.createRasterFromNumpyArray(array200320, -9999, filepath200320, shadowGenerator.geoTransform, shadowGenerator.projection)
-        if(useWideArea and isDebug()):
-            filepathWide200320 = shadowPath / '200320-wide.tif'
-            self.createRasterFromNumpyArray(wide200320, -9999, filepathWide200320, shadowGenerator.geoTransformWide, shadowGenerator.projectionWide)
- 
-        feedback.setProgress(20)
-        msg = "Finished March Raster"
+        # Steps 65 and 66 - the shadow rasters of the four seasonal dates, calculated in one pass
+        # (the DSMs are loaded once and the sun positions of all four days are worked out together)
+        msg = "Calculating shadows for " + ", ".join(name for name, fileLabel, date, threshold in SEASONAL_SHADOW_DATES)
         log(msg)
-        
-        
-        # June 21st 2020 (daylight savings: dst=1)
-        msg = "June 21st 2020"
-        log(msg)
-        dst=1
-        shadowResult = shadowGenerator.calculateShadowRaster(dsmClippedLayer, lowResMergedWideLayer, useWideArea, 
-                                         wideExtent, localExtent, 
-                                         2020, 6, 21, hour, min, sec, UTC, timeInterval, dst, onetime, dlg) # step 66
-
-        array200621, local200621, wide200621 = shadowResult["shfinal"], shadowResult["shlocal"], shadowResult["shwide"] # numpy arrays
-        filepath200621 = shadowPath / '200621-shadow.tif'
-        self.createRasterFromNumpyArray(array200621, -9999, filepath200621, shadowGenerator.geoTransform, shadowGenerator.projection)
-        if(useWideArea and isDebug()):
-            filepathWide200621 = shadowPath / '200621-wide.tif'
-            self.createRasterFromNumpyArray(wide200621, -9999, filepathWide200621, shadowGenerator.geoTransformWide, shadowGenerator.projectionWide)
-        feedback.setProgress(40)
-        msg = "Finished June Raster"
-        log(msg)
-        
-       
-        # Sept 23rd 2020 (daylight savings: dst=1)
-        msg = "Sept 23rd 2020"
-        log(msg)        
-        dst=1
-        shadowResult = shadowGenerator.calculateShadowRaster(dsmClippedLayer, lowResMergedWideLayer, useWideArea, 
-                                         wideExtent, localExtent, 
-                                         2020, 9, 23, hour, min, sec, UTC, timeInterval, dst, onetime, dlg) # step 66
-
-        array200923, local200923, wide200923 = shadowResult["shfinal"], shadowResult["shlocal"], shadowResult["shwide"] # numpy arrays
-        filepath200923 = shadowPath / '200923-shadow.tif'
-        self.createRasterFromNumpyArray(array200923, -9999, filepath200923, shadowGenerator.geoTransform, shadowGenerator.projection)
-        if(useWideArea and isDebug()):
-            filepathWide200923 = shadowPath / '200923-wide.tif'
-            self.createRasterFromNumpyArray(wide200923, -9999, filepathWide200923, shadowGenerator.geoTransformWide, shadowGenerator.projectionWide)
-        feedback.setProgress(60)
-        msg = "Finished September Raster"
-        log(msg)
-
-        # Dec 22nd 2020 
-        msg = "Dec 22nd 2020"
-        log(msg)        
-        dst=0
-        shadowResult = shadowGenerator.calculateShadowRaster(dsmClippedLayer, lowResMergedWideLayer, useWideArea, 
-                                         wideExtent, localExtent, 
-                                         2020, 12, 22, hour, min, sec, UTC, timeInterval, dst, onetime, dlg) # step 66
-
-        array201222, local201222, wide201222 = shadowResult["shfinal"], shadowResult["shlocal"], shadowResult["shwide"] # numpy arrays
-        filepath201222 = shadowPath / '201222-shadow.tif'
-        self.createRasterFromNumpyArray(array201222, -9999, filepath201222, shadowGenerator.geoTransform, shadowGenerator.projection)
-        if(useWideArea and isDebug()):
-            filepathWide201222 = shadowPath / '201222-wide.tif'
-            self.createRasterFromNumpyArray(wide201222 -9999, filepathWide201222, shadowGenerator.geoTransformWide, shadowGenerator.projectionWide)
-        feedback.setProgress(80)
-        msg = "Finished December Raster"
-        log(msg)       
-        
-       
-        # #STEP 70 Reclassification to binary rasters
-        outfilepath200320 = shadowPath / 'March-binary.tif'
-        outfilepath200621 = shadowPath / 'June-binary.tif'
-        outfilepath200923 = shadowPath / 'September-binary.tif'
-        outfilepath201222 = shadowPath / 'December-binary.tif'
-            
-        # Note Bugfix - threshold for March and September is 0.5, for June is 0.6 and for December is 0.4
-        parameters = {
-            'INPUT_RASTER':str(filepath200320),
-            'RASTER_BAND':1,
-            'TABLE':[0,0.5,0,0.5,1,1],
-            'NO_DATA':-9999,
-            'RANGE_BOUNDARIES':0,
-            'NODATA_FOR_MISSING':False,
-            'DATA_TYPE':5,
-            'OUTPUT':str(outfilepath200320)}
-        results = processing.run('native:reclassifybytable',parameters, context=context, feedback=feedback)
-        marchBinary= results['OUTPUT']
-        feedback.setProgress(84)
-
-        parameters['INPUT_RASTER']=str(filepath200923)
-        parameters['OUTPUT']=str(outfilepath200923)
-        results = processing.run('native:reclassifybytable',parameters, context=context, feedback=feedback)
-        septemberBinary= results['OUTPUT']
-        feedback.setProgress(88)
-
-        parameters['INPUT_RASTER']=str(filepath200621)
-        parameters['OUTPUT']=str(outfilepath200621)
-        parameters['TABLE']=[0,0.6,0,0.6,1,1]
-        results = processing.run('native:reclassifybytable',parameters, context=context, feedback=feedback)
-        juneBinary= results['OUTPUT']
-        feedback.setProgress(92)
-
-        parameters['INPUT_RASTER']=str(filepath201222)
-        parameters['OUTPUT']=str(outfilepath201222)
-        parameters['TABLE']=[0,0.4,0,0.4,1,1]
-        results = processing.run('native:reclassifybytable',parameters, context=context, feedback=feedback)
-        decemberBinary= results['OUTPUT']
+        processedRoofPlanesFilePath = dataPath / (PROCESSED_ROOF_PLANES_LAYER_NAME + '.shp')
+        seasonalDates = [date for name, fileLabel, date, threshold in SEASONAL_SHADOW_DATES]
+        receiverMask = None
+        if shadowEngine != RASTER_ENGINE:
+            # Only the roofs are covered by the zonal statistics below, so the other engines only work out their shadows
+            dsmClippedDataset = gdal.Open(str(dsmClippedFilePath))
+            pixelSize = abs(dsmClippedDataset.GetGeoTransform()[1])
+            roofLabels = self.rasteriseFeatureIds(processedRoofPlanesFilePath, dsmClippedDataset.GetGeoTransform(),
+                                                  (dsmClippedDataset.RasterYSize, dsmClippedDataset.RasterXSize))
+            dsmClippedDataset = None
+
+        if shadowEngine == POINT_ENGINE:
+            rows, columns, pointLabels = roofSamplePoints(roofLabels, roofSampleSpacing / pixelSize)
+            pointSunlit = shadowGenerator.calculatePointShadows(dsmClippedLayer, lowResWideLayer, useWideArea,
+                                             wideExtent, localExtent, rows, columns, seasonalDates, UTC, timeInterval, onetime, dlg, feedback)
+            if pointSunlit is None:
+                return {}
+            # Steps 70 to 75 at the sample points - each day made binary, the four multiplied together and averaged over each roof
+            pointBinary = np.prod([seasonalBinary(sunlit, threshold) for sunlit, (name, fileLabel, date, threshold) in zip(pointSunlit, SEASONAL_SHADOW_DATES)], axis=0)
+            processedRoofPlanesLayer = QgsProcessingUtils.mapLayerFromString(str(processedRoofPlanesFilePath), context)
+            featureIds = [feature.id() for feature in processedRoofPlanesLayer.getFeatures()]
+            shadeMeans = labelMeans(pointBinary, pointLabels, max(featureIds, default=-1) + 1)
+            self.writeRoofAttribute(processedRoofPlanesLayer, 'Shade_mean', {featureId: shadeMeans[featureId] for featureId in featureIds})
+            log(f"Written Shade_mean of {len(featureIds)} roofs from {len(rows)} sample points")
+            return {}
+
+        if shadowEngine == RECEIVER_ENGINE:
+            # The roofs are the receivers
+            receiverMask = roofLabels >= 0
+            receiverShadows = shadowGenerator.calculateReceiverShadows(dsmClippedLayer, lowResWideLayer, useWideArea,
+                                             wideExtent, localExtent, receiverMask, seasonalDates, UTC, timeInterval, onetime, dlg, feedback)
+            if receiverShadows is None:
+                return {}
+            receiverShadows.save(shadowPath / 'receiver-shadows.npz')
+            shadowResults = [{'shfinal': receiverShadows.toRaster(sunlit, -9999)} for sunlit in receiverShadows.sunlit]
+        else:
+            shadowResults = shadowGenerator.calculateShadowRasters(dsmClippedLayer, lowResWideLayer, useWideArea,
+                                             wideExtent, localExtent, seasonalDates, UTC, timeInterval, onetime, dlg, feedback)
+        if feedback.isCanceled():
+            return {}
+
+        # Steps 70 to 73 - each day's shadow is made binary (sunlit for more than the day's threshold of the time) and
+        # the four multiplied together, in memory rather than with reclassification and raster calculator layers
+        shadowArrays = [shadowResult["shfinal"] for shadowResult in shadowResults]
+        binaryArrays = [seasonalBinary(shadowArray, threshold) for shadowArray, (name, fileLabel, date, threshold) in zip(shadowArrays, SEASONAL_SHADOW_DATES)]
+        shadowBinaryArray = np.prod(binaryArrays, axis=0)
+        if receiverMask is not None:
+            shadowBinaryArray[~receiverMask] = -9999 # not worked out
+        feedback.setProgress(90)
+
+        # Written once, with the British National Grid CRS and nodata value the old fixLayerCrs step gave it
+        self.createRasterFromNumpyArray(shadowBinaryArray, -9999, shadowBinaryFilePath, shadowGenerator.geoTransform, BRITISH_NATIONAL_GRID.toWkt())
+        shadowBinaryLayer = str(shadowBinaryFilePath)
+
+        if writeSeasonalRasters:
+            for (name, fileLabel, date, threshold), shadowResult, binaryArray in zip(SEASONAL_SHADOW_DATES, shadowResults, binaryArrays):
+                self.createRasterFromNumpyArray(shadowResult["shfinal"], -9999, shadowPath / (fileLabel + '-shadow.tif'), shadowGenerator.geoTransform, shadowGenerator.projection)
+                self.createRasterFromNumpyArray(binaryArray, -9999, shadowPath / (name + '-binary.tif'), shadowGenerator.geoTransform, shadowGenerator.projection)
+                if(useWideArea and isDebug() and shadowEngine == RASTER_ENGINE and wideAreaMethod == MERGED_WIDE_AREA and regionalAreaLayer is None):
+                    filepathWide = shadowPath / (fileLabel + '-wide.tif')
+                    self.createRasterFromNumpyArray(shadowResult["shwide"], -9999, filepathWide, shadowGenerator.geoTransformWide, shadowGenerator.projectionWide)
+                msg = f"Written {name} Rasters"
+                log(msg)
         feedback.setProgress(96)
 
-        # STEP 73 Multiply all binary rasters together to produce the final shadow binary result:
-        parameters = {
-            'INPUT_A' : str(marchBinary),
-            'BAND_A' : 1,
-            'INPUT_B' : str(juneBinary),
-            'BAND_B' : 1,
-            'INPUT_C' : str(septemberBinary),
-            'BAND_C' : 1,
-            'INPUT_D' : str(decemberBinary),
-            'BAND_D' : 1,
-            'FORMULA' : 'A * B * C * D',   
-            'OUTPUT':str(shadowBinaryFilePath)}
-        results = processing.run('gdal:rastercalculator',parameters, context=context, feedback=feedback)
-        shadowBinaryLayer = fixLayerCrs(results['OUTPUT'], shadowBinaryFilePath, context, feedback)
-
-        processedRoofPlanesFilePath = dataPath / (PROCESSED_ROOF_PLANES_LAYER_NAME + '.shp')
         processedRoofPlanesLayer = QgsProcessingUtils.mapLayerFromString(str(processedRoofPlanesFilePath), context) 
 
         # STEP 75 Use zonal stats to calculate mean shade for each roof
@@ -374,6 +549,12 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
             'STATS':[2]}
         results = processing.run("qgis:zonalstatistics", parameters, context=context, feedback=feedback)
 
+        if keepTimestepShadows:
+            hourlyShadeFilePath = shadowPath / (CSV_HOURLY_SHADE_OUTPUT_FILENAME + '.csv')
+            self.writeHourlyShadeProfiles(shadowGenerator.timestepCubes, processedRoofPlanesFilePath, processedRoofPlanesLayer,
+                                          shadowGenerator.geoTransform, hourlyShadeFilePath)
+            log(f"Written hourly shade profiles to {hourlyShadeFilePath}")
+
         # Set output
         
         # results[self.SHADOW_BINARY] = shadowBinaryFilePath 
@@ -391,6 +572,85 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
         return xMin, yMin, xMax, yMax
 
 
+    def writeHourlyShadeProfiles(self, timestepCubes, roofPlanesFilePath, roofPlanesLayer, geoTransform, csvOutputFilePath):
+        """
+        Writes the fraction of each roof sunlit in each hour of each seasonal day to a csv file - a row per roof and day,
+        with the roof's feature id, the day's name and a column per hour (empty for roofs covering no whole pixel).
+        The roofs are rasterised once, by feature id, onto the grid of the shadows.
+        """
+        roofLabels = self.rasteriseFeatureIds(roofPlanesFilePath, geoTransform, timestepCubes[0].shape)
+        featureIds = [feature.id() for feature in roofPlanesLayer.getFeatures()]
+        numberOfLabels = max(max(featureIds, default=-1), int(roofLabels.max())) + 1
+
+        fieldNames = ['fid', 'day'] + [f"sunlit_{hour:02d}" for hour in range(24)]
+        with open(csvOutputFilePath, 'w') as outputFile:
+            outputFile.write(','.join(fieldNames) + '\n')
+            for (name, fileLabel, date, threshold), timestepCube in zip(SEASONAL_SHADOW_DATES, timestepCubes):
+                profiles = hourlyProfiles(timestepCube, roofLabels, numberOfLabels)
+                for featureId in featureIds:
+                    values = ('' if np.isnan(value) else f"{value:.4f}" for value in profiles[featureId])
+                    outputFile.write(','.join([str(featureId), name, *values]) + '\n')
+
+    # The low resolution DSM of a region around a batch of local areas, as in steps 1 and 2 of the wide area. It is kept in
+    # the cache directory, named after the contents of the DSM file and the region's extent, so it is only made once for the
+    # whole batch (and made again if the DSM changes). It counts towards the disk limit of the regional shadows.
+    def regionalWideAreaLayer(self, dsmLayer, regionalAreaLayer, cacheDirectory, dataPath, context, feedback):
+        key = arrayDigest(fileDigest(dsmLayer.source()), regionalAreaLayer.extent().toString(), SCALE_FACTOR)
+        regionalFilePath = cacheDirectory / f"regional-dsm-{key}.tif"
+        if regionalFilePath.exists():
+            markFileUsed(regionalFilePath)
+        else:
+            msg = f"Making the low resolution DSM of the region {regionalAreaLayer.name()}"
+            log(msg)
+            cacheDirectory.mkdir(parents=True, exist_ok=True)
+            tempResultOutputPath = dataPath / 'regional_dsm_clipped.tif'
+            parameters = {
+                'INPUT':dsmLayer,
+                'PROJWIN':regionalAreaLayer,
+                'NODATA':-9999,
+                'OPTIONS':'',
+                'DATA_TYPE':0,
+                '--overwrite': True,
+                'OUTPUT':str(tempResultOutputPath)}
+            results = processing.run('gdal:cliprasterbyextent',parameters, context=context, feedback=feedback)
+            regionalDSMLayer = fixLayerCrs(results['OUTPUT'], dataPath / 'regional_dsm_clipped_crs.tif', context, feedback)
+
+            # Written to a temporary file first, so an interrupted run never leaves a partial DSM for the others to use
+            partialFilePath = cacheDirectory / f"regional-dsm-{key}.partial.tif"
+            parameters = {
+                'INPUT':regionalDSMLayer,
+                'TARGET_CRS':'EPSG:27700',
+                'RESAMPLING':2,  # 2 for cubic method
+                'TARGET_RESOLUTION':SCALE_FACTOR,  # resample up to 10 metres
+                'DATA_TYPE':6, # Float32
+                'OUTPUT':str(partialFilePath)}
+            processing.run('gdal:warpreproject',parameters, context=context, feedback=feedback)
+            os.replace(str(partialFilePath), str(regionalFilePath))
+            limitDirectoryUsage(cacheDirectory, 'regional-*', REGIONAL_SHADOW_CACHE_DISK_MB * 2**20, keep=regionalFilePath)
+        return QgsProcessingUtils.mapLayerFromString(str(regionalFilePath), context)
+
+    # Sets an attribute (added as a double if the layer doesn't have it yet) of the features of a layer, from a dictionary of
+    # values by feature id (NaN for none)
+    def writeRoofAttribute(self, layer, attributeName, valuesByFeatureId):
+        provider = layer.dataProvider()
+        if layer.fields().indexOf(attributeName) < 0:
+            provider.addAttributes([QgsField(attributeName, QVariant.Double)])
+            layer.updateFields()
+        index = layer.fields().indexOf(attributeName)
+        provider.changeAttributeValues({featureId: {index: None if np.isnan(value) else float(value)}
+                                        for featureId, value in valuesByFeatureId.items()})
+
+    # Raster of the feature id of the polygon over each pixel (-1 for none), on the grid given by geoTransform and shape
+    def rasteriseFeatureIds(self, vectorFilePath, geoTransform, shape):
+        rows, cols = shape
+        labelRaster = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Int32)
+        labelRaster.SetGeoTransform(geoTransform)
+        labelRaster.GetRasterBand(1).Fill(-1)
+        layerName = Path(vectorFilePath).stem
+        options = gdal.RasterizeOptions(SQLStatement=f'SELECT FID AS roof_fid FROM "{layerName}"', attribute='roof_fid')
+        gdal.Rasterize(labelRaster, str(vectorFilePath), options=options)
+        return labelRaster.GetRasterBand(1).ReadAsArray()
+
     def createRasterFromNumpyArray(self, sourceNumpyNDArray, noDataValue, filepath, geoTransform, projection):
         cols, rows = sourceNumpyNDArray.shape
         
@@ -399,6 +659,7 @@ class ShadowCalculatorAlgorithmWide(QgsProcessingAlgorithm):
         
         #writing output raster does the magic of converting array into raster!
         outputRaster.GetRasterBand(1).WriteArray( sourceNumpyNDArray ) 
+        outputRaster.GetRasterBand(1).SetNoDataValue(noDataValue)
         outputRaster.SetGeoTransform(geoTransform)
         outputRaster.SetProjection(projection)
         outputRaster.FlushCache()
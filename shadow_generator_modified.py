@@ -25,11 +25,36 @@ from builtins import str
 from builtins import object
 from osgeo import gdal, osr
 import os.path
-from .dailyshading_modified import dailyshading
+from .dailyshading_modified import dailyshading, seasonalShading, parallelSeasonalShading, pointSeasonalShading, castShadow, sampledInterval, sunPositions
+from .sun_shadow_cache import SunShadowCache, SUN_SHADOW_CACHE_MEMORY_MB
+from .horizon_angles import HorizonAngles, HORIZON_SECTORS
+from .shadow_kernels import lineSweepShadow, lineSweepShadowDepth, roofShadowDepth
+from .timestep_shadow_cube import TimestepShadowCube
+from .receiver_shadows import ReceiverShadowStore
+from .low_sun_resolution import LowSunCaster, LOW_SUN_FACTOR
+from .timestep_pool import umepShadow, lineSweepCast
+from .far_field_horizon import FarFieldHorizon, FAR_FIELD_SECTORS
+from .regional_shadow_cache import regionalShadowCacheFor, regionWindow, REGIONAL_SHADOW_CACHE_MEMORY_MB, REGIONAL_SHADOW_CACHE_DISK_MB
 import numpy as np
 import webbrowser
 from .SolarConstants import *
 
+# Methods of working out the shadow for a sun position
+CASTING_METHOD = 'casting' # UMEP's shadow casting sweep for every sun position (the original method)
+HORIZON_METHOD = 'horizon' # per pixel horizon angles worked out once per DSM, then looked up
+LINE_SWEEP_METHOD = 'linesweep' # casting with running maxima along lines towards the sun (see lineSweepShadow)
+SHADOW_METHODS = [CASTING_METHOD, HORIZON_METHOD, LINE_SWEEP_METHOD]
+
+# What the shadows are worked out for
+RASTER_ENGINE = 'raster' # every pixel of the local DSM, using shadowMethod (the original engine)
+RECEIVER_ENGINE = 'receivers' # only the pixels of a receiver mask (e.g. roofs), by marching rays towards the sun
+POINT_ENGINE = 'points' # only sample points (e.g. on roofs), by marching rays towards the sun
+SHADOW_ENGINES = [RASTER_ENGINE, RECEIVER_ENGINE, POINT_ENGINE]
+
+# Ways of working out the shadows of the wide area
+MERGED_WIDE_AREA = 'merged' # shadows cast on the low res wide area DEM every time step (the original method)
+FAR_FIELD_WIDE_AREA = 'farfield' # the far field horizon of the local area, worked out once from the low res wide area DEM
+WIDE_AREA_METHODS = [MERGED_WIDE_AREA, FAR_FIELD_WIDE_AREA]
 
 class ShadowGenerator(object):
     """
@@ -43,7 +68,35 @@ class ShadowGenerator(object):
 
         self.folderPath = 'None'
         self.timeInterval = 30
-        
+        # Shadows are reused for sun positions within this many degrees of one already cast (0 = identical positions only)
+        self.sunPositionTolerance = 0
+        self.shadowCacheMemoryMB = SUN_SHADOW_CACHE_MEMORY_MB
+        self.shadowCacheDirectory = None # if set, shadows that don't fit in memory are kept here
+        self.shadowCaches = {}
+        self.shadowMethod = CASTING_METHOD
+        self.horizonSectors = HORIZON_SECTORS
+        self.horizonCacheDirectory = None # if set, horizon angles are saved here and reused for the same DSM
+        self.horizonAngles = {}
+        self.adaptiveSampling = None # AdaptiveSampling settings to sample each day adaptively rather than every timeInterval
+        self.timestepCubeDirectory = None # if set, calculateShadowRasters keeps the shadow of every time step of each day here
+        self.timestepCubes = [] # the TimestepShadowCube of each day of the last calculateShadowRasters
+        # Local shadows with the sun below this altitude are cast on a DSM lowSunFactor times coarser (0 = never)
+        self.lowSunAltitude = 0
+        self.lowSunFactor = LOW_SUN_FACTOR
+        self.validateLowSun = False # also cast them at full resolution and log the error of each day
+        # Share the time steps of calculateShadowRasters out between this many worker processes (0 = one per CPU core)
+        self.parallelTimesteps = False
+        self.workers = 0
+        self.wideAreaMethod = MERGED_WIDE_AREA
+        self.farFieldSectors = FAR_FIELD_SECTORS
+        # If set, the wide area DSM covers a region shared by several local areas: the part of it covering each
+        # local area's wide extent is used, and its shadows are cast once for each date and time step, kept in a
+        # RegionalShadowCache (and in regionalShadowDirectory, if set) and cropped for each local area
+        self.regionalWideArea = False
+        self.regionalShadowDirectory = None
+        self.regionalShadowCacheMemoryMB = REGIONAL_SHADOW_CACHE_MEMORY_MB
+        self.regionalShadowCacheDiskMB = REGIONAL_SHADOW_CACHE_DISK_MB
+        self.regionalShadowCaches = []
 
     # dsmlayer and dsmWideLayer are clipped versions of the Raster layer
     def calculateShadowRaster(self, dsmlayer, dsmWideLayer, useWideArea, wideExtent, localExtent, year, month, day, hour, minu, sec, UTC, timeInterval, dst, onetime, dlg):
@@ -103,6 +156,264 @@ class ShadowGenerator(object):
         # dst: 0 or 1 depending on whether it's in daylight savings time
         # So the  calculated values are gdal_dsm, lonlat, sizex, sizey - all based on the dsm layer
         """
+        dsm, lowResWideArray, lonlat, scale, scaleWide = self.loadDsms(dsmlayer, dsmWideLayer, useWideArea)
+
+        tv = [year, month, day, hour, minu, sec]
+        # dsm: our layer
+        # lonlat, sizex, sizey: calculated above from the dsm layer
+        # tv: an array of [year, month, day, hour, min, sec]
+        # UTC: UTC offset in hours (0 in our case)
+        # self.timeinterval: time interval in minutes between snapshots
+        # onetime: 0 in our case as we are using intervals and not a single calculation
+        # dlg=null
+        # self.folderpath[0]: path to the output folder
+        # gdal_dsm: dsm read as an array
+        # trans: light transmission (0.03 in our case)
+        # dst: 0 or 1 depending on whether it's in daylight savings time
+        # So the  calculated values are gdal_dsm, lonlat, sizex, sizey - all based on the dsm layer
+        schedule = [(tv, dst)], UTC, sampledInterval(timeInterval, onetime, self.adaptiveSampling), onetime
+        lowResWideArray, wideExtent, wideShadowCaster = self.wideAreaFor(dsm, lowResWideArray, scaleWide, wideExtent, localExtent, useWideArea, dlg,
+                                                                         schedule=schedule)
+        localShadowCaster = self.shadowCasterFor(dsm, scale, dlg, lowSun=True)
+        shadowresult = dailyshading(dsm, lowResWideArray, lonlat, scale, scaleWide, wideExtent, localExtent, tv, UTC, timeInterval, onetime, dlg, dst, useWideArea,
+                                    localShadowCaster, wideShadowCaster, self.adaptiveSampling)
+        self.logShadowCacheUsage()
+        self.logLowSunErrors(dsm, scale, lonlat, dlg, schedule)
+        return shadowresult # dictionary of numpy arrays
+
+    def calculateShadowRasters(self, dsmlayer, dsmWideLayer, useWideArea, wideExtent, localExtent, dates, UTC, timeInterval, onetime, dlg, feedback=None):
+        """
+        Calculates the shadow rasters of several days in one go, as calculateShadowRaster does for one day.
+        The DSMs are read only once and the sun positions of all the days are worked out together.
+
+        Attributes
+        ----------
+            dates : list
+                (year, month, day, dst) for each day, dst being 1 in daylight savings time and 0 otherwise
+            feedback : QgsProcessingFeedback
+                optional - progress is reported from 0 to 80% as each day finishes
+            (the others are as for calculateShadowRaster)
+        Returns
+        -------
+            list of dictionaries of numpy arrays, one per date in the same order (empty if cancelled)
+        If timestepCubeDirectory is set, the shadows of every time step of each day are also kept, in timestepCubes.
+        """
+        dsm, lowResWideArray, lonlat, scale, scaleWide = self.loadDsms(dsmlayer, dsmWideLayer, useWideArea)
+        schedule = seasonalSchedule(dates, UTC, sampledInterval(timeInterval, onetime, self.adaptiveSampling), onetime)
+        lowResWideArray, wideExtent, wideShadowCaster = self.wideAreaFor(dsm, lowResWideArray, scaleWide, wideExtent, localExtent, useWideArea, dlg, feedback, schedule)
+        regionalShadows = useWideArea and self.regionalWideArea and self.wideAreaMethod == MERGED_WIDE_AREA
+        if self.parallelTimesteps:
+            if self.shadowMethod != HORIZON_METHOD and self.adaptiveSampling is None and self.timestepCubeDirectory is None and not regionalShadows:
+                # The workers cast their own wide area shadows, unless there is a far field horizon to hand them
+                shadowResults = self.calculateParallelShadowRasters(dsm, lowResWideArray, lonlat, scale, scaleWide, useWideArea, wideExtent, localExtent,
+                                                                    dates, UTC, timeInterval, onetime, feedback,
+                                                                    wideShadowCaster if self.wideAreaMethod == FAR_FIELD_WIDE_AREA else None)
+                if shadowResults:
+                    self.logLowSunErrors(dsm, scale, lonlat, dlg, schedule)
+                return shadowResults
+            msg = "Parallel time steps are not used with horizon angles, adaptive sampling, kept time step shadows or regional wide area shadows"
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        localShadowCaster = self.shadowCasterFor(dsm, scale, dlg, feedback, lowSun=True)
+        if feedback is not None and feedback.isCanceled():
+            return []
+        self.timestepCubes = self.createTimestepCubes(dsm.shape, dates, timeInterval, onetime)
+        shadowResults = seasonalShading(dsm, lowResWideArray, lonlat, scale, scaleWide, wideExtent, localExtent, dates, UTC, timeInterval, onetime, dlg, useWideArea, feedback,
+                                        localShadowCaster, wideShadowCaster, self.adaptiveSampling, self.timestepCubes or None)
+        self.logShadowCacheUsage()
+        if len(shadowResults) < len(dates):
+            for timestepCube in self.timestepCubes:
+                timestepCube.discard()
+            self.timestepCubes = []
+            return []
+        for timestepCube in self.timestepCubes:
+            timestepCube.complete()
+        self.logLowSunErrors(dsm, scale, lonlat, dlg, schedule)
+        return shadowResults
+
+    # calculateShadowRasters with the time steps shared out between worker processes. Each worker casts its own
+    # shadows with shadowMethod (and lowSunAltitude), so the shadow caches aren't used
+    def calculateParallelShadowRasters(self, dsm, lowResWideArray, lonlat, scale, scaleWide, useWideArea, wideExtent, localExtent,
+                                       dates, UTC, timeInterval, onetime, feedback=None, wideShadowCaster=None):
+        castFunction = lineSweepCast if self.shadowMethod == LINE_SWEEP_METHOD else umepShadow
+        lowSun = (self.lowSunAltitude, self.lowSunFactor) if self.lowSunAltitude > 0 else None
+        return parallelSeasonalShading(dsm, lowResWideArray, lonlat, scale, scaleWide, wideExtent, localExtent, dates, UTC, timeInterval, onetime,
+                                       useWideArea, castFunction, lowSun, self.workers, feedback, wideShadowCaster)
+
+    # A TimestepShadowCube for each date, ready to be written, if timestepCubeDirectory is set
+    def createTimestepCubes(self, shape, dates, timeInterval, onetime):
+        if self.timestepCubeDirectory is None or onetime == 1:
+            return []
+        steps = int(1440 / sampledInterval(timeInterval, onetime, self.adaptiveSampling))
+        timestepCubes = [TimestepShadowCube(Path(self.timestepCubeDirectory) / f"timestep-shadows-{year:04d}-{month:02d}-{day:02d}.npy", shape, steps)
+                         for year, month, day, dst in dates]
+        for timestepCube in timestepCubes:
+            timestepCube.create()
+        return timestepCubes
+
+    def calculateReceiverShadows(self, dsmlayer, dsmWideLayer, useWideArea, wideExtent, localExtent, receiverMask, dates, UTC, timeInterval, onetime, dlg, feedback=None):
+        """
+        As calculateShadowRasters, but working out the shadows only at the pixels of receiverMask (a boolean array the
+        shape of the local DSM, e.g. the rasterised roofs), by marching rays from them towards the sun (as
+        calculatePointShadows), which puts them in shadow exactly where the shadow casting would. The whole local DSM
+        still casts the shadows; the wide area shadows are worked out by wideAreaMethod as usual.
+
+        Returns
+        -------
+            ReceiverShadowStore with the sunlit fraction of each receiver on each date (None if cancelled)
+        """
+        dsm, lowResWideArray, lonlat, scale, scaleWide = self.loadDsms(dsmlayer, dsmWideLayer, useWideArea)
+        receivers = np.flatnonzero(receiverMask)
+        lowResWideArray, wideExtent, wideShadowCaster = self.wideAreaFor(dsm, lowResWideArray, scaleWide, wideExtent, localExtent, useWideArea, dlg, feedback,
+                                                                         seasonalSchedule(dates, UTC, timeInterval, onetime))
+        if feedback is not None and feedback.isCanceled():
+            return None
+        msg = f"Marching rays towards the sun from {len(receivers)} of the {dsm.size} pixels of the DSM"
+        QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        rows, columns = np.unravel_index(receivers, dsm.shape)
+        sunlit = pointSeasonalShading(dsm, lowResWideArray, lonlat, scale, scaleWide, wideExtent, localExtent, rows, columns,
+                                      dates, UTC, timeInterval, onetime, dlg, useWideArea, feedback, wideShadowCaster)
+        self.logShadowCacheUsage()
+        if len(sunlit) < len(dates):
+            return None
+        return ReceiverShadowStore(dsm.shape, receivers, sunlit)
+
+    def calculatePointShadows(self, dsmlayer, dsmWideLayer, useWideArea, wideExtent, localExtent, rows, columns, dates, UTC, timeInterval, onetime, dlg, feedback=None):
+        """
+        As calculateShadowRasters, but working out the shadows only at sample points, by marching rays from each
+        point towards the sun through the local DSM. The wide area shadows are worked out by wideAreaMethod as usual.
+
+        Attributes
+        ----------
+            rows, columns : Numpy Arrays
+                positions of the points in pixels of the local DSM, e.g. from roofSamplePoints
+            (the others are as for calculateShadowRasters)
+        Returns
+        -------
+            list of arrays of the fraction of each date each point is sunlit, one per date (None if cancelled)
+        """
+        dsm, lowResWideArray, lonlat, scale, scaleWide = self.loadDsms(dsmlayer, dsmWideLayer, useWideArea)
+        lowResWideArray, wideExtent, wideShadowCaster = self.wideAreaFor(dsm, lowResWideArray, scaleWide, wideExtent, localExtent, useWideArea, dlg, feedback,
+                                                                         seasonalSchedule(dates, UTC, timeInterval, onetime))
+        if feedback is not None and feedback.isCanceled():
+            return None
+        msg = f"Marching rays towards the sun from {len(rows)} points"
+        QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        sunlit = pointSeasonalShading(dsm, lowResWideArray, lonlat, scale, scaleWide, wideExtent, localExtent, rows, columns,
+                                      dates, UTC, timeInterval, onetime, dlg, useWideArea, feedback, wideShadowCaster)
+        self.logShadowCacheUsage()
+        if len(sunlit) < len(dates):
+            return None
+        return sunlit
+
+    # The wide area shadows (if used), by wideAreaMethod: returns the wide area array and extent to pass on to the
+    # shading functions, and the function giving the wide area shadow raster for a sun position.
+    # With the far field horizon, its one pixel shadow over the local area stands in for the wide area raster.
+    # schedule gives the days shaded, as from seasonalSchedule, for the regional shadows to be kept by date and time step.
+    def wideAreaFor(self, dsm, lowResWideArray, scaleWide, wideExtent, localExtent, useWideArea, dlg, feedback=None, schedule=None):
+        if not useWideArea:
+            return lowResWideArray, wideExtent, None
+        if self.regionalWideArea:
+            window = regionWindow(self.geoTransformWide, lowResWideArray.shape, wideExtent)
+            if not window.inside:
+                msg = "The wide area is not all inside the region, so the shadows of the terrain outside the region are left out"
+                QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Warning)
+            if self.wideAreaMethod == MERGED_WIDE_AREA:
+                return lowResWideArray[window.rows, window.columns], window, self.regionalShadowCasterFor(lowResWideArray, scaleWide, window, localExtent, dsm.max(), schedule)
+            lowResWideArray, wideExtent = lowResWideArray[window.rows, window.columns], window
+        if self.wideAreaMethod == FAR_FIELD_WIDE_AREA:
+            farFieldHorizon = FarFieldHorizon(lowResWideArray, wideExtent, localExtent, dsm.max(), self.farFieldSectors, self.horizonCacheDirectory)
+            msg = f"Far field horizon in {farFieldHorizon.sectors} sectors, highest {farFieldHorizon.angles.max():.2f} degrees"
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+            return np.ones((1, 1)), localExtent, farFieldHorizon.shadow
+        return lowResWideArray, wideExtent, self.shadowCasterFor(lowResWideArray, scaleWide, dlg, feedback)
+
+    # The function giving the wide area shadow raster of a window of the region for a sun position, cropped from the
+    # shadow of the whole region cast for the nearest date and time step of the schedule, with the local area taken to
+    # be flat at localHeight (its highest point) as in the merged wide area DSM. The region is too big for horizon
+    # angles, so its shadows are cast whatever the shadowMethod (with the line sweep if that is the method).
+    def regionalShadowCasterFor(self, regionalArray, scaleWide, window, localExtent, localHeight, schedule):
+        method = LINE_SWEEP_METHOD if self.shadowMethod == LINE_SWEEP_METHOD else CASTING_METHOD
+        regionalCache = regionalShadowCacheFor(regionalArray, self.geoTransformWide, scaleWide, method, self.regionalShadowDirectory,
+                                               self.regionalShadowCacheMemoryMB, self.regionalShadowCacheDiskMB)
+        days, UTC, timeInterval, onetime = schedule
+        for tv, dst in days:
+            altitudes, azimuths = sunPositions(self.lonlatWide, tv, UTC, timeInterval, onetime, dst)
+            minutes = [tv[3] * 60 + tv[4]] if onetime == 1 else (timeInterval * np.arange(len(altitudes))).astype(int)
+            regionalCache.addSteps(f"{tv[0]:04d}{tv[1]:02d}{tv[2]:02d}", minutes, azimuths, altitudes)
+        if method == LINE_SWEEP_METHOD:
+            castRegion = lambda azimuth, altitude: lineSweepShadowDepth(regionalArray, azimuth, altitude, scaleWide)
+        else:
+            castRegion = lambda azimuth, altitude: roofShadowDepth(regionalArray, azimuth, altitude, scaleWide)
+        if regionalCache not in self.regionalShadowCaches:
+            self.regionalShadowCaches.append(regionalCache)
+        localArea = regionWindow(self.geoTransformWide, regionalArray.shape, localExtent)
+        return lambda azimuth, altitude: regionalCache.shadow(azimuth, altitude, castRegion, window, localArea, localHeight)
+
+    # The function giving the shadow raster for a sun position on a DSM, using shadowMethod.
+    # Shadow caches and horizon angles are kept for as long as this generator is,
+    # so later calls with the same DSM reuse the work of earlier ones.
+    # lowSun: cast the shadows of a sun below lowSunAltitude on a coarser DSM (if lowSunAltitude is set)
+    def shadowCasterFor(self, array, scale, dlg, feedback=None, lowSun=False):
+        if self.shadowMethod == HORIZON_METHOD:
+            return self.horizonAnglesFor(array, scale, feedback).shadow
+        castFunction = self.castFunctionFor(dlg)
+        method = self.shadowMethod
+        if lowSun and self.lowSunAltitude > 0:
+            shadowFunction = LowSunCaster(array, scale, castFunction, self.lowSunAltitude, self.lowSunFactor).shadow
+            method += f"-below-{self.lowSunAltitude}-by-{self.lowSunFactor}" # the coarse shadows are kept apart from the others
+        else:
+            shadowFunction = lambda azimuth, altitude: castFunction(array, scale, azimuth, altitude)
+        shadowCache = SunShadowCache(array, scale, self.sunPositionTolerance, self.shadowCacheMemoryMB, self.shadowCacheDirectory, method)
+        shadowCache = self.shadowCaches.setdefault(shadowCache.key, shadowCache)
+        return lambda azimuth, altitude: shadowCache.shadow(azimuth, altitude, shadowFunction)
+
+    # The function casting a shadow with shadowMethod, given (array, scale, azimuth, altitude), for the casting methods
+    def castFunctionFor(self, dlg):
+        if self.shadowMethod == LINE_SWEEP_METHOD:
+            return lambda castArray, castScale, azimuth, altitude: lineSweepShadow(castArray, azimuth, altitude, castScale)
+        return lambda castArray, castScale, azimuth, altitude: castShadow(castArray, azimuth, altitude, castScale, dlg)
+
+    # If validateLowSun is set, logs how much the coarse low sun shadows change the shadow fraction of each day of the
+    # schedule, in altitude bands (see LowSunCaster.describeDayErrors) - casting the day's low sun shadows again
+    def logLowSunErrors(self, dsm, scale, lonlat, dlg, schedule):
+        if not self.validateLowSun or self.lowSunAltitude <= 0 or self.shadowMethod == HORIZON_METHOD:
+            return
+        lowSunCaster = LowSunCaster(dsm, scale, self.castFunctionFor(dlg), self.lowSunAltitude, self.lowSunFactor)
+        days, UTC, timeInterval, onetime = schedule
+        for tv, dst in days:
+            altitudes, azimuths = sunPositions(lonlat, tv, UTC, timeInterval, onetime, dst)
+            msg = f"Low sun shadows cast {lowSunCaster.factor} times coarser below {lowSunCaster.altitude} degrees on {tv[0]:04d}-{tv[1]:02d}-{tv[2]:02d}: "
+            lines = lowSunCaster.describeDayErrors(azimuths, altitudes)
+            msg += "no time steps with a low sun" if not lines else "change in the day's shadow fraction from"
+            for line in lines:
+                msg += "\n" + line
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+
+    def horizonAnglesFor(self, array, scale, feedback=None):
+        horizonAngles = HorizonAngles(array, scale, self.horizonSectors, self.horizonCacheDirectory)
+        horizonAngles = self.horizonAngles.setdefault(horizonAngles.key, horizonAngles)
+        if not horizonAngles.isComplete():
+            msg = f"Calculating horizon angles in {self.horizonSectors} sectors for a {array.shape[1]} x {array.shape[0]} DSM"
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+            horizonAngles.prepare(feedback)
+        return horizonAngles
+
+    # Also saves the shadows of the caches to the cache directory, if there is one
+    def logShadowCacheUsage(self):
+        for shadowCache in self.shadowCaches.values():
+            shadowCache.spillAll()
+            msg = "Shadow cache: " + shadowCache.describeUsage()
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        for regionalCache in self.regionalShadowCaches:
+            regionalCache.writeAll()
+            msg = "Regional shadow cache: " + regionalCache.describeUsage()
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        self.regionalShadowCaches = []
+
+    # Reads the local (and wide area, if used) DSMs into numpy arrays and works out their scales and position.
+    # Also makes the geotransforms and projections available to the outside world.
+    # Returns dsm, lowResWideArray, lonlat, scale, scaleWide
+    def loadDsms(self, dsmlayer, dsmWideLayer, useWideArea):
         provider = dsmlayer.dataProvider()
         filepath_dsm = str(provider.dataSourceUri())
         gdal_dsm = gdal.Open(filepath_dsm)
@@ -132,26 +443,15 @@ class ShadowGenerator(object):
 
             # Make available to the outside world:
             self.geoTransformWide = geoTransformWide
+            self.lonlatWide = lonlatWide
             self.projectionWide = gdal_dsm_wide.GetProjection()
-    
-            
 
+        return dsm, lowResWideArray, lonlat, scale, scaleWide
 
-        tv = [year, month, day, hour, minu, sec]
-        # dsm: our layer
-        # lonlat, sizex, sizey: calculated above from the dsm layer
-        # tv: an array of [year, month, day, hour, min, sec]
-        # UTC: UTC offset in hours (0 in our case)
-        # self.timeinterval: time interval in minutes between snapshots
-        # onetime: 0 in our case as we are using intervals and not a single calculation
-        # dlg=null
-        # self.folderpath[0]: path to the output folder
-        # gdal_dsm: dsm read as an array
-        # trans: light transmission (0.03 in our case)
-        # dst: 0 or 1 depending on whether it's in daylight savings time
-        # So the  calculated values are gdal_dsm, lonlat, sizex, sizey - all based on the dsm layer
-        shadowresult = dailyshading(dsm, lowResWideArray, lonlat, scale, scaleWide, wideExtent, localExtent, tv, UTC, timeInterval, onetime, dlg, dst, useWideArea)
-        return shadowresult # dictionary of numpy arrays
+# The days of a calculation for regionalShadowCasterFor: ([year, month, day, 0, 0, 0], dst) for each of the dates,
+# with the other arguments as they are
+def seasonalSchedule(dates, UTC, timeInterval, onetime):
+    return [([year, month, day, 0, 0, 0], dst) for year, month, day, dst in dates], UTC, timeInterval, onetime
 
 def calculateScaleParameters(gdal_dsm, dsmlayer, dsm):
     nd = gdal_dsm.GetRasterBand(1).GetNoDataValue()
@@ -0,0 +1,294 @@
+"""
+Shadow casting kernels used by the solar and shadow calculations
+Based on some original open source code by Fredrik Lindberg.
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        original copyright   : 2015 by Fredrik Lindberg (fredrikl@gvc.gu.se)
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - these functions are also run in worker processes
+
+import numpy as np
+
+# Where a shadow of the line sweep is within this fraction of the DSM's highest point of the ground, it is worked out
+# again step by step (far more than the rounding errors of the lines)
+LINE_SWEEP_TOLERANCE = 1e-9
+
+
+def roofShadow(a, azimuth, altitude, scale):
+    """
+    Roof and ground shadow for one sun (or sky patch) position.
+    This is the shadow casting part of UMEP's shadowingfunction_wallheight_13 without the wall
+    shadow and wall sun calculations, which the modified SEBE calculation throws away.
+    Returns the same sh array: 1 where the pixel is sunlit, 0 where it is in shadow.
+
+    Attributes
+    ----------
+        a : Numpy Array
+            DSM
+        azimuth : float
+            degrees clockwise from north
+        altitude : float
+            degrees above the horizon
+        scale : float
+            pixels per metre
+    """
+    return roofShadowMask(a, azimuth, altitude, scale).astype(float)
+
+
+def roofShadowMask(a, azimuth, altitude, scale, work=None, out=None):
+    """
+    As roofShadow, but returns a boolean array (True where sunlit) and can reuse arrays between calls
+    so that repeated calls don't allocate any full size arrays.
+
+    Attributes
+    ----------
+        a : Numpy Array
+            DSM
+        azimuth : float
+            degrees clockwise from north
+        altitude : float
+            degrees above the horizon
+        scale : float
+            pixels per metre
+        work : Numpy Array
+            optional array of the same shape and type as a, overwritten with the shadow volume
+        out : Numpy Array
+            optional boolean array of the same shape as a for the result
+    """
+    if work is None:
+        f = np.copy(a)
+    else:
+        f = work
+        np.copyto(f, a)
+
+    amaxvalue = np.max(a)
+    tanaltitudebyscale = np.tan(altitude*np.pi/180.) / scale
+    target = None
+    for distance, source, target in sweepSteps(azimuth, a.shape):
+        dz = distance * tanaltitudebyscale
+        # Only the overlapping part of the shifted DSM can raise the shadow volume, so update that
+        # part of f in place instead of building a full size temporary array every step
+        np.fmax(f[target], a[source] - dz, out=f[target])
+        if dz > amaxvalue:
+            break
+
+    if target is not None:
+        # The original also compares against the zero filled part of its temporary array, which
+        # touches every pixel apart from those inside the final (smallest) shifted part
+        (xp1, xp2), (yp1, yp2) = (target[0].start, target[0].stop), (target[1].start, target[1].stop)
+        for outside in (f[:xp1, :], f[xp2:, :], f[xp1:xp2, :yp1], f[xp1:xp2, yp2:]):
+            np.fmax(outside, 0, out=outside)
+
+    return np.equal(f, a, out=out)
+
+
+def roofShadowDepth(a, azimuth, altitude, scale):
+    """
+    As roofShadowMask, but returns how far (metres) each pixel is below the shadow cast over it - 0 where sunlit.
+    So a pixel would be sunlit at a height h if its depth is no more than h less its height (with the rest of
+    the DSM as it is).
+
+    Attributes
+    ----------
+        a : Numpy Array
+            DSM
+        azimuth : float
+            degrees clockwise from north
+        altitude : float
+            degrees above the horizon
+        scale : float
+            pixels per metre
+    """
+    work = np.empty(a.shape)
+    roofShadowMask(a, azimuth, altitude, scale, work)
+    return np.subtract(work, a, out=work)
+
+
+def sweepSteps(azimuth, shape):
+    """
+    The steps of the shadow casting sweep away from the sun, as in UMEP's shadowing functions.
+    Step i shifts the DSM i pixels along the major axis of the sun direction (and the rounded
+    distance along the other); the sweep ends once the shift reaches the edge of the DSM.
+
+    Attributes
+    ----------
+        azimuth : float
+            degrees clockwise from north
+        shape : tuple
+            shape of the DSM
+    Yields
+    ------
+        distance, source, target
+            horizontal distance of the step in pixels, and the slices of the DSM that are shifted
+            (source) onto the pixels they may shade (target)
+    """
+    degrees = np.pi/180.
+    azimuth = azimuth*degrees
+    sizex = shape[0]
+    sizey = shape[1]
+    dx = 0
+    dy = 0
+    index = 1
+
+    pibyfour = np.pi/4.
+    threetimespibyfour = 3.*pibyfour
+    fivetimespibyfour = 5.*pibyfour
+    seventimespibyfour = 7.*pibyfour
+    sinazimuth = np.sin(azimuth)
+    cosazimuth = np.cos(azimuth)
+    tanazimuth = np.tan(azimuth)
+    signsinazimuth = np.sign(sinazimuth)
+    signcosazimuth = np.sign(cosazimuth)
+    with np.errstate(divide='ignore'):
+        dssin = np.abs((1./sinazimuth))
+        dscos = np.abs((1./cosazimuth))
+
+    while (np.abs(dx) < sizex) and (np.abs(dy) < sizey):
+        if (pibyfour <= azimuth and azimuth < threetimespibyfour) or (fivetimespibyfour <= azimuth and azimuth < seventimespibyfour):
+            dy = signsinazimuth * index
+            dx = -1 * signcosazimuth * np.abs(np.round(index / tanazimuth))
+            ds = dssin
+        else:
+            dy = signsinazimuth * np.abs(np.round(index * tanazimuth))
+            dx = -1 * signcosazimuth * index
+            ds = dscos
+
+        absdx = np.abs(dx)
+        absdy = np.abs(dy)
+
+        xc1 = int((dx + absdx) / 2)
+        xc2 = int(sizex + (dx - absdx) / 2)
+        yc1 = int((dy + absdy) / 2)
+        yc2 = int(sizey + (dy - absdy) / 2)
+        xp1 = int(-((dx - absdx) / 2))
+        xp2 = int(sizex - (dx + absdx) / 2)
+        yp1 = int(-((dy - absdy) / 2))
+        yp2 = int(sizey - (dy + absdy) / 2)
+
+        yield ds * index, (slice(xc1, xc2), slice(yc1, yc2)), (slice(xp1, xp2), slice(yp1, yp2))
+        index = index + 1
+
+
+def lineSweepShadow(a, azimuth, altitude, scale):
+    """
+    As roofShadow, with the same shadows, but with less of the sweep. The steps of the sweep (sweepSteps) repeat:
+    after some number of steps, the period, the next steps are those from the start shifted by the step at the
+    period. So the shadow the DSM casts along each line of period steps is worked out first, as a running maximum
+    in a single pass along the lines, and only the first period steps of the sweep are then made, on the line
+    shadows rather than the DSM. With the sun along the rows, columns or diagonals the period is one step;
+    elsewhere it is a few tens to a few hundred steps, fewer than the sweep makes with a low sun (where this is
+    up to about 20 times faster).
+    Steps further than the sweep's last are left out of the sweep but not the lines - their shadows fall below
+    the ground, as long as it has no negative heights (otherwise this falls back to the sweep). Shadows within
+    rounding error of the ground are worked out again step by step, so the shadows are exactly roofShadowMask's.
+
+    Attributes
+    ----------
+        a : Numpy Array
+            DSM
+        azimuth : float
+            degrees clockwise from north
+        altitude : float
+            degrees above the horizon
+        scale : float
+            pixels per metre
+    """
+    return lineSweepShadowMask(a, azimuth, altitude, scale).astype(float)
+
+
+def lineSweepShadowMask(a, azimuth, altitude, scale):
+    """
+    As lineSweepShadow, but returns a boolean array (True where sunlit), as roofShadowMask
+    """
+    if a.size == 0 or not a.min() >= 0:
+        return roofShadowMask(a, azimuth, altitude, scale)
+    return np.equal(lineSweep(a, azimuth, altitude, scale), a)
+
+
+def lineSweepShadowDepth(a, azimuth, altitude, scale):
+    """
+    As roofShadowDepth, worked out as lineSweepShadow
+    """
+    if a.size == 0 or not a.min() >= 0:
+        return roofShadowDepth(a, azimuth, altitude, scale)
+    shadowHeight = lineSweep(a, azimuth, altitude, scale)
+    return np.subtract(shadowHeight, a, out=shadowHeight)
+
+
+# The height of the shadow over each pixel of a DSM with no negative heights (the shadow volume of roofShadowMask),
+# as lineSweepShadow
+def lineSweep(a, azimuth, altitude, scale):
+    amaxvalue = np.max(a)
+    tanaltitudebyscale = np.tan(altitude*np.pi/180.) / scale
+    steps = []
+    for distance, source, target in sweepSteps(azimuth, a.shape):
+        steps.append((distance * tanaltitudebyscale, source, target))
+        if steps[-1][0] > amaxvalue:
+            break
+
+    # Offset (rows, columns) of the pixel casting onto each pixel at each step, from the start of the step's slices
+    offsets = np.array([(0, 0)] + [(source[0].start - target[0].start, source[1].start - target[1].start)
+                                   for dz, source, target in steps])
+    period = len(steps)
+    for candidate in range(1, len(steps)):
+        if np.array_equal(offsets[candidate:], offsets[:len(offsets) - candidate] + offsets[candidate]):
+            period = candidate
+            break
+
+    lines = np.array(a, dtype=float)
+    if period < len(steps):
+        # Running maximum of the shadow cast along each line, from the far end: the shadow of the pixels one period
+        # further on, lowered by the fall of a period, or the pixel itself
+        dz, source, target = steps[period - 1]
+        rowOffset, columnOffset = offsets[period]
+        byRows = abs(rowOffset) >= abs(columnOffset)
+        turnedLines = lines if byRows else lines.T
+        majorOffset, minorOffset = (rowOffset, columnOffset) if byRows else (columnOffset, rowOffset)
+        minorSource, minorTarget = (source[1], target[1]) if byRows else (source[0], target[0])
+        majorLength = turnedLines.shape[0]
+        order = range(majorLength - 1 - majorOffset, -1, -1) if majorOffset > 0 else range(-majorOffset, majorLength)
+        for major in order:
+            row = turnedLines[major]
+            np.fmax(row[minorTarget], turnedLines[major + majorOffset][minorSource] - dz, out=row[minorTarget])
+
+    # The highest shadow cast on each pixel (-inf where none is)
+    shadowHeight = np.full(a.shape, -np.inf)
+    for dz, source, target in steps[:period]:
+        np.fmax(shadowHeight[target], lines[source] - dz, out=shadowHeight[target])
+
+    # The fall along a line is added up a period at a time rather than worked out for each step as the sweep does,
+    # so the shadows can differ by rounding errors. Where they could make a pixel sunlit rather than shaded (with a
+    # shadow level with the ground, e.g. buildings of whole metres with the sun at 45 degrees), the shadow is worked
+    # out again as the sweep would
+    if period < len(steps):
+        rows, columns = np.nonzero(np.abs(shadowHeight - a) <= LINE_SWEEP_TOLERANCE * (amaxvalue + 1.))
+        exact = np.full(len(rows), -np.inf)
+        for (dz, source, target), (rowOffset, columnOffset) in zip(steps, offsets[1:]):
+            inside = np.flatnonzero((target[0].start <= rows) & (rows < target[0].stop)
+                                    & (target[1].start <= columns) & (columns < target[1].stop))
+            exact[inside] = np.fmax(exact[inside], a[rows[inside] + rowOffset, columns[inside] + columnOffset] - dz)
+        shadowHeight[rows, columns] = exact
+    return np.fmax(shadowHeight, a, out=shadowHeight)
+
+
+# The local window of a low resolution wide area raster at full resolution, as
+# zoomResolutionArray(array, ...)[ymin:ymax, xmin:xmax] but without zooming the whole wide area
+# (see wideAreaWindowIndices in dailyshading_modified).
+# out is reused between time steps if given (pass None the first time).
+def compositeWideAreaWindow(array, rowIndices, columnIndices, out=None):
+    rows = np.take(array, rowIndices, axis=0)
+    if out is None:
+        out = np.empty((len(rowIndices), len(columnIndices)), dtype=array.dtype)
+    return np.take(rows, columnIndices, axis=1, out=out)
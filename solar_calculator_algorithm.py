@@ -38,13 +38,18 @@ from qgis.core import *
 
 from UMEP.WallHeight import wallalgorithms
 from .WallworkerModified import Worker as WallWorker
+from .WallworkerModified import WALL_ASPECT_METHODS, FILTER_METHOD, GRADIENT_METHOD, compareWallAspects
+from .wall_tiling import WallTiler
 from .SolarConstants  import *
 from osgeo import gdal
 import numpy as np
 from pathlib import Path # Post python 3.4
 from .metdata_processor_modified import MetdataProcessor # TODO move file here
 from .sebe_modified import SEBE  as sebe # TODO move file here
+from .sebe_modified import RADIATION_CACHE_LOCATION_DECIMALS, RADIATION_CACHE_ALTITUDE_STEP
 from .sebeworker_modified import Worker as SebeWorker
+from .patch_shadow_cache import PatchShadowCache
+from .memory_usage import describePeakMemoryUsage
 from .SolarDirectoryPaths import SolarDirectoryPaths
 
 
@@ -65,6 +70,17 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
     # calling from the QGIS console.
     METEOROLOGICAL_RAW="METEOROLOGICAL_DATA_FILE"
     DATA_DIRECTORY = "DATA_DIRECTORY"   
+    WALL_ASPECT_METHOD = "WALL_ASPECT_METHOD"
+    COMPARE_WALL_ASPECT = "COMPARE_WALL_ASPECT"
+    WALL_TILE_SIZE = "WALL_TILE_SIZE"
+    PROCESSES = "PROCESSES"
+    PARALLEL_SKY_VAULT = "PARALLEL_SKY_VAULT"
+    CACHE_PATCH_SHADOWS = "CACHE_PATCH_SHADOWS"
+    CACHE_SKY_RADIATION = "CACHE_SKY_RADIATION"
+    SKY_PATCH_ERROR_BUDGET = "SKY_PATCH_ERROR_BUDGET"
+    CALCULATE_MONTHLY = "CALCULATE_MONTHLY"
+    LOW_MEMORY = "LOW_MEMORY"
+    SINGLE_PRECISION = "SINGLE_PRECISION"
  
     def initAlgorithm(self, config):
         """
@@ -85,6 +101,69 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
                 extension="epw"
         ))
 
+        # Order must match WALL_ASPECT_METHODS
+        self.addParameter(QgsProcessingParameterEnum(
+                self.WALL_ASPECT_METHOD,
+                self.tr('Wall aspect method'),
+                options=[self.tr('Rotating filter (original)'), self.tr('Gradient (fast, approximate)')],
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.COMPARE_WALL_ASPECT,
+                                                        self.tr('Report wall aspect accuracy of the gradient method against the filter method'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.WALL_TILE_SIZE,
+                self.tr('Tile size in pixels for the wall height and aspect calculation (0 = no tiling)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.PROCESSES,
+                self.tr('Number of worker processes (0 = one per CPU core)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL_SKY_VAULT,
+                                                        self.tr('Calculate the sky patches of the solar energy raster in parallel'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.CACHE_PATCH_SHADOWS,
+                                                        self.tr('Cache the sky patch shadows so that reruns with other meteorological data skip shadow casting'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.CACHE_SKY_RADIATION,
+                                                        self.tr('Cache the sky radiation matrices, shared by all areas using the same meteorological data '
+                                                                f'(the radiation is then calculated for the location rounded to {RADIATION_CACHE_LOCATION_DECIMALS} '
+                                                                f'decimal places of a degree and {RADIATION_CACHE_ALTITUDE_STEP} m of altitude)'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterNumber(
+                self.SKY_PATCH_ERROR_BUDGET,
+                self.tr('Share of the unshaded annual energy that may be merged from the weakest sky patches into their nearest calculated patch (0 = calculate all patches)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=0.5,
+                defaultValue=0
+        ))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.CALCULATE_MONTHLY,
+                                                        self.tr('Also calculate monthly solar energy (12 band raster)'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.LOW_MEMORY,
+                                                        self.tr('Low memory solar energy calculation (in place, runs in a single process)'),
+                                                        defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.SINGLE_PRECISION,
+                                                        self.tr('Use single precision for the low memory solar energy calculation'),
+                                                        defaultValue=False))
+
 
     def calculateWallHeightParameters(self, dsmlayer):
         provider = dsmlayer.dataProvider()
@@ -96,6 +175,14 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
         self.projection = self.gdal_dsm.GetProjection()
         
 
+    # The low memory calculation runs in a single process, so it can't also calculate the sky patches in parallel
+    def checkParameterValues(self, parameters, context):
+        if self.parameterAsBool(parameters, self.LOW_MEMORY, context) and self.parameterAsBool(parameters, self.PARALLEL_SKY_VAULT, context):
+            return False, self.tr('The low memory solar energy calculation runs in a single process - '
+                                  'choose either it or calculating the sky patches in parallel')
+        return super().checkParameterValues(parameters, context)
+
+
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
@@ -106,6 +193,18 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
         dataPath.mkdir(parents=True, exist_ok=True)
         solarRasterFilePath = dataPath / 'annual-solar-energy.tif'
         meteorologicalDataRawFilePath = self.parameterAsFile(parameters, self.METEOROLOGICAL_RAW, context)
+        wallAspectMethod = WALL_ASPECT_METHODS[self.parameterAsEnum(parameters, self.WALL_ASPECT_METHOD, context)]
+        compareWallAspect = self.parameterAsBool(parameters, self.COMPARE_WALL_ASPECT, context)
+        wallTileSize = self.parameterAsInt(parameters, self.WALL_TILE_SIZE, context)
+        processes = self.parameterAsInt(parameters, self.PROCESSES, context)
+        parallelSkyVault = self.parameterAsBool(parameters, self.PARALLEL_SKY_VAULT, context)
+        cachePatchShadows = self.parameterAsBool(parameters, self.CACHE_PATCH_SHADOWS, context)
+        cacheSkyRadiation = self.parameterAsBool(parameters, self.CACHE_SKY_RADIATION, context)
+        skyPatchErrorBudget = self.parameterAsDouble(parameters, self.SKY_PATCH_ERROR_BUDGET, context)
+        calculateMonthly = self.parameterAsBool(parameters, self.CALCULATE_MONTHLY, context)
+        monthlySolarRasterFilePath = dataPath / 'monthly-solar-energy.tif'
+        lowMemory = self.parameterAsBool(parameters, self.LOW_MEMORY, context)
+        singlePrecision = self.parameterAsBool(parameters, self.SINGLE_PRECISION, context)
         
         results = {}
 
@@ -126,10 +225,18 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
         dsmMinusDtmClippedLayer = QgsProcessingUtils.mapLayerFromString(str(dsmMinusDtmFilePath), context) 
 
         self.calculateWallHeightParameters(dsmMinusDtmClippedLayer)
-        wallHeightArray = wallalgorithms.findwalls(self.dsm, WALL_LIMIT)
+        if wallTileSize > 0:
+            # Split into overlapping tiles and calculate them in parallel - gives exactly the same result
+            tiler = WallTiler(self.dsm, self.scale, WALL_LIMIT, feedback, wallAspectMethod, wallTileSize, processes)
+            wallHeightArray, wallAspectArray = tiler.run()
+        else:
+            wallHeightArray = wallalgorithms.findwalls(self.dsm, WALL_LIMIT)
  
-        worker = WallWorker(wallHeightArray, self.scale, self.dsm, feedback)
-        wallAspectArray = worker.run()
+            worker = WallWorker(wallHeightArray, self.scale, self.dsm, feedback, wallAspectMethod)
+            wallAspectArray = worker.run()
+
+        if compareWallAspect:
+            self.reportWallAspectAccuracy(wallHeightArray, wallAspectArray, wallAspectMethod, feedback)
         # TODO replace -9999 with constant
 
         
@@ -151,14 +258,40 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
         dsmFilePath = dataPath / (DSM_1M_CLIPPED_LAYER_NAME + '.tif')
         dsmLayer = QgsProcessingUtils.mapLayerFromString(str(dsmFilePath), context) 
 
-        building_slope, building_aspect, scale, voxelheight, sizey, sizex, radmatI, radmatD, radmatR, calc_month, dsmArray = solarEnergyCalculator.calculateSebeParameters(dsmLayer, UTC_OFFSET, ALBEDO)
+        # The sky radiation cache is shared by all the areas, so it lives in the top level data directory
+        skyRadiationCacheDirectory = paths.dataDirectoryPath / CACHE_STRING if cacheSkyRadiation else None
+        building_slope, building_aspect, scale, voxelheight, sizey, sizex, radmatI, radmatD, radmatR, calc_month, dsmArray = solarEnergyCalculator.calculateSebeParameters(dsmLayer, UTC_OFFSET, ALBEDO, calculateMonthly, skyRadiationCacheDirectory)
 
         msg = "(81c) - starting the final solar roof calculation"
         QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
 
-        sebeWorker = SebeWorker(dsmArray, scale, building_slope,building_aspect, voxelheight, sizey, sizex, wallHeightArray, wallAspectArray, ALBEDO, PSI, radmatI, radmatD, radmatR, calc_month, feedback)
+        shadowCache = None
+        if cachePatchShadows:
+            # The patch shadows only depend on the DSM, so they can be reused whatever the weather file
+            shadowCache = PatchShadowCache(dataPath / CACHE_STRING, dsmArray, scale, radmatI[:, 0:2])
+            if shadowCache.isComplete():
+                shadowCache.markUsed()
+                msg = "(81c) - using cached sky patch shadows"
+                QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+
+        sebeWorker = SebeWorker(dsmArray, scale, building_slope,building_aspect, voxelheight, sizey, sizex, wallHeightArray, wallAspectArray, ALBEDO, PSI, radmatI, radmatD, radmatR, calc_month, feedback,
+                                parallel=parallelSkyVault, processes=processes, shadowCache=shadowCache,
+                                patchErrorBudget=skyPatchErrorBudget,
+                                monthlyRadiationMatrices=solarEnergyCalculator.monthlyRadiationMatrices,
+                                lowMemory=lowMemory, singlePrecision=singlePrecision)
         solarEnergyArray = sebeWorker.run()
+        msg = f"(81c) - solar roof calculation finished, {describePeakMemoryUsage()}"
+        QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        if skyPatchErrorBudget > 0:
+            skippedPatches = sorted(set(range(radmatI.shape[0])) - set(sebeWorker.patches.tolist()))
+            msg = (f"(81c) - calculated {len(sebeWorker.patches)} of {radmatI.shape[0]} sky patches, "
+                   f"{sebeWorker.patchEnergyMoved:.2%} of the unshaded annual energy merged from the skipped patches into their nearest calculated patch; "
+                   f"skipped patches {skippedPatches}")
+            QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
         solarEnergyRaster=self.createRasterFromNumpyArray(solarEnergyArray, -9999, solarRasterFilePath)
+        if sebeWorker.Energymonthroof is not None:
+            # One band per month, January first
+            self.createRasterFromNumpyArray(sebeWorker.Energymonthroof, -9999, monthlySolarRasterFilePath)
         
         msg = "Step 81 completed successfully - see the layers panel for results"
         QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
@@ -179,17 +312,37 @@ class SolarCalculatorAlgorithm(QgsProcessingAlgorithm):
       
         return results # Include the raster layers for wall aspect and wall height here
     
+    # Logs how closely the gradient wall aspect method agrees with the filter method for this area,
+    # calculating whichever of the two wasn't used for the main calculation
+    def reportWallAspectAccuracy(self, wallHeightArray, wallAspectArray, wallAspectMethod, feedback):
+        otherMethod = FILTER_METHOD if wallAspectMethod == GRADIENT_METHOD else GRADIENT_METHOD
+        otherWallAspectArray = WallWorker(np.copy(wallHeightArray), self.scale, self.dsm, feedback, otherMethod).run()
+        if wallAspectMethod == FILTER_METHOD:
+            report = compareWallAspects(wallAspectArray, otherWallAspectArray, wallHeightArray)
+        else:
+            report = compareWallAspects(otherWallAspectArray, wallAspectArray, wallHeightArray)
+        msg = (f"Wall aspect accuracy (gradient against filter method) over {report['wallPixels']} wall pixels: "
+               f"mean difference {report['meanDifference']:.1f} degrees, median {report['medianDifference']:.1f}, "
+               f"90th percentile {report['percentile90Difference']:.1f}; "
+               f"within 5 degrees {report['within5Degrees']:.0%}, within 15 degrees {report['within15Degrees']:.0%}, "
+               f"within 45 degrees {report['within45Degrees']:.0%}")
+        QgsMessageLog.logMessage(msg, CAFS_OUTPUT_LOG_NAME, level=Qgis.Info)
+        return report
+
     # Create a raster from the numpy array by writing the data out to a file
     # I cannot find any other method of doing this!
+    # A 3 dimensional array (bands, rows, cols) gives a multi-band raster
     def createRasterFromNumpyArray(self, sourceNumpyNDArray, noDataValue, filepath):
+        bands = sourceNumpyNDArray.reshape((-1,) + sourceNumpyNDArray.shape[-2:])
         # Construct a file path to the temporary file in the data directory:
-        cols, rows = sourceNumpyNDArray.shape
+        cols, rows = bands.shape[1:]
         
         # Open up the raster file
-        outputRaster = gdal.GetDriverByName('GTiff').Create(str(filepath),rows, cols, int(1) ,gdal.GDT_Float32)
+        outputRaster = gdal.GetDriverByName('GTiff').Create(str(filepath),rows, cols, bands.shape[0] ,gdal.GDT_Float32)
 
         #writing output raster does the magic of converting array into raster!
-        outputRaster.GetRasterBand(1).WriteArray( sourceNumpyNDArray ) 
+        for band in range(bands.shape[0]):
+            outputRaster.GetRasterBand(band + 1).WriteArray( bands[band] ) 
         outputRaster.SetGeoTransform(self.geoTransform)
         outputRaster.SetProjection(self.projection)
         outputRaster.FlushCache()
@@ -0,0 +1,205 @@
+"""
+Vectorised sun positions for many times at once
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+from functools import lru_cache
+import numpy as np
+
+# Resolution of the cached table of sun positions for a whole year
+EPHEMERIS_STEP_MINUTES = 1
+# Number of location/year tables kept in memory (each is about 8MB at one minute steps)
+EPHEMERIS_CACHE_SIZE = 8
+# Locations are rounded to this many decimal places of a degree (about 10m) before caching
+EPHEMERIS_LOCATION_DECIMALS = 4
+
+
+def sunPositionsAt(timestamps, longitude, latitude):
+    """
+    Sun azimuth and apparent altitude (including atmospheric refraction) at each timestamp.
+    Timestamps that fall on whole minutes are looked up in a table for the whole year, which is
+    cached per location and year; any others are calculated directly.
+
+    Attributes
+    ----------
+        timestamps : Numpy Array
+            UTC times, as numpy datetime64 values
+        longitude : float
+            degrees east
+        latitude : float
+            degrees north
+    Returns
+    -------
+        azimuth, altitude : Numpy Arrays
+            degrees clockwise from north and degrees above the horizon
+    """
+    timestamps = np.asarray(timestamps, dtype='datetime64[s]')
+    longitude = round(float(longitude), EPHEMERIS_LOCATION_DECIMALS)
+    latitude = round(float(latitude), EPHEMERIS_LOCATION_DECIMALS)
+    years = timestamps.astype('datetime64[Y]')
+    stepsIntoYear = (timestamps - years).astype('timedelta64[s]').astype(np.int64) / (60. * EPHEMERIS_STEP_MINUTES)
+    if timestamps.size == 0 or np.any(stepsIntoYear != np.floor(stepsIntoYear)):
+        return noaaSunPosition(timestamps, longitude, latitude)
+
+    azimuth = np.empty(timestamps.shape)
+    altitude = np.empty(timestamps.shape)
+    stepsIntoYear = stepsIntoYear.astype(np.int64)
+    for year in np.unique(years):
+        inYear = years == year
+        yearAzimuth, yearAltitude = ephemerisForYear(longitude, latitude, int(year.astype(int)) + 1970)
+        azimuth[inYear] = yearAzimuth[stepsIntoYear[inYear]]
+        altitude[inYear] = yearAltitude[stepsIntoYear[inYear]]
+    return azimuth, altitude
+
+
+# Indices of the times at which the sun is above the horizon
+def aboveHorizon(altitude):
+    return np.flatnonzero(altitude > 0)
+
+
+# Sun azimuth and altitude at every step of a year (UTC), for sunPositionsAt to look up.
+# The arrays are shared between callers so are made read only.
+@lru_cache(maxsize=EPHEMERIS_CACHE_SIZE)
+def ephemerisForYear(longitude, latitude, year):
+    start = np.datetime64(str(year), 'm')
+    end = np.datetime64(str(year + 1), 'm')
+    timestamps = np.arange(start, end, np.timedelta64(EPHEMERIS_STEP_MINUTES, 'm'))
+    azimuth, altitude = noaaSunPosition(timestamps, longitude, latitude)
+    azimuth.setflags(write=False)
+    altitude.setflags(write=False)
+    return azimuth, altitude
+
+
+def noaaSunPosition(timestamps, longitude, latitude):
+    """
+    Sun azimuth and apparent altitude using the NOAA solar calculator equations (after Meeus,
+    Astronomical Algorithms), accurate to about 0.01 degrees between 1800 and 2100, with the
+    NOAA approximation to atmospheric refraction.
+
+    Attributes
+    ----------
+        timestamps : Numpy Array
+            UTC times, as numpy datetime64 values
+        longitude : float
+            degrees east
+        latitude : float
+            degrees north
+    Returns
+    -------
+        azimuth, altitude : Numpy Arrays
+            degrees clockwise from north and degrees above the horizon
+    """
+    seconds = np.asarray(timestamps, dtype='datetime64[s]').astype(np.int64).astype(float)
+    julianDay = seconds / 86400. + 2440587.5
+    julianCentury = (julianDay - 2451545.) / 36525.
+    minutesOfDay = np.mod(seconds, 86400.) / 60.
+
+    meanLongitude = np.mod(280.46646 + julianCentury * (36000.76983 + julianCentury * 0.0003032), 360.)
+    meanAnomaly = np.radians(357.52911 + julianCentury * (35999.05029 - 0.0001537 * julianCentury))
+    eccentricity = 0.016708634 - julianCentury * (0.000042037 + 0.0000001267 * julianCentury)
+    equationOfCentre = (np.sin(meanAnomaly) * (1.914602 - julianCentury * (0.004817 + 0.000014 * julianCentury))
+                        + np.sin(2 * meanAnomaly) * (0.019993 - 0.000101 * julianCentury)
+                        + np.sin(3 * meanAnomaly) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * julianCentury)
+    apparentLongitude = np.radians(meanLongitude + equationOfCentre - 0.00569 - 0.00478 * np.sin(omega))
+    meanObliquity = 23. + (26. + (21.448 - julianCentury * (46.815 + julianCentury * (0.00059 - julianCentury * 0.001813))) / 60.) / 60.
+    obliquity = np.radians(meanObliquity + 0.00256 * np.cos(omega))
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparentLongitude))
+
+    y = np.tan(obliquity / 2) ** 2
+    meanLongitudeRadians = np.radians(meanLongitude)
+    equationOfTime = 4 * np.degrees(y * np.sin(2 * meanLongitudeRadians)
+                                    - 2 * eccentricity * np.sin(meanAnomaly)
+                                    + 4 * eccentricity * y * np.sin(meanAnomaly) * np.cos(2 * meanLongitudeRadians)
+                                    - 0.5 * y * y * np.sin(4 * meanLongitudeRadians)
+                                    - 1.25 * eccentricity * eccentricity * np.sin(2 * meanAnomaly)) # minutes
+
+    trueSolarTime = np.mod(minutesOfDay + equationOfTime + 4 * longitude, 1440.)
+    hourAngle = np.radians(trueSolarTime / 4. - 180.)
+    latitudeRadians = np.radians(latitude)
+
+    cosZenith = np.clip(np.sin(latitudeRadians) * np.sin(declination)
+                        + np.cos(latitudeRadians) * np.cos(declination) * np.cos(hourAngle), -1., 1.)
+    altitude = 90. - np.degrees(np.arccos(cosZenith))
+    azimuth = np.mod(np.degrees(np.arctan2(np.sin(hourAngle),
+                                           np.cos(hourAngle) * np.sin(latitudeRadians) - np.tan(declination) * np.cos(latitudeRadians))) + 180., 360.)
+    return azimuth, altitude + atmosphericRefraction(altitude)
+
+
+# NOAA approximation to the refraction (in degrees) at a true altitude (in degrees)
+def atmosphericRefraction(altitude):
+    tanAltitude = np.tan(np.radians(altitude))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arcseconds = np.where(altitude > 5.,
+                              58.1 / tanAltitude - 0.07 / tanAltitude ** 3 + 0.000086 / tanAltitude ** 5,
+                              np.where(altitude > -0.575,
+                                       1735. + altitude * (-518.2 + altitude * (103.4 + altitude * (-12.79 + altitude * 0.711))),
+                                       -20.772 / tanAltitude))
+    return np.where(altitude > 85., 0., arcseconds / 3600.)
+
+
+# UTC timestamps (numpy datetime64) for times given in local time with a UTC offset in hours
+def utcTimestamps(year, dayOfYear, hour, minute, UTC=0):
+    days = (np.asarray(year, dtype=np.int64) - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (np.asarray(dayOfYear, dtype=np.int64) - 1)
+    minutes = np.round((np.asarray(hour, dtype=float) - UTC) * 60. + np.asarray(minute, dtype=float)).astype(np.int64)
+    return days.astype('datetime64[m]') + minutes.astype('timedelta64[m]')
+
+
+def metdataSolarGeometry(metdata, location, UTC):
+    """
+    Vectorised equivalent of UMEP's Solweig_2015a_metdata_noload: the solar geometry of each row of
+    meteorological data in the UMEP format (year, day of year, hour, minute, ...), with the sun positions
+    taken from sunPositionsAt rather than one sun_position call per row.
+    As in the original, each sun position is taken half a time step before the row's time, and the maximum
+    altitude of each day is found on a 15 minute grid from 10:15.
+
+    Returns
+    -------
+        YYYY, altitude, azimuth, zen, jday, leafon, dectime, altmax
+            as Solweig_2015a_metdata_noload - all but dectime are 1 x rows arrays, and zen is in radians
+    """
+    rows = metdata.shape[0]
+    years = metdata[:, 0].astype(np.int64)
+    daysOfYear = metdata[:, 1].astype(np.int64)
+    dectime = metdata[:, 1] + metdata[:, 2] / 24 + metdata[:, 3] / (60 * 24.)
+    halfTimeStepMinutes = 0. if rows == 1 else (dectime[1] - dectime[0]) / 2. * 1440.
+
+    timestamps = utcTimestamps(years, daysOfYear, metdata[:, 2], metdata[:, 3] - halfTimeStepMinutes, UTC)
+    azimuth, altitude = sunPositionsAt(timestamps, location['longitude'], location['latitude'])
+    zen = np.radians(90. - altitude)
+
+    # Day of year of the (local) time the sun position was calculated for
+    localTimes = timestamps + np.timedelta64(int(round(UTC * 60)), 'm')
+    jday = (localTimes.astype('datetime64[D]') - localTimes.astype('datetime64[Y]').astype('datetime64[D]')).astype(np.int64) + 1
+
+    leafon1 = 97 # as in the original
+    leafoff1 = 300
+    leafon = ((daysOfYear > leafon1) | (daysOfYear < leafoff1)).astype(float)
+
+    # Daily maximum altitude - worked out on the first row and the first row of each day, then carried forward
+    newDay = np.mod(dectime, np.floor(dectime)) == 0
+    newDay[0] = True
+    dayRows = np.flatnonzero(newDay)
+    steps = np.arange(0, (1440 - 615) // 15)
+    gridTimes = utcTimestamps(np.repeat(years[dayRows], len(steps)), np.repeat(daysOfYear[dayRows], len(steps)),
+                              10, np.tile(15 + 15 * steps, len(dayRows)), UTC)
+    gridAzimuth, gridAltitude = sunPositionsAt(gridTimes, location['longitude'], location['latitude'])
+    dailyMaximum = np.maximum(gridAltitude.reshape(len(dayRows), len(steps)).max(axis=1), 0.)
+    altmax = dailyMaximum[np.cumsum(newDay) - 1]
+
+    return (years.astype(float).reshape(1, rows), altitude.reshape(1, rows), azimuth.reshape(1, rows), zen.reshape(1, rows),
+            jday.astype(float).reshape(1, rows), leafon.reshape(1, rows), dectime, altmax.reshape(1, rows))
@@ -0,0 +1,149 @@
+"""
+In-memory cache of shadow masks by sun position, shared across the days of a shadow calculation
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from collections import OrderedDict
+from pathlib import Path # Post python 3.4
+import numpy as np
+from .cache_utils import arrayDigest
+
+# Default limit on the memory used by the masks kept by one cache
+SUN_SHADOW_CACHE_MEMORY_MB = 256
+
+
+class SunShadowCache():
+    """
+    The shadow cast on a DSM depends only on the sun's azimuth and altitude, and the sun passes
+    through almost the same positions on several of the days we calculate (20 March and
+    23 September, for example). This cache keeps the shadow masks by sun position so that each
+    position is only cast once.
+
+    Sun positions are rounded to a multiple of the tolerance (in degrees) and the shadow is cast
+    for the rounded position, so with a tolerance of 0.25 the sun is never more than 0.125 degrees
+    from where the shadow was cast. A tolerance of 0 only matches identical positions and gives
+    exactly the same results as casting every shadow.
+
+    Masks are kept bit-packed, least recently used first out once maxMemoryMB is reached. If a
+    spill directory is given, masks pushed out of memory are written there (named after a hash of
+    the DSM) and read back rather than recast - this also lets later runs on the same DSM reuse them.
+
+    Attributes
+    ----------
+        dsm : Numpy Array
+            the DSM the shadows are cast on
+        scale : float
+            pixels per metre of the DSM
+        tolerance : float
+            sun positions within this many degrees may share a shadow (0 = exact positions only)
+        maxMemoryMB : float
+            limit on the memory used by the masks held in memory
+        spillDirectory : Path
+            optional - where masks are written when pushed out of memory
+        method : str
+            optional - name of the shadow method, so that shadows cast by different methods are kept apart
+    """
+
+    def __init__(self, dsm, scale, tolerance=0, maxMemoryMB=SUN_SHADOW_CACHE_MEMORY_MB, spillDirectory=None, method=''):
+        self.shape = dsm.shape
+        self.tolerance = float(tolerance)
+        self.maxBytes = int(maxMemoryMB * 2**20)
+        self.key = arrayDigest(dsm, float(scale), self.tolerance, method)
+        self.spillDirectory = None if spillDirectory is None else Path(spillDirectory)
+        self.masks = OrderedDict()
+        self.bytesUsed = 0
+        self.hits = 0
+        self.misses = 0
+        self.spillReads = 0
+
+    def shadow(self, azimuth, altitude, castShadow):
+        """
+        The shadow for a sun position - 1 where sunlit, 0 in shadow - from the cache if
+        possible, otherwise cast with castShadow(azimuth, altitude) and kept.
+        """
+        positionKey, azimuth, altitude = self.quantise(azimuth, altitude)
+        packed = self.masks.get(positionKey)
+        if packed is not None:
+            self.masks.move_to_end(positionKey)
+            self.hits += 1
+            return self.unpack(packed)
+
+        packed = self.readSpilled(positionKey)
+        if packed is not None:
+            self.spillReads += 1
+            self.store(positionKey, packed)
+            return self.unpack(packed)
+
+        self.misses += 1
+        shadow = castShadow(azimuth, altitude)
+        self.store(positionKey, np.packbits(shadow.ravel() > 0.5))
+        return shadow
+
+    # The cache key for a sun position, and the position the shadow is cast for
+    def quantise(self, azimuth, altitude):
+        if self.tolerance == 0:
+            return (float(azimuth), float(altitude)), azimuth, altitude
+        azimuthStep = int(round(azimuth / self.tolerance))
+        altitudeStep = int(round(altitude / self.tolerance))
+        # The sun must stay above the horizon to cast a shadow
+        return (azimuthStep, altitudeStep), azimuthStep * self.tolerance, max(altitudeStep * self.tolerance, self.tolerance / 2)
+
+    def store(self, positionKey, packed):
+        self.masks[positionKey] = packed
+        self.bytesUsed += packed.nbytes
+        while self.bytesUsed > self.maxBytes and len(self.masks) > 1:
+            evictedKey, evicted = self.masks.popitem(last=False)
+            self.bytesUsed -= evicted.nbytes
+            self.spill(evictedKey, evicted)
+
+    def unpack(self, packed):
+        return np.unpackbits(packed, count=self.shape[0] * self.shape[1]).reshape(self.shape).astype(float)
+
+    def spillFilePath(self, positionKey):
+        return self.spillDirectory / f"sun-shadow-{self.key}-{positionKey[0]}-{positionKey[1]}.npy"
+
+    # Writes a mask pushed out of memory to the spill directory (via a temporary file, so an
+    # interrupted write never leaves a partial mask behind)
+    def spill(self, positionKey, packed):
+        if self.spillDirectory is None:
+            return
+        filePath = self.spillFilePath(positionKey)
+        if filePath.exists():
+            return
+        self.spillDirectory.mkdir(parents=True, exist_ok=True)
+        partialFilePath = filePath.with_suffix('.partial.npy')
+        np.save(str(partialFilePath), packed)
+        os.replace(str(partialFilePath), str(filePath))
+
+    # Writes the masks still in memory to the spill directory too, so that later runs can use them
+    def spillAll(self):
+        for positionKey, packed in self.masks.items():
+            self.spill(positionKey, packed)
+
+    def readSpilled(self, positionKey):
+        if self.spillDirectory is None:
+            return None
+        filePath = self.spillFilePath(positionKey)
+        if not filePath.exists():
+            return None
+        return np.load(str(filePath))
+
+    # Text for the log, e.g. "96 sun positions: 52 cast, 44 from memory, 0 from disk"
+    def describeUsage(self):
+        total = self.hits + self.misses + self.spillReads
+        return f"{total} sun positions: {self.misses} cast, {self.hits} from memory, {self.spillReads} from disk"
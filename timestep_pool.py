@@ -0,0 +1,184 @@
+"""
+Parallel calculation of the time step shadows of one or more days in a pool of worker processes
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, wait
+from UMEP.Utilities import shadowingfunctions as shadow
+from .shadow_kernels import lineSweepShadow, compositeWideAreaWindow
+from .low_sun_resolution import LowSunCaster
+from .process_pool import createProcessPool, cancelFutures, numberOfWorkers, SharedArrays, attachSharedArrays
+
+# Number of chunks of time steps handed to each worker process.
+# More chunks gives smoother progress reporting and quicker cancellation, fewer gives less copying of results.
+TIMESTEP_CHUNKS_PER_WORKER = 3
+
+
+# The shadow casting functions the worker processes can use, given (array, scale, azimuth, altitude) -
+# UMEP's shadow casting (as castShadow in dailyshading_modified, without a progress bar) and the line sweep
+def umepShadow(array, scale, azimuth, altitude):
+    return shadow.shadowingfunctionglobalradiation(array, azimuth, altitude, scale, None, 1)
+
+def lineSweepCast(array, scale, azimuth, altitude):
+    return lineSweepShadow(array, azimuth, altitude, scale)
+
+
+def parallelShadingFromSunPositions(clippedHighResArray, lowResWideArray, scale, scaleWide, windowIndices, sunPositions,
+                                    useWideArea, castFunction=umepShadow, lowSun=None, workers=None, feedback=None, wideShadowCaster=None):
+    """
+    The shadow results of several days (as shadingFromSunPositions), with the time steps with the sun up shared out
+    between worker processes in chunks - the steps of all the days together, so the workers are kept busy even
+    with few steps a day. The DSMs are placed in shared memory once; each chunk returns its partial totals for
+    each day, which are added up here.
+
+    Attributes
+    ----------
+        windowIndices : tuple
+            the rows and columns of the low resolution wide area making up the local region, from wideAreaWindowIndices
+            (None without a wide area)
+        sunPositions : list
+            (altitudes, azimuths) of each day
+        castFunction : function
+            umepShadow or lineSweepCast
+        lowSun : tuple
+            optional - (altitude, factor) to cast the local shadows of a lower sun on a coarser DSM, as LowSunCaster
+        workers : int
+            number of worker processes (0 or None = one per CPU core)
+        feedback : QgsProcessingFeedback
+            optional - progress is reported from 0 to 80% as the chunks finish, and the calculation stops if cancelled
+        wideShadowCaster : function
+            optional - a picklable function of (azimuth, altitude) giving the wide area shadow, instead of casting it
+            on lowResWideArray with castFunction
+    Returns
+    -------
+        list of shadow result dictionaries, one per day (empty if cancelled)
+    """
+    steps = [(day, i, azimuths[i], altitudes[i]) for day, (altitudes, azimuths) in enumerate(sunPositions)
+             for i in np.flatnonzero(altitudes > 0)]
+    workers = numberOfWorkers(workers)
+    chunks = [chunk for chunk in np.array_split(np.arange(len(steps)), workers * TIMESTEP_CHUNKS_PER_WORKER) if chunk.size > 0]
+
+    totals = [DayTotals(clippedHighResArray.shape, lowResWideArray.shape if useWideArea else None) for day in sunPositions]
+    arrays = {'dsm': clippedHighResArray}
+    if useWideArea:
+        arrays['wide'] = lowResWideArray
+    sharedArrays = SharedArrays(arrays)
+    cancelled = False
+    try:
+        initargs = (sharedArrays.descriptors(), scale, scaleWide, windowIndices, castFunction, lowSun, wideShadowCaster)
+        with createProcessPool(workers, initialiseTimestepWorker, initargs) as pool:
+            futures = {pool.submit(calculateTimestepChunk, [steps[index] for index in chunk]) for chunk in chunks}
+            stepsDone = 0
+            while futures:
+                if feedback is not None and feedback.isCanceled():
+                    cancelFutures(futures)
+                    cancelled = True
+                    break
+                done, futures = wait(futures, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunkTotals, numberOfSteps = future.result()
+                    for day, dayTotals in chunkTotals.items():
+                        totals[day].add(dayTotals)
+                    stepsDone += numberOfSteps
+                    if feedback is not None:
+                        feedback.setProgress(int(80 * stepsDone / len(steps)))
+    finally:
+        sharedArrays.release()
+
+    if cancelled:
+        return []
+    return [dayTotals.shadowResult() for dayTotals in totals]
+
+
+class DayTotals():
+    """
+    The running totals of a day's shadows, as kept by shadingFromSunPositions - or those of part of the day,
+    which can be added together.
+    """
+
+    def __init__(self, shape, wideShape=None):
+        self.shtot = np.zeros(shape) # total with wide area influence included
+        self.shtotLocalOnly = np.zeros(shape)
+        self.shtotWideArea = np.zeros(wideShape) if wideShape is not None else None
+        self.index = 0
+        self.lastStep = -1 # the latest step, whose wide area shadow over the local region is kept (as shadingFromSunPositions does)
+        self.lastWindow = 0
+
+    def addStep(self, step, sh, combinedRaster, shLowResWideArea, clippedHighResWideAreaArray):
+        self.shtotLocalOnly += sh
+        self.index += 1
+        if self.shtotWideArea is not None:
+            self.shtotWideArea += shLowResWideArea
+            self.shtot += combinedRaster
+            self.shtotLocalOnly += sh # added twice with a wide area, as in shadingFromSunPositions
+        else:
+            self.shtot += sh
+        if step > self.lastStep:
+            self.lastStep = step
+            self.lastWindow = clippedHighResWideAreaArray
+
+    def add(self, other):
+        self.shtot += other.shtot
+        self.shtotLocalOnly += other.shtotLocalOnly
+        if self.shtotWideArea is not None:
+            self.shtotWideArea += other.shtotWideArea
+        self.index += other.index
+        if other.lastStep > self.lastStep:
+            self.lastStep = other.lastStep
+            self.lastWindow = other.lastWindow
+
+    def shadowResult(self):
+        shwidefinal = 0 if self.shtotWideArea is None else self.shtotWideArea / self.index
+        return {'shfinal': self.shtot / self.index, 'shwide': shwidefinal, 'shlocal': self.shtotLocalOnly / self.index,
+                'shWideZoomedArray': 0, 'shWideClippedArray': self.lastWindow}
+
+
+# Per process state of the time step worker processes
+timestepWorkerState = {}
+
+def initialiseTimestepWorker(descriptors, scale, scaleWide, windowIndices, castFunction, lowSun=None, wideShadowCaster=None):
+    arrays, blocks = attachSharedArrays(descriptors)
+    timestepWorkerState.update(arrays)
+    timestepWorkerState['blocks'] = blocks
+    timestepWorkerState['windowIndices'] = windowIndices
+    localShadowCaster = lambda azimuth, altitude: castFunction(arrays['dsm'], scale, azimuth, altitude)
+    if lowSun is not None:
+        localShadowCaster = LowSunCaster(arrays['dsm'], scale, castFunction, *lowSun).shadow
+    timestepWorkerState['localShadowCaster'] = localShadowCaster
+    if wideShadowCaster is None and 'wide' in arrays:
+        wideShadowCaster = lambda azimuth, altitude: castFunction(arrays['wide'], scaleWide, azimuth, altitude)
+    timestepWorkerState['wideShadowCaster'] = wideShadowCaster
+
+
+# Runs in a worker process: the DayTotals of each day of a chunk of (day, step, azimuth, altitude) time steps,
+# and the number of steps
+def calculateTimestepChunk(steps):
+    state = timestepWorkerState
+    dsm = state['dsm']
+    wide = state.get('wide')
+    totals = {}
+    for day, step, azimuth, altitude in steps:
+        dayTotals = totals.setdefault(day, DayTotals(dsm.shape, None if wide is None else wide.shape))
+        sh = state['localShadowCaster'](azimuth, altitude)
+        if wide is None:
+            dayTotals.addStep(step, sh, sh, 0, 0)
+            continue
+        shLowResWideArea = state['wideShadowCaster'](azimuth, altitude)
+        clippedHighResWideAreaArray = compositeWideAreaWindow(shLowResWideArea, *state['windowIndices'])
+        dayTotals.addStep(step, sh, sh * clippedHighResWideAreaArray * 1, shLowResWideArea, clippedHighResWideAreaArray)
+    return totals, len(steps)
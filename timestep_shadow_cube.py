@@ -0,0 +1,113 @@
+"""
+Shadow masks of every time step of a day, kept on disk, and the hourly sun profiles of roofs worked out from them
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Note: no qgis imports here - also used in worker processes
+
+import os
+from pathlib import Path # Post python 3.4
+import numpy as np
+
+
+class TimestepShadowCube():
+    """
+    The shadow mask of each time step of a day (1 where sunlit), one bit per pixel, in a memory-mapped
+    .npy file of shape (steps, packed bytes). The steps are equally spaced through the day from midnight
+    (local clock time), so step i is at i * 1440 / steps minutes; steps with the sun down are left in shadow.
+
+    As with the other caches, the cube is written to a temporary file and only renamed once complete.
+    """
+
+    def __init__(self, filePath, shape, steps):
+        self.filePath = Path(filePath)
+        self.partialFilePath = self.filePath.with_suffix('.partial.npy')
+        self.shape = tuple(shape)
+        self.steps = int(steps)
+        self.cube = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cube'] = None
+        return state
+
+    # Minutes after midnight of each step
+    def stepMinutes(self):
+        return np.arange(self.steps) * 1440. / self.steps
+
+    # Creates an empty (all shaded) cube ready for writing
+    def create(self):
+        self.filePath.parent.mkdir(parents=True, exist_ok=True)
+        packedLength = (self.shape[0] * self.shape[1] + 7) // 8
+        self.cube = np.lib.format.open_memmap(str(self.partialFilePath), mode='w+', dtype=np.uint8,
+                                              shape=(self.steps, packedLength))
+
+    def writeStep(self, index, shadow):
+        self.cube[index] = np.packbits(np.asarray(shadow).ravel() > 0.5)
+
+    # Renames the cube to its final name once the day is finished
+    def complete(self):
+        self.cube.flush()
+        self.cube = None
+        os.replace(str(self.partialFilePath), str(self.filePath))
+
+    # Removes a partly written cube (e.g. after the calculation has been cancelled)
+    def discard(self):
+        self.cube = None
+        if self.partialFilePath.exists():
+            os.remove(str(self.partialFilePath))
+
+    # The shadow mask of one step as a boolean array (True where sunlit)
+    def readStepMask(self, index):
+        if self.cube is None:
+            self.cube = np.load(str(self.filePath), mmap_mode='r')
+        bits = np.unpackbits(self.cube[index], count=self.shape[0] * self.shape[1])
+        return bits.reshape(self.shape).view(bool)
+
+
+def hourlyProfiles(cube, labels, numberOfLabels):
+    """
+    The fraction of each labelled area (e.g. roof) that is sunlit in each hour of the day - the average over its
+    pixels and over the time steps in the hour.
+
+    Attributes
+    ----------
+        cube : TimestepShadowCube
+            shadow masks of the day
+        labels : Numpy Array
+            integer label of each pixel (as the cube's shape), from 0 to numberOfLabels - 1, or -1 for none
+        numberOfLabels : int
+            number of labels
+    Returns
+    -------
+        profiles : Numpy Array
+            numberOfLabels x 24 sunlit fractions (NaN for labels with no pixels)
+    """
+    # The labelled pixels are picked out once, then every step only counts their sunlit pixels
+    labels = labels.ravel()
+    labelledPixels = np.flatnonzero(labels >= 0)
+    pixelLabels = labels[labelledPixels]
+    pixelsPerLabel = np.bincount(pixelLabels, minlength=numberOfLabels)
+
+    sunlitCounts = np.zeros((numberOfLabels, 24))
+    stepsPerHour = np.zeros(24)
+    for step, minutes in enumerate(cube.stepMinutes()):
+        hour = int(minutes // 60)
+        stepsPerHour[hour] += 1
+        sunlit = cube.readStepMask(step).ravel()[labelledPixels]
+        sunlitCounts[:, hour] += np.bincount(pixelLabels, weights=sunlit, minlength=numberOfLabels)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sunlitCounts / (pixelsPerLabel[:, None] * np.maximum(stepsPerHour, 1)[None, :])
@@ -0,0 +1,113 @@
+"""
+Tiled, multi-process calculation of the wall height and wall aspect rasters
+/***************************************************************************
+        copyright            : (c) 2021 by Cumbria Action for Sustainability
+        author               : Tom Nicholls
+        email                : tom@codeclass.co.uk
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, wait
+from UMEP.WallHeight import wallalgorithms
+from .WallworkerModified import Worker as WallWorker
+from .WallworkerModified import FILTER_METHOD, GRADIENT_METHOD, calculateFilterSize, gradientReach
+from .process_pool import createProcessPool, cancelFutures, SilentFeedback
+
+
+# Number of pixels that must be added around each tile so that the interior of the tile is
+# calculated exactly as it would be for the whole array.
+# The line filter reaches filthalveceil pixels out, but the original filter loop also stops one pixel
+# short of the end of the array, so an extra pixel is needed to keep tile interiors inside its range.
+# The gradient method reaches as far as its filters do (gradientReach). The walls themselves (findwalls)
+# only reach one pixel.
+def tileHalo(scale, method=FILTER_METHOD):
+    if method == GRADIENT_METHOD:
+        return max(1, gradientReach(scale))
+    filtersize, filthalveceil, filthalvefloor = calculateFilterSize(scale)
+    return filthalveceil + 1
+
+
+# Splits an array of the given shape into tiles.
+# Returns a list of (interior, padded) pairs, each being (rowStart, rowEnd, colStart, colEnd)
+def splitIntoTiles(shape, tileSize, halo):
+    rows, cols = shape
+    tiles = []
+    for rowStart in range(0, rows, tileSize):
+        rowEnd = min(rowStart + tileSize, rows)
+        for colStart in range(0, cols, tileSize):
+            colEnd = min(colStart + tileSize, cols)
+            padded = (max(rowStart - halo, 0), min(rowEnd + halo, rows),
+                      max(colStart - halo, 0), min(colEnd + halo, cols))
+            tiles.append(((rowStart, rowEnd, colStart, colEnd), padded))
+    return tiles
+
+
+# Runs in a worker process: calculates wall height and aspect for one padded tile
+# and returns just the interior of the tile
+def calculateWallTile(dsmTile, interior, padded, scale, wallLimit, method):
+    wallHeightTile = wallalgorithms.findwalls(dsmTile, wallLimit)
+    wallAspectTile = WallWorker(wallHeightTile, scale, dsmTile, SilentFeedback(), method).run()
+    rowStart, rowEnd, colStart, colEnd = interior
+    rowOffset, colOffset = padded[0], padded[2]
+    window = (slice(rowStart - rowOffset, rowEnd - rowOffset), slice(colStart - colOffset, colEnd - colOffset))
+    return interior, wallHeightTile[window], wallAspectTile[window]
+
+
+class WallTiler():
+    """
+    Calculates the wall height and wall aspect rasters of a DSM-DTM array by splitting it into
+    tiles (with a halo of extra pixels around each one) and processing the tiles in a pool of
+    worker processes. The tile interiors are stitched back together, giving the same result as
+    running wallalgorithms.findwalls and WallworkerModified.Worker on the whole array.
+
+    As with the untiled calculation, the returned wall height array has been reduced to 0 and 1 by
+    the wall aspect calculation.
+    """
+
+    def __init__(self, dsm, scale, wallLimit, feedback, method=FILTER_METHOD, tileSize=1000, workers=None):
+        self.dsm = dsm
+        self.scale = scale
+        self.wallLimit = wallLimit
+        self.feedback = feedback
+        self.method = method
+        self.tileSize = tileSize
+        self.workers = workers
+
+    # Returns wallHeightArray, wallAspectArray
+    def run(self):
+        halo = tileHalo(self.scale, self.method)
+        tiles = splitIntoTiles(self.dsm.shape, self.tileSize, halo)
+        wallHeightArray = np.zeros(self.dsm.shape)
+        wallAspectArray = np.zeros(self.dsm.shape)
+
+        with createProcessPool(self.workers) as pool:
+            futures = set()
+            for interior, padded in tiles:
+                rowStart, rowEnd, colStart, colEnd = padded
+                dsmTile = np.ascontiguousarray(self.dsm[rowStart:rowEnd, colStart:colEnd])
+                futures.add(pool.submit(calculateWallTile, dsmTile, interior, padded, self.scale, self.wallLimit, self.method))
+
+            completed = 0
+            while futures:
+                if self.feedback.isCanceled():
+                    cancelFutures(futures)
+                    break
+                done, futures = wait(futures, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (rowStart, rowEnd, colStart, colEnd), wallHeightTile, wallAspectTile = future.result()
+                    wallHeightArray[rowStart:rowEnd, colStart:colEnd] = wallHeightTile
+                    wallAspectArray[rowStart:rowEnd, colStart:colEnd] = wallAspectTile
+                    completed += 1
+                    self.feedback.setProgress(int(completed * 50 / len(tiles))) # From 0 to 50% as this is the first half of processing
+
+        return wallHeightArray, wallAspectArray